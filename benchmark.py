@@ -0,0 +1,933 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+import os
+import sys
+import math
+import time
+import json
+import random
+import shutil
+import base64
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import multiprocessing
+import concurrent.futures
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(filename: str):
+    # the scripts are not importable by name (e.g. `lf-utf8.py`)
+    module_name = os.path.splitext(filename)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_decode(bs: bytes):
+    # the exception-driven trial decoding that `Encoding.decode` used before
+    for encoding in ['utf-8-sig', 'utf-8', 'utf-16', 'gb2312', 'shift-jis']:
+        try:
+            decoded_content = bs.decode(encoding)
+            return encoding, decoded_content
+        except Exception:
+            pass
+
+    return None, bs
+
+
+SAMPLE_TEXT_LIST = [
+    ('ascii', 'int main(int argc, char **argv) { return 0; }\n'),
+    ('utf-8', '# 中文注释 日本語のコメント\nprint("héllo wörld")\n'),
+    ('utf-8-sig', '﻿// 带 BOM 的源文件\nvoid f();\n'),
+    ('utf-16', 'Windows resource 文件\r\n'),
+    ('gb2312', '// 简体中文注释\nint x = 1;\n'),
+    ('shift-jis', '// 日本語のコメント\nint y = 2;\n'),
+]
+
+
+def generate_encoding_corpus(seed: int, num_files: int, filesize: int, binary_ratio: float):
+    rng = random.Random(seed)
+    corpus = []
+
+    for _ in range(num_files):
+        if rng.random() < binary_ratio:
+            corpus.append(('binary', rng.randbytes(filesize)))
+            continue
+
+        label, text = rng.choice(SAMPLE_TEXT_LIST)
+        repeated_text = text * max(1, filesize // len(text.encode('utf-8')))
+        if label in ('ascii', 'utf-8-sig'):
+            # the BOM is part of the sample text
+            bs = repeated_text.encode('utf-8')
+        else:
+            bs = repeated_text.encode(label)
+
+        corpus.append((label, bs))
+
+    return corpus
+
+
+def time_decode(decode_func, corpus):
+    result_list = []
+    start_time = time.perf_counter()
+    for _, bs in corpus:
+        result_list.append(decode_func(bs))
+    elapsed = time.perf_counter() - start_time
+
+    return elapsed, result_list
+
+
+def is_correctly_decoded(label: str, bs: bytes, decoded_content):
+    if label == 'binary':
+        return type(decoded_content) is bytes
+
+    if type(decoded_content) is not str:
+        return False
+
+    true_encoding = 'utf-8' if (label == 'ascii') else label
+    return decoded_content == bs.decode(true_encoding)
+
+
+def benchmark_encoding(args):
+    lf_utf8 = load_script('lf-utf8.py')
+
+    corpus = generate_encoding_corpus(args.seed, args.num_files, args.filesize, args.binary_ratio)
+    total_bytes = sum([len(bs) for _, bs in corpus])
+
+    report = {
+        'benchmark': 'encoding',
+        'num_files': len(corpus),
+        'total_bytes': total_bytes,
+        'results': {},
+    }
+
+    for name, decode_func in [
+        ('legacy_cascade', legacy_decode),
+        ('detector', lf_utf8.Encoding.decode),
+    ]:
+        best_elapsed = None
+        for _ in range(args.repeat):
+            elapsed, result_list = time_decode(decode_func, corpus)
+            if (best_elapsed is None) or (elapsed < best_elapsed):
+                best_elapsed = elapsed
+
+        detected = {}
+        num_correct = 0
+        for (label, bs), (encoding, decoded_content) in zip(corpus, result_list):
+            key = f'{label} -> {encoding}'
+            detected[key] = detected.get(key, 0) + 1
+            if is_correctly_decoded(label, bs, decoded_content):
+                num_correct += 1
+
+        report['results'][name] = {
+            'correct_files': num_correct,
+            'seconds': best_elapsed,
+            'files_per_second': len(corpus) / best_elapsed,
+            'mb_per_second': total_bytes / (1024 * 1024) / best_elapsed,
+            'detected': detected,
+        }
+
+    return report
+
+
+# text that is appended to the generated comments, the encoding decides which text can be used
+COMMENT_TEXT_DICT = {
+    'utf-8': '中文注释 日本語のコメント héllo wörld',
+    'utf-8-sig': '带 BOM 的源文件',
+    'gb2312': '简体中文注释',
+    'shift-jis': '日本語のコメント',
+}
+
+CODE_LINE_LIST = [
+    'int main(int argc, char **argv) {',
+    '    return compute(argc, argv) + 1;',
+    '}',
+    'SELECT id, name FROM users WHERE id = 42;',
+    'def format_text_file(inpath):',
+    '    content = open(inpath).read()',
+    'public static void main(String[] args) {',
+    '',
+]
+
+TEXT_EXTENSIONS = ['.c', '.h', '.cpp', '.java', '.py', '.txt', '.md', '.sql', '.csv']
+
+# extensions that are not in IGNORED_EXTS so the content has to be sniffed
+BINARY_EXTENSIONS = ['.so', '.a', '.zip', '.parquet', '.pyc', '.o']
+
+
+def parse_weights(weights_str: str):
+    # 'utf-8=80,gb2312=20' -> [('utf-8', 80.0), ('gb2312', 20.0)]
+    weight_list = []
+    for item in weights_str.split(','):
+        name, weight = item.split('=')
+        weight_list.append((name.strip(), float(weight)))
+
+    return weight_list
+
+
+def generate_text_content(rng: random.Random, encoding: str, filesize: int, crlf: bool, trailing_whitespace: bool):
+    line_ending = '\r\n' if crlf else '\n'
+    line_list = []
+    num_bytes = 0
+
+    while num_bytes < filesize:
+        if rng.random() < 0.2:
+            line = '// ' + COMMENT_TEXT_DICT.get(encoding, 'plain comment')
+        else:
+            line = rng.choice(CODE_LINE_LIST)
+
+        if trailing_whitespace and (rng.random() < 0.1):
+            line += rng.choice([' ', '\t', '  '])
+
+        line_list.append(line)
+        # close enough, multi-byte characters are counted as one byte
+        num_bytes += len(line) + len(line_ending)
+
+    content = line_ending.join(line_list) + line_ending
+    if encoding == 'utf-8-sig':
+        return content.encode('utf-8-sig')
+
+    return content.encode(encoding)
+
+
+def generate_notebook(rng: random.Random, num_cells: int, image_size: int, canonical: bool):
+    cell_list = []
+    for cell_idx in range(num_cells):
+        image_bs = rng.randbytes(image_size)
+        cell_list.append({
+            'cell_type': 'code',
+            'execution_count': cell_idx + 1,
+            'metadata': {},
+            'outputs': [
+                {
+                    'data': {
+                        'image/png': base64_encode(image_bs),
+                        'text/plain': ['<Figure size 432x288 with 1 Axes>'],
+                    },
+                    'metadata': {},
+                    'output_type': 'display_data',
+                },
+            ],
+            'source': [
+                'import matplotlib.pyplot as plt\n',
+                f'plt.plot(range({cell_idx + 10}))',
+            ],
+        })
+
+    obj = {
+        'cells': cell_list,
+        'metadata': {
+            'kernelspec': {
+                'display_name': 'Python 3',
+                'language': 'python',
+                'name': 'python3',
+            },
+            'language_info': {
+                'name': 'python',
+                'version': '3.8.5',
+            },
+        },
+        'nbformat': 4,
+        'nbformat_minor': 4,
+    }
+
+    if canonical:
+        return (json.dumps(obj, ensure_ascii=False, indent='\t') + '\n').encode('utf-8')
+
+    # the layout that Jupyter writes
+    return (json.dumps(obj, ensure_ascii=False, indent=1) + '\n').encode('utf-8')
+
+
+def base64_encode(bs: bytes):
+    return base64.b64encode(bs).decode('ascii') + '\n'
+
+
+SOLUTION_CONFIG_LIST = ['Debug|x64', 'Debug|x86', 'Release|x64', 'Release|x86']
+VCXPROJ_CONFIG_LIST = ['Debug|x64', 'Debug|Win32', 'Release|x64', 'Release|Win32']
+
+
+def generate_solution_file(project_name_list: list):
+    line_list = [
+        'Microsoft Visual Studio Solution File, Format Version 12.00',
+        '# Visual Studio Version 16',
+    ]
+
+    for project_idx, project_name in enumerate(project_name_list):
+        guid = '{%08X-0000-0000-0000-000000000000}' % project_idx
+        line_list.append(f'Project("{{8BC9CEB8-8B4A-11D0-8D11-00A0C91BC942}}") = "{project_name}", "{project_name}\\{project_name}.vcxproj", "{guid}"')
+        line_list.append('EndProject')
+
+    line_list.append('Global')
+    line_list.append('\tGlobalSection(SolutionConfigurationPlatforms) = preSolution')
+    for config in SOLUTION_CONFIG_LIST:
+        line_list.append(f'\t\t{config} = {config}')
+    line_list.append('\tEndGlobalSection')
+    line_list.append('\tGlobalSection(ProjectConfigurationPlatforms) = postSolution')
+    for project_idx in range(len(project_name_list)):
+        guid = '{%08X-0000-0000-0000-000000000000}' % project_idx
+        for config in SOLUTION_CONFIG_LIST:
+            line_list.append(f'\t\t{guid}.{config}.ActiveCfg = {config}')
+            line_list.append(f'\t\t{guid}.{config}.Build.0 = {config}')
+    line_list.append('\tEndGlobalSection')
+    line_list.append('EndGlobal')
+
+    return ('\r\n'.join(line_list) + '\r\n').encode('utf-8')
+
+
+def generate_vcxproj_file(num_source_files: int = 0):
+    line_list = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<Project DefaultTargets="Build" ToolsVersion="16.0" xmlns="http://schemas.microsoft.com/developer/msbuild/2003">',
+        '  <ItemGroup Label="ProjectConfigurations">',
+    ]
+
+    for config in VCXPROJ_CONFIG_LIST:
+        configuration, platform = config.split('|')
+        line_list.append(f'    <ProjectConfiguration Include="{config}">')
+        line_list.append(f'      <Configuration>{configuration}</Configuration>')
+        line_list.append(f'      <Platform>{platform}</Platform>')
+        line_list.append('    </ProjectConfiguration>')
+
+    line_list.append('  </ItemGroup>')
+
+    for config in VCXPROJ_CONFIG_LIST:
+        line_list.append(f'  <PropertyGroup Condition="\'$(Configuration)|$(Platform)\'==\'{config}\'" Label="Configuration">')
+        line_list.append('    <ConfigurationType>Application</ConfigurationType>')
+        line_list.append('  </PropertyGroup>')
+        line_list.append(f'  <ItemDefinitionGroup Condition="\'$(Configuration)|$(Platform)\'==\'{config}\'">')
+        line_list.append('    <ClCompile>')
+        line_list.append('      <WarningLevel>Level3</WarningLevel>')
+        line_list.append('    </ClCompile>')
+        line_list.append('  </ItemDefinitionGroup>')
+
+    if num_source_files > 0:
+        line_list.append('  <ItemGroup>')
+        for file_idx in range(num_source_files):
+            line_list.append(f'    <ClCompile Include="src\\file{file_idx}.cpp" />')
+        line_list.append('  </ItemGroup>')
+
+    line_list.append('</Project>')
+
+    return ('\r\n'.join(line_list) + '\r\n').encode('utf-8')
+
+
+def legacy_remove_solution_config(module, content_bs: bytes):
+    # the line by line check that the Visual Studio cleaner used before the combined matcher
+    output_lines = []
+    for line in content_bs.decode('utf-8').splitlines():
+        detected = False
+        for s in module.SOLUTION_FILE_BLACKLIST_CONFIG:
+            if s in line:
+                detected = True
+                break
+
+        if not detected:
+            output_lines.append(line)
+
+    output_bs = ('\n'.join(output_lines) + '\n').encode('utf-8')
+    return (content_bs != output_bs), output_bs
+
+
+def legacy_remove_vcxproj_config(module, content_bs: bytes):
+    output_lines = []
+
+    ignoring_tag_name = None
+    for line in content_bs.decode('utf-8').splitlines():
+        if ignoring_tag_name is not None:
+            if f'</{ignoring_tag_name}>' in line:
+                ignoring_tag_name = None
+            continue
+
+        for tag_name, attribute_name, attribute_value_list in module.VCXPROJ_FILE_BLACKLIST_CONFIG_INFO_LIST:
+            if (tag_name in line) and (attribute_name in line):
+                for attribute_value in attribute_value_list:
+                    if attribute_value in line:
+                        ignoring_tag_name = tag_name
+                        break
+                if ignoring_tag_name is not None:
+                    break
+
+        if ignoring_tag_name is None:
+            output_lines.append(line)
+
+    output_bs = ('\n'.join(output_lines) + '\n').encode('utf-8')
+    return (content_bs != output_bs), output_bs
+
+
+def generate_tree(outdir: str, args):
+    # The tree only depends on the arguments so the same arguments always produce the same files.
+    rng = random.Random(args.seed)
+    encoding_weight_list = parse_weights(args.encodings)
+    encoding_list = [encoding for encoding, _ in encoding_weight_list]
+    weight_list = [weight for _, weight in encoding_weight_list]
+
+    manifest = {
+        'num_text_files': 0,
+        'num_binary_files': 0,
+        'num_notebooks': 0,
+        'num_vs_projects': 0,
+        'total_bytes': 0,
+        'encodings': {},
+    }
+
+    def write_file(relpath: str, bs: bytes):
+        filepath = os.path.join(outdir, relpath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, mode='wb') as outfile:
+            outfile.write(bs)
+
+        manifest['total_bytes'] += len(bs)
+
+    def random_dirpath():
+        depth = rng.randint(0, args.max_depth)
+        return os.path.join('', *[f'd{rng.randint(0, args.fanout - 1)}' for _ in range(depth)])
+
+    for file_idx in range(args.num_files):
+        dirpath = random_dirpath()
+        filesize = int(rng.lognormvariate(math.log(args.median_filesize), 1.0))
+        filesize = max(16, min(filesize, args.max_filesize))
+
+        if rng.random() < args.binary_ratio:
+            ext = rng.choice(BINARY_EXTENSIONS)
+            write_file(os.path.join(dirpath, f'f{file_idx}{ext}'), rng.randbytes(filesize))
+            manifest['num_binary_files'] += 1
+            continue
+
+        encoding = rng.choices(encoding_list, weights=weight_list)[0]
+        ext = rng.choice(TEXT_EXTENSIONS)
+        content_bs = generate_text_content(
+            rng,
+            encoding,
+            filesize,
+            crlf=(rng.random() < args.crlf_ratio),
+            trailing_whitespace=(rng.random() < args.crlf_ratio),
+        )
+
+        write_file(os.path.join(dirpath, f'f{file_idx}{ext}'), content_bs)
+        manifest['num_text_files'] += 1
+        manifest['encodings'][encoding] = manifest['encodings'].get(encoding, 0) + 1
+
+    for notebook_idx in range(args.num_notebooks):
+        notebook_bs = generate_notebook(
+            rng,
+            num_cells=4,
+            image_size=args.notebook_image_size,
+            canonical=(notebook_idx % 2 == 0),
+        )
+        write_file(os.path.join(random_dirpath(), f'notebook{notebook_idx}.ipynb'), notebook_bs)
+        manifest['num_notebooks'] += 1
+
+    if args.num_vs_projects > 0:
+        project_name_list = [f'Project{project_idx}' for project_idx in range(args.num_vs_projects)]
+        write_file(os.path.join('vs', 'Solution.sln'), generate_solution_file(project_name_list))
+        vcxproj_bs = generate_vcxproj_file()
+        for project_name in project_name_list:
+            write_file(os.path.join('vs', project_name, f'{project_name}.vcxproj'), vcxproj_bs)
+        manifest['num_vs_projects'] = len(project_name_list)
+
+    return manifest
+
+
+def get_total_filesize(filepath_list: list):
+    return sum([os.path.getsize(filepath) for filepath in filepath_list])
+
+
+# Each phase function prepares its input (untimed) and returns a function
+# that runs the phase and returns `(num_files, num_bytes)`.
+
+
+def phase_lf_utf8_discover(module, tree_dir: str, jobs: int):
+    def run():
+        return len(list(module.iter_regular_files(tree_dir))), 0
+
+    return run
+
+
+def phase_lf_utf8_check(module, tree_dir: str, jobs: int):
+    filepath_list = module.find_regular_files(tree_dir)
+    num_bytes = get_total_filesize(filepath_list)
+
+    def run():
+        for _ in module.iterate_check_results(filepath_list, jobs=jobs):
+            pass
+
+        return len(filepath_list), num_bytes
+
+    return run
+
+
+def phase_lf_utf8_check_single_process(module, tree_dir: str, jobs: int):
+    return phase_lf_utf8_check(module, tree_dir, 1)
+
+
+def phase_lf_utf8_index_warm(module, tree_dir: str, jobs: int):
+    filepath_list = module.find_regular_files(tree_dir)
+    num_bytes = get_total_filesize(filepath_list)
+
+    # also removed when the phase process exits if `run` is never called
+    index_dir = tempfile.TemporaryDirectory(prefix='benchmark-index-')
+    index_filepath = os.path.join(index_dir.name, 'benchmark.index')
+    version = module.get_normalization_version()
+
+    index = module.CleanFileIndex(index_filepath, version)
+    for filepath, format_result in module.iterate_check_results(filepath_list, index=index):
+        if 'digest' in format_result:
+            index.mark_clean(filepath, format_result['stat'], format_result['digest'])
+    index.save()
+
+    def run():
+        try:
+            warm_index = module.CleanFileIndex(index_filepath, version)
+            warm_index.load()
+            for _ in module.iterate_check_results(filepath_list, jobs=jobs, index=warm_index):
+                pass
+        finally:
+            index_dir.cleanup()
+
+        return len(filepath_list), num_bytes
+
+    return run
+
+
+def phase_ipynb_discover(module, tree_dir: str, jobs: int):
+    def run():
+        return len(list(module.iter_ipynb_files(tree_dir))), 0
+
+    return run
+
+
+def phase_ipynb_normalize(module, tree_dir: str, jobs: int):
+    filepath_list = list(module.iter_ipynb_files(tree_dir))
+    num_bytes = get_total_filesize(filepath_list)
+
+    def run():
+        for filepath in filepath_list:
+            module.format_ipynb_file(filepath)
+
+        return len(filepath_list), num_bytes
+
+    return run
+
+
+def phase_visualstudio_discover(module, tree_dir: str, jobs: int):
+    def run():
+        return len(list(module.iter_visual_studio_config_files(tree_dir))), 0
+
+    return run
+
+
+def phase_visualstudio_solution(module, tree_dir: str, jobs: int):
+    solution_file_list = []
+    module.find_visual_studio_config_files(tree_dir, solution_file_list, [])
+    num_bytes = get_total_filesize(solution_file_list)
+
+    def run():
+        for solution_file in solution_file_list:
+            module.remove_visual_studio_config_from_solution_file(solution_file)
+
+        return len(solution_file_list), num_bytes
+
+    return run
+
+
+def phase_visualstudio_vcxproj(module, tree_dir: str, jobs: int):
+    vcxproj_file_list = []
+    module.find_visual_studio_config_files(tree_dir, [], vcxproj_file_list)
+    num_bytes = get_total_filesize(vcxproj_file_list)
+
+    def run():
+        for vcxproj_file in vcxproj_file_list:
+            module.remove_visual_studio_config_from_vcxproj_file(vcxproj_file)
+
+        return len(vcxproj_file_list), num_bytes
+
+    return run
+
+
+# phase name -> (script filename, phase function)
+TREE_PHASES = {
+    'lf-utf8/discover': ('lf-utf8.py', phase_lf_utf8_discover),
+    'lf-utf8/check': ('lf-utf8.py', phase_lf_utf8_check_single_process),
+    'lf-utf8/check_jobs': ('lf-utf8.py', phase_lf_utf8_check),
+    'lf-utf8/index_warm': ('lf-utf8.py', phase_lf_utf8_index_warm),
+    'ipynb/discover': ('ipynb.py', phase_ipynb_discover),
+    'ipynb/normalize': ('ipynb.py', phase_ipynb_normalize),
+    'visualstudio/discover': ('visualstudio-remove_bloated_configurations.py', phase_visualstudio_discover),
+    'visualstudio/solution': ('visualstudio-remove_bloated_configurations.py', phase_visualstudio_solution),
+    'visualstudio/vcxproj': ('visualstudio-remove_bloated_configurations.py', phase_visualstudio_vcxproj),
+}
+
+
+def get_peak_rss_bytes():
+    if resource is None:
+        return None
+
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak_rss
+
+    return peak_rss * 1024
+
+
+def run_phase(phase_name: str, tree_dir: str, jobs: int):
+    # runs in a fresh process so the peak RSS belongs to this phase only
+    script_filename, phase_func = TREE_PHASES[phase_name]
+    module = load_script(script_filename)
+    run = phase_func(module, tree_dir, jobs)
+
+    start_time = time.perf_counter()
+    num_files, num_bytes = run()
+    seconds = time.perf_counter() - start_time
+
+    return {
+        'num_files': num_files,
+        'num_bytes': num_bytes,
+        'seconds': seconds,
+        'peak_rss_bytes': get_peak_rss_bytes(),
+    }
+
+
+def get_commit_id():
+    git_process = subprocess.run(
+        args=['git', 'rev-parse', 'HEAD'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=SCRIPT_DIR,
+    )
+
+    if git_process.returncode != 0:
+        return None
+
+    return git_process.stdout.decode('utf-8').strip()
+
+
+def benchmark_tree(args):
+    if args.tree_dir is not None:
+        tree_dir = args.tree_dir
+        manifest = None
+        is_temporary_tree = False
+    else:
+        tree_dir = tempfile.mkdtemp(prefix='benchmark-tree-')
+        manifest = generate_tree(tree_dir, args)
+        is_temporary_tree = True
+
+    phase_name_list = args.phases if (args.phases is not None) else list(TREE_PHASES.keys())
+    jobs = args.jobs if (args.jobs > 0) else (os.cpu_count() or 1)
+
+    report = {
+        'benchmark': 'tree',
+        'commit': get_commit_id(),
+        'python': sys.version,
+        'jobs': jobs,
+        'tree': manifest,
+        'phases': {},
+    }
+
+    try:
+        mp_context = multiprocessing.get_context('spawn')
+        for phase_name in phase_name_list:
+            run_list = []
+            for _ in range(args.repeat):
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+                    run_list.append(executor.submit(run_phase, phase_name, tree_dir, jobs).result())
+
+            best_run = min(run_list, key=lambda x: x['seconds'])
+            peak_rss_list = [x['peak_rss_bytes'] for x in run_list if x['peak_rss_bytes'] is not None]
+            seconds = max(best_run['seconds'], 1e-9)
+
+            report['phases'][phase_name] = {
+                'num_files': best_run['num_files'],
+                'num_bytes': best_run['num_bytes'],
+                'seconds': best_run['seconds'],
+                'files_per_second': best_run['num_files'] / seconds,
+                'mb_per_second': (best_run['num_bytes'] / (1024 * 1024) / seconds) if (best_run['num_bytes'] > 0) else None,
+                'peak_rss_bytes': max(peak_rss_list) if (len(peak_rss_list) > 0) else None,
+            }
+
+            print(f'{phase_name}: {best_run["num_files"]} files in {best_run["seconds"]:.3f}s', file=sys.stderr)
+    finally:
+        if is_temporary_tree and (not args.keep_tree):
+            shutil.rmtree(tree_dir)
+        elif is_temporary_tree:
+            print(f'tree is kept in {tree_dir}', file=sys.stderr)
+
+    return report
+
+
+def benchmark_generate(args):
+    manifest = generate_tree(args.outdir, args)
+    manifest['outdir'] = args.outdir
+    return manifest
+
+
+def benchmark_compare(args):
+    # compare two reports of the `tree` benchmark, e.g. from two commits
+    with open(args.old_report, mode='r', encoding='utf-8') as infile:
+        old_report = json.load(infile)
+
+    with open(args.new_report, mode='r', encoding='utf-8') as infile:
+        new_report = json.load(infile)
+
+    report = {
+        'benchmark': 'compare',
+        'old_commit': old_report.get('commit', None),
+        'new_commit': new_report.get('commit', None),
+        'phases': {},
+    }
+
+    for phase_name, new_phase in new_report['phases'].items():
+        old_phase = old_report['phases'].get(phase_name, None)
+        if old_phase is None:
+            continue
+
+        report['phases'][phase_name] = {
+            'old_seconds': old_phase['seconds'],
+            'new_seconds': new_phase['seconds'],
+            # greater than 1 means the new commit is faster
+            'speedup': old_phase['seconds'] / max(new_phase['seconds'], 1e-9),
+            'old_peak_rss_bytes': old_phase['peak_rss_bytes'],
+            'new_peak_rss_bytes': new_phase['peak_rss_bytes'],
+        }
+
+    return report
+
+
+# Stand-in for clang-format so the scheduler can be measured without clang-format installed.
+# It sleeps to simulate the process startup and style loading, then removes trailing whitespace.
+STUB_FORMATTER_SOURCE = r'''
+import re
+import sys
+import time
+
+time.sleep(float(sys.argv[1]))
+inpath_list = [x for x in sys.argv[2:] if not x.startswith('-')]
+is_xml = ('--output-replacements-xml' in sys.argv)
+for inpath in inpath_list:
+    content_bs = open(inpath, mode='rb').read()
+    if not is_xml:
+        sys.stdout.buffer.write(re.sub(rb'[ \t]+(?=\r?\n)', b'', content_bs))
+        continue
+
+    sys.stdout.buffer.write(b"<?xml version='1.0'?>\n<replacements xml:space='preserve' incomplete_format='false'>\n")
+    for match in re.finditer(rb'[ \t]+(?=\r?\n)', content_bs):
+        sys.stdout.buffer.write(b"<replacement offset='%d' length='%d'></replacement>\n" % (match.start(), len(match.group(0))))
+    sys.stdout.buffer.write(b'</replacements>\n')
+'''
+
+
+def write_stub_formatter(outdir: str, startup_delay: float):
+    script_filepath = os.path.join(outdir, 'stub_formatter.py')
+    with open(script_filepath, mode='w', encoding='utf-8') as outfile:
+        outfile.write(STUB_FORMATTER_SOURCE)
+
+    if os.name == 'posix':
+        # an executable that takes the arguments of clang-format
+        stub_filepath = os.path.join(outdir, 'clang-format')
+        with open(stub_filepath, mode='w', encoding='utf-8') as outfile:
+            outfile.write(f'#!/bin/sh\nexec "{sys.executable}" "{script_filepath}" {startup_delay} "$@"\n')
+        os.chmod(stub_filepath, 0o755)
+    else:
+        stub_filepath = os.path.join(outdir, 'clang-format.bat')
+        with open(stub_filepath, mode='w', encoding='utf-8') as outfile:
+            outfile.write(f'@"{sys.executable}" "{script_filepath}" {startup_delay} %*\r\n')
+
+    return stub_filepath
+
+
+def benchmark_clang_format(args):
+    clang_format = load_script('clang-format.py')
+    rng = random.Random(args.seed)
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark-clang-format-')
+    try:
+        clang_format.CLANG_FORMAT_BINARY = write_stub_formatter(work_dir, args.startup_delay)
+
+        filepath_list = []
+        for file_idx in range(args.num_files):
+            filepath = os.path.join(work_dir, f'f{file_idx}.h')
+            content_bs = generate_text_content(rng, 'utf-8', args.filesize, crlf=False, trailing_whitespace=True)
+            with open(filepath, mode='wb') as outfile:
+                outfile.write(content_bs)
+            filepath_list.append(filepath)
+
+        report = {
+            'benchmark': 'clang-format',
+            'commit': get_commit_id(),
+            'num_files': len(filepath_list),
+            'startup_delay': args.startup_delay,
+            'results': {},
+        }
+
+        expected_result_list = None
+        for jobs in args.jobs:
+            for batch_size in args.batch:
+                start_time = time.perf_counter()
+                result_list = [x for _, x in clang_format.iterate_format_results(filepath_list, batch_size, jobs)]
+                seconds = time.perf_counter() - start_time
+
+                # every configuration has to produce the same output in the same order
+                comparable_result_list = [(x.get('error', None) is None, x.get('content_bs', None)) for x in result_list]
+                if expected_result_list is None:
+                    expected_result_list = comparable_result_list
+
+                report['results'][f'jobs={jobs} batch={batch_size}'] = {
+                    'seconds': seconds,
+                    'files_per_second': len(filepath_list) / seconds,
+                    'num_errors': len([x for x in result_list if 'error' in x]),
+                    'same_output': (comparable_result_list == expected_result_list),
+                }
+
+                print(f'jobs={jobs} batch={batch_size}: {seconds:.3f}s', file=sys.stderr)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return report
+
+
+def benchmark_visualstudio(args):
+    visualstudio = load_script('visualstudio-remove_bloated_configurations.py')
+
+    project_name_list = [f'project{project_idx}' for project_idx in range(args.num_projects)]
+    solution_bs = generate_solution_file(project_name_list)
+    # one project file per project in the solution
+    vcxproj_bs = generate_vcxproj_file(args.num_source_files)
+
+    # The cleaned files are what the cleaner sees when it is run again on the same tree.
+    corpus_list = [
+        ('solution', legacy_remove_solution_config, visualstudio.remove_visual_studio_config_from_solution_content, [solution_bs]),
+        ('vcxproj', legacy_remove_vcxproj_config, visualstudio.remove_visual_studio_config_from_vcxproj_content, [vcxproj_bs] * args.num_projects),
+        ('solution cleaned', legacy_remove_solution_config, visualstudio.remove_visual_studio_config_from_solution_content, [legacy_remove_solution_config(visualstudio, solution_bs)[1]]),
+        ('vcxproj cleaned', legacy_remove_vcxproj_config, visualstudio.remove_visual_studio_config_from_vcxproj_content, [legacy_remove_vcxproj_config(visualstudio, vcxproj_bs)[1]] * args.num_projects),
+    ]
+
+    report = {
+        'benchmark': 'visualstudio',
+        'commit': get_commit_id(),
+        'num_projects': args.num_projects,
+        'num_source_files': args.num_source_files,
+        'results': {},
+    }
+
+    for corpus_name, legacy_func, matcher_func, corpus in corpus_list:
+        total_bytes = sum([len(bs) for bs in corpus])
+        total_lines = sum([len(bs.splitlines()) for bs in corpus])
+
+        expected_result_list = None
+        for name, remove_func in [
+            ('legacy_lines', lambda bs: legacy_func(visualstudio, bs)),
+            ('matcher', matcher_func),
+        ]:
+            best_elapsed = None
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                result_list = [remove_func(bs) for bs in corpus]
+                elapsed = time.perf_counter() - start_time
+                if (best_elapsed is None) or (elapsed < best_elapsed):
+                    best_elapsed = elapsed
+
+            # both implementations have to drop the same lines
+            if expected_result_list is None:
+                expected_result_list = result_list
+
+            report['results'][f'{corpus_name} {name}'] = {
+                'total_bytes': total_bytes,
+                'total_lines': total_lines,
+                'seconds': best_elapsed,
+                'mb_per_second': total_bytes / (1024 * 1024) / best_elapsed,
+                'lines_per_second': total_lines / best_elapsed,
+                'same_output': (result_list == expected_result_list),
+            }
+
+            print(f'{corpus_name} {name}: {best_elapsed:.3f}s', file=sys.stderr)
+
+    return report
+
+
+def add_tree_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--num-files', dest='num_files', type=int, default=2000)
+    parser.add_argument('--median-filesize', dest='median_filesize', type=int, default=4 * 1024)
+    parser.add_argument('--max-filesize', dest='max_filesize', type=int, default=1024 * 1024)
+    parser.add_argument('--encodings', default='utf-8=80,utf-8-sig=5,gb2312=10,shift-jis=5', help='encoding weights of the text files')
+    parser.add_argument('--crlf-ratio', dest='crlf_ratio', type=float, default=0.2, help='ratio of text files with CRLF line endings (and trailing whitespace)')
+    parser.add_argument('--binary-ratio', dest='binary_ratio', type=float, default=0.05)
+    parser.add_argument('--max-depth', dest='max_depth', type=int, default=6)
+    parser.add_argument('--fanout', type=int, default=4, help='number of subdirectories per directory')
+    parser.add_argument('--num-notebooks', dest='num_notebooks', type=int, default=20)
+    parser.add_argument('--notebook-image-size', dest='notebook_image_size', type=int, default=64 * 1024)
+    parser.add_argument('--num-vs-projects', dest='num_vs_projects', type=int, default=200)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    encoding_parser = subparsers.add_parser('encoding', help='Encoding.decode against the legacy trial decoding cascade')
+    encoding_parser.add_argument('--num-files', dest='num_files', type=int, default=2000)
+    encoding_parser.add_argument('--filesize', type=int, default=16 * 1024)
+    encoding_parser.add_argument('--binary-ratio', dest='binary_ratio', type=float, default=0.1)
+    encoding_parser.add_argument('--repeat', type=int, default=3)
+    encoding_parser.set_defaults(func=benchmark_encoding)
+
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic tree')
+    generate_parser.add_argument('outdir')
+    add_tree_arguments(generate_parser)
+    generate_parser.set_defaults(func=benchmark_generate)
+
+    tree_parser = subparsers.add_parser('tree', help='time each phase of lf-utf8.py, ipynb.py and the Visual Studio cleaner on a synthetic tree')
+    tree_parser.add_argument('--tree-dir', dest='tree_dir', help='use an existing tree instead of generating one')
+    tree_parser.add_argument('--keep-tree', dest='keep_tree', action='store_true')
+    tree_parser.add_argument('--phases', nargs='+', choices=list(TREE_PHASES.keys()))
+    tree_parser.add_argument('-j', '--jobs', type=int, default=0, help='worker processes for the parallel phases (0 to use all CPUs)')
+    tree_parser.add_argument('--repeat', type=int, default=1)
+    add_tree_arguments(tree_parser)
+    tree_parser.set_defaults(func=benchmark_tree)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two reports of the tree benchmark')
+    compare_parser.add_argument('old_report')
+    compare_parser.add_argument('new_report')
+    compare_parser.set_defaults(func=benchmark_compare)
+
+    clang_format_parser = subparsers.add_parser('clang-format', help='clang-format.py scheduler (jobs and batch size) with a stub formatter')
+    clang_format_parser.add_argument('--num-files', dest='num_files', type=int, default=200)
+    clang_format_parser.add_argument('--filesize', type=int, default=2 * 1024)
+    clang_format_parser.add_argument('--startup-delay', dest='startup_delay', type=float, default=0.02, help='seconds the stub formatter sleeps before formatting')
+    clang_format_parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, 8])
+    clang_format_parser.add_argument('--batch', type=int, nargs='+', default=[1, 16])
+    clang_format_parser.set_defaults(func=benchmark_clang_format)
+
+    visualstudio_parser = subparsers.add_parser('visualstudio', help='Visual Studio cleaner matcher against the legacy line by line check')
+    visualstudio_parser.add_argument('--num-projects', dest='num_projects', type=int, default=5000)
+    visualstudio_parser.add_argument('--num-source-files', dest='num_source_files', type=int, default=50, help='source files in each project file')
+    visualstudio_parser.add_argument('--repeat', type=int, default=3)
+    visualstudio_parser.set_defaults(func=benchmark_visualstudio)
+
+    args = parser.parse_args()
+
+    report = args.func(args)
+    report_str = json.dumps(report, indent='\t', ensure_ascii=False)
+    print(report_str)
+
+    if args.output is not None:
+        with open(args.output, mode='w', encoding='utf-8') as outfile:
+            outfile.write(report_str + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 # encoding=utf-8
 import os
+import re
+import sys
+import json
+import time
+import codecs
+import signal
 import subprocess
-import threading
 import argparse
 import stat
+import errno
+import select
+import struct
+import hashlib
+import ctypes
+import ctypes.util
 import typing
 import traceback
+import threading
+import collections
+import concurrent.futures
 
 RESET = '\033[0m'
 RED = '\033[91m'
@@ -17,52 +31,289 @@ class Encoding:
     UTF8 = 'utf-8'
     UTF8_WITH_BOM = 'utf-8-sig'
     UTF16 = 'utf-16'
+    UTF16_LE = 'utf-16-le'
+    UTF16_BE = 'utf-16-be'
     GB2312 = 'gb2312'
     SHIFT_JIS = 'shift-jis'
 
+    # only the beginning of the content is scanned to rank the encodings
+    SAMPLE_SIZE = 64 * 1024
+
+    @classmethod
+    def detect(cls, bs: bytes):
+        # Return `[(encoding, confidence), ...]` with the most likely encoding first.
+        # The sample is validated once per candidate and each validation stops at the first invalid byte.
+        # An empty list means that the content is binary.
+        candidate_list, _ = cls.scan(bs)
+        return candidate_list
+
+    @classmethod
+    def scan(cls, bs: bytes):
+        # Return `(candidate_list, decoded_content)`.
+        # `decoded_content` is not None if the whole content fits in the sample and is already decoded.
+        sample = bs[:cls.SAMPLE_SIZE]
+        is_truncated = (len(bs) > len(sample))
+
+        if sample.startswith(b'\xef\xbb\xbf'):
+            return [(cls.UTF8_WITH_BOM, 1.0)], None
+
+        if sample.startswith((b'\xff\xfe', b'\xfe\xff')):
+            return [(cls.UTF16, 1.0)], None
+
+        num_nul = sample.count(0)
+        if num_nul > 0:
+            # UTF-16 text without BOM has a NUL byte next to every ASCII character
+            num_even_nul = sample[0::2].count(0)
+            num_odd_nul = num_nul - num_even_nul
+            num_pairs = len(sample) // 2
+
+            if (len(bs) % 2 == 0) and (num_nul * 4 >= num_pairs):
+                if num_odd_nul > num_even_nul * 4:
+                    return [(cls.UTF16_LE, 0.9)], None
+
+                if num_even_nul > num_odd_nul * 4:
+                    return [(cls.UTF16_BE, 0.9)], None
+
+            return [], None
+
+        if sample.isascii():
+            if not is_truncated:
+                return [(cls.UTF8, 1.0)], None
+
+            # ASCII is valid in every candidate, the rest of the content decides
+            return [(cls.UTF8, 0.9), (cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)], None
+
+        candidate_list = []
+        for encoding, confidence in (
+            (cls.UTF8, 0.99),
+            (cls.GB2312, 0.6),
+            (cls.SHIFT_JIS, 0.5),
+        ):
+            # the incremental decoder validates in a single pass and stops at the first invalid byte,
+            # a multi-byte character cut at the end of a truncated sample is not an error
+            try:
+                decoded_sample = codecs.getincrementaldecoder(encoding)().decode(sample, final=(not is_truncated))
+            except UnicodeDecodeError:
+                continue
+
+            if not is_truncated:
+                # the sample is the whole content
+                return [(encoding, confidence)], decoded_sample
+
+            candidate_list.append((encoding, confidence))
+
+            if encoding == cls.UTF8:
+                # Valid multi-byte UTF-8 sequences are very unlikely in other encodings,
+                # so they are not checked against the sample. They are still tried if the rest of the content is not UTF-8.
+                candidate_list.extend([(cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)])
+                break
+
+        return candidate_list, None
+
     @classmethod
     def decode(cls, bs: bytes):
-        try:
-            encoding = cls.UTF8_WITH_BOM
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+        # The content is decoded once with the most likely encoding.
+        # The next candidate is only tried if the content after the sample is invalid.
+        candidate_list, decoded_content = cls.scan(bs)
+        if decoded_content is not None:
+            return candidate_list[0][0], decoded_content
+
+        for encoding, _ in candidate_list:
+            try:
+                decoded_content = str(bs, encoding)
+                return encoding, decoded_content
+            except UnicodeDecodeError:
+                continue
 
-        try:
-            encoding = cls.UTF8
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+        return None, bs
 
-        try:
-            encoding = cls.UTF16
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
 
-        try:
-            encoding = cls.GB2312
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+class NullSpan:
+    # returned by a disabled `Tracer`, the instrumented code does not need to check if tracing is enabled
+    num_bytes = 0
 
-        try:
-            encoding = cls.SHIFT_JIS
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+    def __enter__(self):
+        return self
 
-        return None, bs
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class TraceSpan:
+    __slots__ = ('span_list', 'phase', 'filepath', 'num_bytes', 'start_ns')
+
+    def __init__(self, span_list: list, phase: str, filepath: str):
+        self.span_list = span_list
+        self.phase = phase
+        self.filepath = filepath
+        # bytes read or written in this phase
+        self.num_bytes = 0
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        self.span_list.append((self.phase, self.filepath, self.start_ns, duration_ns, self.num_bytes, threading.get_ident()))
+        return False
+
+
+class Tracer:
+    # Per-phase timing for `--stats` and `--trace`.
+    # A span is recorded as `(phase, filepath, start_ns, duration_ns, num_bytes, thread_id)`,
+    # the worker threads append to the same list (`list.append` is atomic).
+
+    def __init__(self):
+        self.enabled = False
+        self.span_list = []
+
+    def span(self, phase: str, filepath: str = None):
+        if not self.enabled:
+            return NULL_SPAN
+
+        return TraceSpan(self.span_list, phase, filepath)
+
+    def print_stats(self, file=sys.stderr):
+        duration_dict = collections.defaultdict(list)
+        bytes_dict = collections.defaultdict(int)
+        for phase, _, _, duration_ns, num_bytes, _ in self.span_list:
+            duration_dict[phase].append(duration_ns)
+            bytes_dict[phase] += num_bytes
+
+        print(f'{"phase":<20} {"count":>8} {"total ms":>12} {"p50 ms":>10} {"p95 ms":>10} {"max ms":>10} {"bytes":>14}', file=file)
+        for phase, duration_list in duration_dict.items():
+            duration_list.sort()
+            count = len(duration_list)
+            p50 = duration_list[(count - 1) // 2]
+            p95 = duration_list[min(count - 1, (count * 95) // 100)]
+            print(
+                f'{phase:<20} {count:>8} {sum(duration_list) / 1e6:>12.3f} {p50 / 1e6:>10.3f}'
+                f' {p95 / 1e6:>10.3f} {duration_list[-1] / 1e6:>10.3f} {bytes_dict[phase]:>14}',
+                file=file,
+            )
+
+    def write_trace(self, outpath: str):
+        # Chrome trace-event format, open with chrome://tracing or https://ui.perfetto.dev
+        origin_ns = min([x[2] for x in self.span_list], default=0)
+
+        event_list = []
+        pid = os.getpid()
+        for phase, filepath, start_ns, duration_ns, num_bytes, thread_id in self.span_list:
+            event_args = {}
+            if filepath is not None:
+                event_args['file'] = filepath
+            if num_bytes > 0:
+                event_args['bytes'] = num_bytes
+
+            event_list.append({
+                'name': phase,
+                'ph': 'X',
+                'ts': (start_ns - origin_ns) / 1000,
+                'dur': duration_ns / 1000,
+                'pid': pid,
+                'tid': thread_id,
+                'args': event_args,
+            })
+
+        # non-UTF-8 file names are escaped
+        with open(outpath, mode='w', encoding='utf-8') as outfile:
+            json.dump({'traceEvents': event_list, 'displayTimeUnit': 'ms'}, outfile)
+
+
+TRACER = Tracer()
+
+
+class ProgressReporter:
+    # Status lines are buffered and written in batches, in the order of the results.
+    # On a TTY a progress line (files/s, bytes/s, ETA) is redrawn at most every `REDRAW_INTERVAL` seconds.
+    # Only changed or failed files are printed (every file with `verbose`), followed by a summary.
+
+    REDRAW_INTERVAL = 0.1  # seconds
+    MAX_PENDING_LINES = 256
+
+    # statuses that are always printed
+    REPORTED_STATUSES = ('changed', 'fixed', 'error')
+
+    def __init__(self, total_files: int, verbose: bool = False):
+        self.file = sys.stdout
+        self.is_tty = self.file.isatty()
+        self.verbose = verbose
+        self.total_files = total_files
+
+        self.num_files = 0
+        self.num_bytes = 0
+        self.status_counter = collections.Counter()
+        self.pending_lines = []
+        self.has_progress_line = False
+        self.start_time = time.monotonic()
+        self.last_flush_time = self.start_time
+
+    def update(self, filepath: str, status: str, message: str = '', num_bytes: int = 0):
+        # `status` is one of 'ok', 'changed', 'fixed' or 'error'
+        self.num_files += 1
+        self.num_bytes += num_bytes
+        self.status_counter[status] += 1
+
+        if (status in self.REPORTED_STATUSES) or self.verbose:
+            self.pending_lines.append(f'> {filepath} {message}')
+
+        now = time.monotonic()
+        if (len(self.pending_lines) >= self.MAX_PENDING_LINES) or ((now - self.last_flush_time) >= self.REDRAW_INTERVAL):
+            self.flush(now)
+
+    def format_progress(self, now: float):
+        elapsed = max(now - self.start_time, 1e-9)
+        files_per_second = self.num_files / elapsed
+        mb_per_second = self.num_bytes / (1024 * 1024) / elapsed
+
+        if files_per_second > 0:
+            eta = f'{(self.total_files - self.num_files) / files_per_second:.0f}s'
+        else:
+            eta = '?'
+
+        return f'{self.num_files}/{self.total_files} files {files_per_second:.0f} files/s {mb_per_second:.1f} MB/s ETA {eta}'
+
+    def flush(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+
+        parts = []
+        if self.has_progress_line:
+            # erase the progress line before the status lines are written over it
+            parts.append('\r\033[K')
+            self.has_progress_line = False
+
+        for line in self.pending_lines:
+            parts.append(line)
+            parts.append('\n')
+        self.pending_lines = []
+
+        if self.is_tty:
+            parts.append(self.format_progress(now))
+            self.has_progress_line = True
+
+        if len(parts) > 0:
+            self.file.write(''.join(parts))
+            self.file.flush()
+
+        self.last_flush_time = now
+
+    def close(self):
+        now = time.monotonic()
+        self.is_tty = False
+        self.flush(now)
+
+        count_str = ', '.join([f'{count} {status}' for status, count in self.status_counter.items()])
+        if len(count_str) > 0:
+            count_str = f' ({count_str})'
+
+        self.file.write(f'{self.num_files} files{count_str} in {now - self.start_time:.2f}s\n')
+        self.file.flush()
 
 
 SUPPORTED_EXTENSIONS = [
@@ -85,12 +336,69 @@ def convert_string(bytes_input: bytes):
         return s
 
 
+# The formatter runs in its own session (process group) so that a timeout also kills the processes it started.
+if os.name == 'posix':
+    POPEN_NEW_SESSION_KWARGS = {'start_new_session': True}
+else:
+    POPEN_NEW_SESSION_KWARGS = {}
+
+
+def kill_process_group(process: subprocess.Popen):
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        process.kill()
+
+
+class RunningProcessSet:
+    # The formatters run in their own sessions so Ctrl+C in the terminal does not reach them.
+    # With several worker threads only the main thread is interrupted,
+    # so the running processes are tracked to kill them from there.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process_set = set()
+        self.is_cancelled = False
+
+    def add(self, process: subprocess.Popen):
+        with self.lock:
+            self.process_set.add(process)
+            if not self.is_cancelled:
+                return
+
+        # started after `cancel`
+        kill_process_group(process)
+
+    def discard(self, process: subprocess.Popen):
+        with self.lock:
+            self.process_set.discard(process)
+
+    def cancel(self):
+        # kill the running processes and every process that is started afterwards until `reset`
+        with self.lock:
+            self.is_cancelled = True
+            process_list = list(self.process_set)
+
+        for process in process_list:
+            kill_process_group(process)
+
+    def reset(self):
+        with self.lock:
+            self.is_cancelled = False
+
+
+RUNNING_PROCESS_SET = RunningProcessSet()
+
+
 class Command:
     def __init__(self, cmd: typing.List[str]):
         self.cmd = cmd
 
         # type is hinted implicitly (subprocess.Popen)
-        self.p = None
+        self.process = None
 
         # The process is terminated by us because it took too long.
         # If this flag is True then the output is broken.
@@ -98,26 +406,30 @@ class Command:
         self.stdout = None
         self.stderr = None
 
-    def target(self):
+    def run(self, timeout=5, raise_on_error=True):
         # print('>', ' '.join(self.cmd))
         self.process = subprocess.Popen(
             self.cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            **POPEN_NEW_SESSION_KWARGS,
         )
+        RUNNING_PROCESS_SET.add(self.process)
 
-        self.stdout, self.stderr = self.process.communicate()
-
-    def run(self, timeout=5, raise_on_error=True):
-        thread = threading.Thread(target=self.target)
-        thread.start()
-        thread.join(timeout)
-
-        if thread.is_alive():
+        try:
+            self.stdout, self.stderr = self.process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
             self.terminated = True
-            self.process.terminate()
-            # TODO Will call block our main thread for a long time?
-            thread.join()
+            kill_process_group(self.process)
+            # reap the process, the pipes are closed by the kill
+            self.stdout, self.stderr = self.process.communicate()
+        except BaseException:
+            # e.g. KeyboardInterrupt, do not leave the formatter running
+            kill_process_group(self.process)
+            self.process.wait()
+            raise
+        finally:
+            RUNNING_PROCESS_SET.discard(self.process)
 
         if raise_on_error:
             if self.terminated:
@@ -149,37 +461,74 @@ IGNORED_DIRS = [
 ]
 
 
+def iter_clang_supported_files(inpath: str) -> typing.Iterator[str]:
+    # IGNORED_DIRS are pruned before descending, build trees and `node_modules` are full of headers
+    if os.path.basename(inpath).lower() in IGNORED_DIRS:
+        return
+
+    if not os.path.isdir(inpath):
+        if os.path.isfile(inpath) and (os.path.splitext(inpath)[1].lower() in SUPPORTED_EXTENSIONS):
+            yield inpath
+        return
+
+    dirpath_stack = [inpath]
+    while len(dirpath_stack) > 0:
+        with os.scandir(dirpath_stack.pop()) as entry_iter:
+            for entry in entry_iter:
+                if entry.name.lower() in IGNORED_DIRS:
+                    continue
+
+                if entry.is_dir():
+                    dirpath_stack.append(entry.path)
+                elif entry.is_file() and (os.path.splitext(entry.name)[1].lower() in SUPPORTED_EXTENSIONS):
+                    yield entry.path
+
+
 def find_clang_supported_files(inpath: str) -> typing.List[str]:
-    basename = os.path.basename(inpath)
-    if basename.lower() in IGNORED_DIRS:
-        return []
+    return list(iter_clang_supported_files(inpath))
 
-    regular_filepath_list = []
 
-    file_stat = os.stat(inpath)
+def get_git_list_files_args(since: str = None, staged: bool = False):
+    if (since is None) and (not staged):
+        return ['git', '-c', 'core.quotepath=off', 'ls-files']
 
-    if stat.S_ISDIR(file_stat.st_mode):
-        child_filename_list = os.listdir(inpath)
-        for child_filename in child_filename_list:
-            child_filepath = os.path.join(inpath, child_filename)
-            regular_filepath_list.extend(find_clang_supported_files(child_filepath))
-    elif stat.S_ISREG(file_stat.st_mode):
-        ext = os.path.splitext(inpath)[1].lower()
-        if ext in SUPPORTED_EXTENSIONS:
-            regular_filepath_list.append(inpath)
+    # Only the files that are added, copied, modified or renamed relative to `since` (or HEAD with `staged`).
+    # A renamed file is listed with its new path. Rename detection is skipped because the new path of
+    # an undetected rename is still listed as added.
+    args = [
+        'git',
+        '-c', 'core.quotepath=off',
+        'diff',
+        '--name-only',
+        '--relative',
+        '--no-renames',
+        '--diff-filter=ACMR',
+    ]
 
-    return regular_filepath_list
+    if staged:
+        args.append('--cached')
 
+    if since is not None:
+        if since.startswith('-'):
+            # `since` is placed before `--` so git would read it as an option
+            raise Exception(f'Invalid git revision: {since!r}')
 
-def find_clang_supported_files_from_git(inpath: str):
+        args.append(since)
+
+    args.append('--')
+    return args
+
+
+def find_clang_supported_files_from_git(inpath: str, since: str = None, staged: bool = False):
     git_process = subprocess.run(
-        args=['git', 'ls-files'],
+        args=get_git_list_files_args(since, staged),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         cwd=inpath,
     )
 
-    if len(git_process.stderr) > 0:
+    # git prints warnings (e.g. about line endings under `text=auto`) on stderr, only the returncode tells a failure
+    if git_process.returncode != 0:
         _, error_msg = Encoding.decode(git_process.stderr)
 
         if type(error_msg) is bytes:
@@ -219,6 +568,409 @@ def find_clang_supported_files_from_git(inpath: str):
     return filepath_list
 
 
+# `@@ -12,3 +14,5 @@`, the count is 1 if it is omitted
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+
+def parse_changed_line_ranges(diff_output: str):
+    # Return `{relative_path: [(first_line, last_line), ...]}` from `git diff -U0`.
+    # The line numbers are 1-based and inclusive, in the new version of the file.
+    line_ranges_dict = {}
+    line_range_list = None
+
+    for line in diff_output.split('\n'):
+        if line.startswith('+++ '):
+            if line.startswith('+++ b/'):
+                line_range_list = line_ranges_dict.setdefault(line[len('+++ b/'):], [])
+            else:
+                # `+++ /dev/null`, the file is deleted
+                line_range_list = None
+            continue
+
+        if line_range_list is None:
+            continue
+
+        match = HUNK_HEADER_PATTERN.match(line)
+        if match is None:
+            continue
+
+        first_line = int(match.group(1))
+        num_lines = 1 if (match.group(2) is None) else int(match.group(2))
+        if num_lines == 0:
+            # only deleted lines, the line before the deletion joins its new neighbour
+            line_range_list.append((max(first_line, 1), max(first_line, 1)))
+        else:
+            line_range_list.append((first_line, first_line + num_lines - 1))
+
+    return line_ranges_dict
+
+
+def get_unstaged_filepath_set(inpath: str):
+    # Return the paths (joined with `inpath`) of the files whose working tree content differs from the index.
+    git_process = subprocess.run(
+        args=[
+            'git',
+            'diff',
+            '--name-only',
+            '-z',
+            '--no-ext-diff',
+            '--relative',
+            '--',
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=inpath,
+    )
+
+    if git_process.returncode != 0:
+        _, error_msg = Encoding.decode(git_process.stderr)
+
+        if type(error_msg) is bytes:
+            error_msg = str(error_msg)
+
+        raise Exception(error_msg)
+
+    relpath_list = git_process.stdout.decode('utf-8', errors='surrogateescape').split('\0')
+    return set(os.path.join(inpath, relpath) for relpath in relpath_list if len(relpath) > 0)
+
+
+def get_changed_line_ranges(inpath: str, since: str = None, staged: bool = False):
+    # Return `{filepath: [(first_line, last_line), ...]}` for the supported files changed
+    # since `since` (or staged with `staged`, or not staged by default).
+    args = [
+        'git',
+        '-c', 'core.quotepath=off',
+        'diff',
+        '-U0',
+        '--no-color',
+        '--no-ext-diff',
+        '--relative',
+        '--no-renames',
+        '--diff-filter=ACMR',
+        '--src-prefix=a/',
+        '--dst-prefix=b/',
+    ]
+
+    if staged:
+        args.append('--cached')
+
+    if since is not None:
+        if since.startswith('-'):
+            # `since` is placed before `--` so git would read it as an option
+            raise Exception(f'Invalid git revision: {since!r}')
+
+        args.append(since)
+
+    args.append('--')
+
+    git_process = subprocess.run(
+        args=args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=inpath,
+    )
+
+    if git_process.returncode != 0:
+        _, error_msg = Encoding.decode(git_process.stderr)
+
+        if type(error_msg) is bytes:
+            error_msg = str(error_msg)
+
+        raise Exception(error_msg)
+
+    # the content of the hunks may be in any encoding, only the headers matter
+    diff_output = git_process.stdout.decode('utf-8', errors='surrogateescape')
+
+    line_ranges_dict = {}
+    for relpath, line_range_list in parse_changed_line_ranges(diff_output).items():
+        if len(line_range_list) == 0:
+            continue
+
+        ext = os.path.splitext(relpath)[1].lower()
+        if ext not in SUPPORTED_EXTENSIONS:
+            continue
+
+        filepath = os.path.join(inpath, relpath)
+        if os.path.isfile(filepath):
+            line_ranges_dict[filepath] = line_range_list
+
+    if staged and (len(line_ranges_dict) > 0):
+        # the line numbers come from the index but clang-format formats the working tree files
+        unstaged_filepath_list = sorted(get_unstaged_filepath_set(inpath).intersection(line_ranges_dict.keys()))
+        if len(unstaged_filepath_list) > 0:
+            raise Exception(
+                '--changed-lines --staged requires the files to have no unstaged changes (stage them or run `git stash --keep-index`): '
+                + ', '.join(unstaged_filepath_list)
+            )
+
+    return line_ranges_dict
+
+
+class Inotify:
+    # Minimal inotify binding through ctypes (Linux only).
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x00080000
+
+    # a file is formatted once it is closed after writing or moved into place (atomic save)
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    # struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+    EVENT_HEADER = struct.Struct('iIII')
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            error_code = ctypes.get_errno()
+            raise OSError(error_code, os.strerror(error_code))
+
+        # watch descriptor -> directory path
+        self.wd_dict = {}
+
+    def add_watch(self, dirpath: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.WATCH_MASK)
+        if wd < 0:
+            error_code = ctypes.get_errno()
+            if error_code in (errno.ENOENT, errno.ENOTDIR):
+                # removed before the watch was added
+                return None
+
+            # ENOSPC means that fs.inotify.max_user_watches is too low for this tree
+            raise OSError(error_code, f'{os.strerror(error_code)}: {dirpath}')
+
+        self.wd_dict[wd] = dirpath
+        return wd
+
+    def remove_watch(self, wd: int):
+        # the kernel sends IN_IGNORED afterwards
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float = None):
+        # return `[(wd, dirpath, name, mask), ...]`, `dirpath` is None for IN_Q_OVERFLOW
+        readable_list, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable_list) == 0:
+            return []
+
+        buf = os.read(self.fd, self.READ_SIZE)
+
+        event_list = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(buf, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+
+            if mask & self.IN_IGNORED:
+                self.wd_dict.pop(wd, None)
+                continue
+
+            dirpath = self.wd_dict.get(wd, None)
+            if (dirpath is None) and (not (mask & self.IN_Q_OVERFLOW)):
+                continue
+
+            event_list.append((wd, dirpath, name, mask))
+
+        return event_list
+
+    def close(self):
+        os.close(self.fd)
+
+
+def list_watch_dirs(inpath: str):
+    # directories under `inpath` (included) with the same pruning as `iter_clang_supported_files`
+    dirpath_list = []
+    dirpath_stack = [inpath]
+    while len(dirpath_stack) > 0:
+        dirpath = dirpath_stack.pop()
+        dirpath_list.append(dirpath)
+
+        try:
+            with os.scandir(dirpath) as entry_iter:
+                for entry in entry_iter:
+                    if entry.name.lower() in IGNORED_DIRS:
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        dirpath_stack.append(entry.path)
+        except OSError:
+            continue
+
+    return dirpath_list
+
+
+def filter_git_ignored(inpath: str, path_list: typing.List[str]):
+    # Drop the paths that are excluded by .gitignore. Tracked files are never reported as ignored.
+    if len(path_list) == 0:
+        return path_list
+
+    git_process = subprocess.run(
+        args=['git', 'check-ignore', '--stdin', '-z'],
+        input=b''.join([os.fsencode(path) + b'\0' for path in path_list]),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=inpath,
+    )
+
+    # 1 means that none of the paths is ignored
+    if git_process.returncode not in (0, 1):
+        return path_list
+
+    ignored_path_set = set([os.fsdecode(path) for path in git_process.stdout.split(b'\0') if len(path) > 0])
+    return [path for path in path_list if path not in ignored_path_set]
+
+
+WATCH_DEBOUNCE_SECONDS = 0.2
+# a continuous stream of events is still processed at this interval
+WATCH_MAX_DELAY_SECONDS = 2.0
+
+
+def watch_files(
+    inpath: str,
+    is_watched_file: typing.Callable[[str], bool],
+    process_batch: typing.Callable[[typing.List[str]], None],
+    use_git: bool = False,
+):
+    # Run `process_batch` on the files under `inpath` whenever they are written, until Ctrl+C.
+    # Bursts of events (e.g. `git checkout`) are debounced and processed as one batch.
+    if not sys.platform.startswith('linux'):
+        raise Exception('--watch requires Linux (inotify)')
+
+    inpath = os.path.abspath(inpath)
+    inotify = Inotify()
+
+    def add_watch_tree(dirpath: str, is_moved: bool = False):
+        # return the files that already exist in the new directories
+        dirpath_list = list_watch_dirs(dirpath)
+        if use_git:
+            dirpath_list = filter_git_ignored(inpath, dirpath_list)
+
+        filepath_list = []
+        for child_dirpath in dirpath_list:
+            wd = inotify.add_watch(child_dirpath)
+            if wd is None:
+                continue
+
+            if is_moved and (child_dirpath == dirpath):
+                moved_wd_set.add(wd)
+
+            with os.scandir(child_dirpath) as entry_iter:
+                for entry in entry_iter:
+                    if (entry.name.lower() not in IGNORED_DIRS) and entry.is_file() and is_watched_file(entry.path):
+                        filepath_list.append(entry.path)
+
+        return filepath_list
+
+    # filepath -> stat after the last batch, the events of our own writes are skipped
+    processed_stat_dict = {}
+    pending_filepath_set = set()
+    # A directory that is renamed inside the tree keeps its watch descriptor, IN_MOVED_TO of the new parent
+    # registers the new path and the IN_MOVE_SELF that follows must not remove the watch.
+    moved_wd_set = set()
+    first_event_time = None
+    last_event_time = None
+
+    add_watch_tree(inpath)
+    print(f'watching {len(inotify.wd_dict)} directories in {inpath}', flush=True)
+
+    try:
+        while True:
+            timeout = None
+            if len(pending_filepath_set) > 0:
+                deadline = min(last_event_time + WATCH_DEBOUNCE_SECONDS, first_event_time + WATCH_MAX_DELAY_SECONDS)
+                timeout = max(0, deadline - time.monotonic())
+
+            event_list = inotify.read_events(timeout)
+            now = time.monotonic()
+
+            if len(event_list) == 0:
+                # IN_MOVE_SELF is queued together with IN_MOVED_TO, the queue is empty so it has been read
+                moved_wd_set.clear()
+
+            for wd, dirpath, name, mask in event_list:
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    # events were dropped, every file may have changed
+                    pending_filepath_set.update([x for x in iter_clang_supported_files(inpath) if is_watched_file(x)])
+                    continue
+
+                if mask & Inotify.IN_MOVE_SELF:
+                    # moved out of the tree unless IN_MOVED_TO of the new parent registered it again
+                    if wd in moved_wd_set:
+                        moved_wd_set.discard(wd)
+                    else:
+                        inotify.remove_watch(wd)
+                    continue
+
+                if (len(name) == 0) or (name.lower() in IGNORED_DIRS):
+                    continue
+
+                path = os.path.join(dirpath, name)
+                if mask & Inotify.IN_ISDIR:
+                    if mask & Inotify.IN_CREATE:
+                        pending_filepath_set.update(add_watch_tree(path))
+                    elif mask & Inotify.IN_MOVED_TO:
+                        pending_filepath_set.update(add_watch_tree(path, is_moved=True))
+                elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    if is_watched_file(path):
+                        pending_filepath_set.add(path)
+
+            if len(pending_filepath_set) == 0:
+                first_event_time = None
+                continue
+
+            if len(event_list) > 0:
+                last_event_time = now
+                if first_event_time is None:
+                    first_event_time = now
+
+            if ((now - last_event_time) < WATCH_DEBOUNCE_SECONDS) and ((now - first_event_time) < WATCH_MAX_DELAY_SECONDS):
+                continue
+
+            batch = []
+            for filepath in sorted(pending_filepath_set):
+                try:
+                    file_stat = os.stat(filepath)
+                except OSError:
+                    continue
+
+                stat_key = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+                if stat.S_ISREG(file_stat.st_mode) and (processed_stat_dict.get(filepath, None) != stat_key):
+                    batch.append(filepath)
+
+            pending_filepath_set.clear()
+            first_event_time = None
+
+            if use_git:
+                batch = filter_git_ignored(inpath, batch)
+
+            if len(batch) == 0:
+                continue
+
+            process_batch(batch)
+
+            for filepath in batch:
+                try:
+                    file_stat = os.stat(filepath)
+                except OSError:
+                    continue
+
+                processed_stat_dict[filepath] = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
+
+
 def format_text_file_content(content: str):
     # enforce LF line ending
     content = content.replace('\r', '')
@@ -244,16 +996,28 @@ def format_text_file_content(content: str):
     return content
 
 
-def format_with_clang_format(inpath: str):
-    content_bs = open(inpath, mode='rb').read()
+# seconds per file
+CLANG_FORMAT_TIMEOUT = 5
+
+# changed with `--clang-format`
+CLANG_FORMAT_BINARY = 'clang-format'
+
+# clang-format looks up `.clang-format` in the directory of each file and its parents
+DEFAULT_STYLE_ARGUMENT = '-style=file'
+
+
+def format_with_clang_format(inpath: str, style_argument: str = DEFAULT_STYLE_ARGUMENT):
+    with TRACER.span('read', inpath) as span:
+        content_bs = open(inpath, mode='rb').read()
+        span.num_bytes = len(content_bs)
 
-    # TODO check for .clang-format file in the same directory
     # TODO add 'check' or 'format' flags
-    cmd = ['clang-format', '-style=file', inpath]
+    cmd = [CLANG_FORMAT_BINARY, style_argument, inpath]
     sp = Command(cmd)
 
     try:
-        sp.run()
+        with TRACER.span('clang-format', inpath):
+            sp.run(timeout=CLANG_FORMAT_TIMEOUT)
     except Exception as ex:
         stacktrace = traceback.format_exc()
 
@@ -261,21 +1025,511 @@ def format_with_clang_format(inpath: str):
             'error': f'failed to run clang-format\n{ex}\n{stacktrace}',
         }
 
-    clang_formatted_content = convert_string(sp.stdout)
-    clang_formatted_content = format_text_file_content(clang_formatted_content)
-    encoded_content = clang_formatted_content.encode('utf-8')
+    return get_format_result(inpath, content_bs, sp.stdout)
+
+
+def get_format_result(inpath: str, content_bs: bytes, clang_formatted_bs: bytes):
+    with TRACER.span('decode', inpath):
+        clang_formatted_content = convert_string(clang_formatted_bs)
+
+    with TRACER.span('normalize', inpath):
+        clang_formatted_content = format_text_file_content(clang_formatted_content)
+        encoded_content = clang_formatted_content.encode('utf-8')
 
     if content_bs == encoded_content:
         return {
             'diff': False,
+            'filesize': len(content_bs),
         }
     else:
         return {
             'diff': True,
             'content_bs': encoded_content,
+            'filesize': len(content_bs),
+        }
+
+
+# `<replacement offset='12' length='3'>text</replacement>`, the offset and length are in bytes
+REPLACEMENT_PATTERN = re.compile(rb"<replacement offset='(\d+)' length='(\d+)'(?:/>|>(.*?)</replacement>)", re.DOTALL)
+XML_ENTITY_PATTERN = re.compile(rb'&(#\d+|#x[0-9a-fA-F]+|lt|gt|amp|quot|apos);')
+XML_ENTITY_DICT = {
+    b'lt': b'<',
+    b'gt': b'>',
+    b'amp': b'&',
+    b'quot': b'"',
+    b'apos': b"'",
+}
+
+
+def unescape_xml_entity(match: re.Match):
+    entity = match.group(1)
+    if entity.startswith(b'#x'):
+        return chr(int(entity[2:], 16)).encode('utf-8')
+
+    if entity.startswith(b'#'):
+        return chr(int(entity[1:])).encode('utf-8')
+
+    return XML_ENTITY_DICT[entity]
+
+
+def parse_replacements_xml(xml_bs: bytes):
+    # With several files `clang-format --output-replacements-xml` writes one XML document per file, in order.
+    # Return `[[(offset, length, replacement_bs), ...], ...]`.
+    replacements_list = []
+    for document_bs in xml_bs.split(b'<?xml')[1:]:
+        replacement_list = []
+        for match in REPLACEMENT_PATTERN.finditer(document_bs):
+            replacement_bs = XML_ENTITY_PATTERN.sub(unescape_xml_entity, match.group(3) or b'')
+            replacement_list.append((int(match.group(1)), int(match.group(2)), replacement_bs))
+
+        replacements_list.append(replacement_list)
+
+    return replacements_list
+
+
+def apply_replacements(content_bs: bytes, replacement_list: typing.List[typing.Tuple[int, int, bytes]]):
+    part_list = []
+    last_offset = 0
+    for offset, length, replacement_bs in sorted(replacement_list, key=lambda x: x[0]):
+        if offset < last_offset:
+            raise Exception(f'overlapping replacement at offset {offset}')
+
+        part_list.append(content_bs[last_offset:offset])
+        part_list.append(replacement_bs)
+        last_offset = offset + length
+
+    part_list.append(content_bs[last_offset:])
+    return b''.join(part_list)
+
+
+def format_batch_with_clang_format(inpath_list: typing.List[str], style_argument: str = DEFAULT_STYLE_ARGUMENT):
+    # One clang-format process for the whole batch, the replacements are split back per file.
+    # If any file fails or the process times out, every file of the batch is formatted on its own.
+    if len(inpath_list) == 1:
+        return [format_with_clang_format(inpath_list[0], style_argument)]
+
+    content_bs_list = []
+    for inpath in inpath_list:
+        with TRACER.span('read', inpath) as span:
+            content_bs_list.append(open(inpath, mode='rb').read())
+            span.num_bytes = len(content_bs_list[-1])
+
+    cmd = [CLANG_FORMAT_BINARY, style_argument, '--output-replacements-xml', *inpath_list]
+    sp = Command(cmd)
+
+    try:
+        with TRACER.span('clang-format-batch'):
+            sp.run(timeout=CLANG_FORMAT_TIMEOUT * len(inpath_list))
+
+        replacements_list = parse_replacements_xml(sp.stdout)
+        if len(replacements_list) != len(inpath_list):
+            raise Exception(f'expected {len(inpath_list)} replacement lists, got {len(replacements_list)}')
+
+        clang_formatted_bs_list = [
+            apply_replacements(content_bs, replacement_list)
+            for content_bs, replacement_list in zip(content_bs_list, replacements_list)
+        ]
+    except Exception:
+        return [format_with_clang_format(inpath, style_argument) for inpath in inpath_list]
+
+    return [
+        get_format_result(inpath, content_bs, clang_formatted_bs)
+        for inpath, content_bs, clang_formatted_bs in zip(inpath_list, content_bs_list, clang_formatted_bs_list)
+    ]
+
+
+# same lookup order as `-style=file`
+CLANG_FORMAT_STYLE_FILENAMES = ['.clang-format', '_clang-format']
+
+# `-style=file:<path>` is supported since clang-format 14
+MIN_STYLE_FILEPATH_VERSION = 14
+
+# clang-format binary -> major version, None if it is unknown
+CLANG_FORMAT_VERSION_DICT = {}
+
+
+def get_clang_format_major_version():
+    if CLANG_FORMAT_BINARY not in CLANG_FORMAT_VERSION_DICT:
+        sp = Command([CLANG_FORMAT_BINARY, '--version'])
+        major_version = None
+        try:
+            sp.run(timeout=CLANG_FORMAT_TIMEOUT)
+            # e.g. `Ubuntu clang-format version 14.0.0-1ubuntu1`
+            match = re.search(rb'clang-format version (\d+)\.', sp.stdout)
+            if match is not None:
+                major_version = int(match.group(1))
+        except Exception:
+            pass
+
+        CLANG_FORMAT_VERSION_DICT[CLANG_FORMAT_BINARY] = major_version
+
+    return CLANG_FORMAT_VERSION_DICT[CLANG_FORMAT_BINARY]
+
+
+class ClangFormatStyleIndex:
+    # Resolves the effective style file of every directory once instead of once per file.
+    # The style of a directory is the first `.clang-format` or `_clang-format` in the directory or its parents.
+    # Styles are identified by the SHA-1 of the style file, None if there is no style file.
+    # With `is_style_filepath_supported` clang-format gets the resolved style file instead of searching for it again.
+
+    def __init__(self, is_style_filepath_supported: bool = False):
+        self.is_style_filepath_supported = is_style_filepath_supported
+        # absolute directory path -> style digest
+        self.dir_style_dict = {}
+        # style digest -> style file path
+        self.style_filepath_dict = {}
+        # the styles that are based on the style of a parent directory (`BasedOnStyle: InheritParentConfig`)
+        self.inherited_style_digest_set = set()
+
+    def resolve_dir(self, dirpath: str):
+        unresolved_dirpath_list = []
+        style_digest = None
+
+        while True:
+            if dirpath in self.dir_style_dict:
+                style_digest = self.dir_style_dict[dirpath]
+                break
+
+            unresolved_dirpath_list.append(dirpath)
+
+            style_filepath = None
+            for filename in CLANG_FORMAT_STYLE_FILENAMES:
+                if os.path.isfile(os.path.join(dirpath, filename)):
+                    style_filepath = os.path.join(dirpath, filename)
+                    break
+
+            if style_filepath is not None:
+                with open(style_filepath, mode='rb') as infile:
+                    style_bs = infile.read()
+
+                if b'InheritParentConfig' in style_bs:
+                    # the effective style also depends on where the file is
+                    style_digest = hashlib.sha1(style_bs + os.fsencode(style_filepath)).hexdigest()
+                    self.inherited_style_digest_set.add(style_digest)
+                else:
+                    style_digest = hashlib.sha1(style_bs).hexdigest()
+                self.style_filepath_dict.setdefault(style_digest, style_filepath)
+                break
+
+            parent_dirpath = os.path.dirname(dirpath)
+            if parent_dirpath == dirpath:
+                break
+
+            dirpath = parent_dirpath
+
+        # every directory on the way up shares the result
+        for unresolved_dirpath in unresolved_dirpath_list:
+            self.dir_style_dict[unresolved_dirpath] = style_digest
+
+        return style_digest
+
+    def resolve(self, filepath: str):
+        return self.resolve_dir(os.path.dirname(os.path.abspath(filepath)))
+
+    def get_style_argument(self, style_digest: str):
+        if (not self.is_style_filepath_supported) or (style_digest in self.inherited_style_digest_set):
+            return DEFAULT_STYLE_ARGUMENT
+
+        if style_digest is None:
+            # what `-style=file` falls back to without a style file
+            return '-style=LLVM'
+
+        return f'-style=file:{self.style_filepath_dict[style_digest]}'
+
+
+def get_line_spans(content_bs: bytes, line_range_list: typing.List[typing.Tuple[int, int]]):
+    # Return the byte spans `[(start, end), ...]` of the 1-based inclusive line ranges.
+    # The newline is scanned once from the start up to the last range.
+    span_list = []
+    line_number = 1
+    line_start = 0
+    for first_line, last_line in sorted(line_range_list):
+        while (line_number < first_line) and (line_start < len(content_bs)):
+            line_start = content_bs.find(b'\n', line_start)
+            line_start = len(content_bs) if (line_start < 0) else (line_start + 1)
+            line_number += 1
+
+        span_start = line_start
+        while (line_number <= last_line) and (line_start < len(content_bs)):
+            line_start = content_bs.find(b'\n', line_start)
+            line_start = len(content_bs) if (line_start < 0) else (line_start + 1)
+            line_number += 1
+
+        span_list.append((span_start, line_start))
+
+    return span_list
+
+
+def map_offset(offset: int, replacement_list: typing.List[typing.Tuple[int, int, bytes]]):
+    # the offset after the (sorted) replacements are applied
+    delta = 0
+    for replacement_offset, length, replacement_bs in replacement_list:
+        if replacement_offset + length <= offset:
+            delta += len(replacement_bs) - length
+        elif replacement_offset < offset:
+            # inside a replaced span
+            return replacement_offset + delta
+        else:
+            break
+
+    return offset + delta
+
+
+def format_text_line_spans(content_bs: bytes, span_list: typing.List[typing.Tuple[int, int]]):
+    # The rules of `format_text_file_content` restricted to the given spans.
+    # The file is not decoded: CR and trailing spaces or tabs are ASCII in UTF-8, GB2312 and Shift-JIS.
+    # Leading and trailing empty lines are only removed if a span touches the start or the end of the file.
+    merged_span_list = []
+    for start, end in sorted(span_list):
+        # expand to whole lines
+        start = content_bs.rfind(b'\n', 0, start) + 1
+        newline_idx = content_bs.find(b'\n', max(start, end - 1))
+        end = len(content_bs) if (newline_idx < 0) else (newline_idx + 1)
+
+        if (len(merged_span_list) > 0) and (start <= merged_span_list[-1][1]):
+            merged_span_list[-1] = (merged_span_list[-1][0], max(end, merged_span_list[-1][1]))
+        else:
+            merged_span_list.append((start, end))
+
+    part_list = []
+    last_end = 0
+    for start, end in merged_span_list:
+        part_list.append(content_bs[last_end:start])
+
+        span_bs = content_bs[start:end].replace(b'\r', b'')
+        span_bs = b'\n'.join([line.rstrip() for line in span_bs.split(b'\n')])
+
+        if start == 0:
+            span_bs = span_bs.lstrip(b'\n')
+
+        if end == len(content_bs):
+            # the line before the span already ends with a newline
+            span_bs = span_bs.rstrip(b'\n')
+            if (len(span_bs) > 0) or (start == 0):
+                span_bs += b'\n'
+
+        part_list.append(span_bs)
+        last_end = end
+
+    part_list.append(content_bs[last_end:])
+    return b''.join(part_list)
+
+
+def format_changed_lines_with_clang_format(
+    inpath: str,
+    line_range_list: typing.List[typing.Tuple[int, int]],
+    style_argument: str = DEFAULT_STYLE_ARGUMENT,
+):
+    # Only the changed lines are formatted (like git-clang-format), the rest of the file is left as it is.
+    with TRACER.span('read', inpath) as span:
+        content_bs = open(inpath, mode='rb').read()
+        span.num_bytes = len(content_bs)
+
+    cmd = [CLANG_FORMAT_BINARY, style_argument, '--output-replacements-xml']
+    for first_line, last_line in line_range_list:
+        cmd.append(f'--lines={first_line}:{last_line}')
+    cmd.append(inpath)
+
+    sp = Command(cmd)
+
+    try:
+        with TRACER.span('clang-format', inpath):
+            sp.run(timeout=CLANG_FORMAT_TIMEOUT)
+
+        replacements_list = parse_replacements_xml(sp.stdout)
+        if len(replacements_list) != 1:
+            raise Exception(f'expected 1 replacement list, got {len(replacements_list)}')
+
+        replacement_list = sorted(replacements_list[0], key=lambda x: x[0])
+        clang_formatted_bs = apply_replacements(content_bs, replacement_list)
+    except Exception as ex:
+        stacktrace = traceback.format_exc()
+
+        return {
+            'error': f'failed to run clang-format\n{ex}\n{stacktrace}',
+        }
+
+    with TRACER.span('normalize', inpath):
+        # the changed lines and the lines that clang-format touched
+        span_list = [
+            (map_offset(start, replacement_list), map_offset(end, replacement_list))
+            for start, end in get_line_spans(content_bs, line_range_list)
+        ]
+        for offset, _, replacement_bs in replacement_list:
+            new_offset = map_offset(offset, replacement_list)
+            span_list.append((new_offset, new_offset + len(replacement_bs)))
+
+        formatted_bs = format_text_line_spans(clang_formatted_bs, span_list)
+
+    if formatted_bs == content_bs:
+        return {
+            'diff': False,
+            'filesize': len(content_bs),
+        }
+    else:
+        return {
+            'diff': True,
+            'content_bs': formatted_bs,
+            'filesize': len(content_bs),
         }
 
 
+# a batch that is being filled is closed when its first file is this many batches behind
+MAX_BATCH_SPAN_FACTOR = 4
+
+
+def iterate_batches(
+    filepath_list: typing.List[str],
+    batch_size: int,
+    style_index: ClangFormatStyleIndex,
+):
+    # yield `(style_digest, [index, ...])`, the files of a batch share the same style
+    # so a broken style file only makes its own batches fall back to per-file runs
+    if batch_size <= 1:
+        for filepath_idx, filepath in enumerate(filepath_list):
+            yield style_index.resolve(filepath), [filepath_idx]
+        return
+
+    # The results are released in the order of `filepath_list`, so a batch that waits for more files of its style
+    # holds back the results of every later file. A batch is closed when it is full or when its first file
+    # is `max_batch_span` files behind, which bounds the results that wait for an earlier file.
+    max_batch_span = batch_size * MAX_BATCH_SPAN_FACTOR
+
+    # style digest -> indices of the batch that is being filled, ordered by the first index
+    open_batch_dict = {}
+    for filepath_idx, filepath in enumerate(filepath_list):
+        style_digest = style_index.resolve(filepath)
+        index_list = open_batch_dict.setdefault(style_digest, [])
+        index_list.append(filepath_idx)
+        if len(index_list) >= batch_size:
+            yield style_digest, open_batch_dict.pop(style_digest)
+
+        while len(open_batch_dict) > 0:
+            oldest_style_digest = next(iter(open_batch_dict))
+            if (filepath_idx - open_batch_dict[oldest_style_digest][0]) < max_batch_span:
+                break
+            yield oldest_style_digest, open_batch_dict.pop(oldest_style_digest)
+
+    yield from open_batch_dict.items()
+
+
+def iterate_format_results(
+    filepath_list: typing.List[str],
+    batch_size: int = 1,
+    jobs: int = 1,
+    style_index: ClangFormatStyleIndex = None,
+    line_ranges_dict: typing.Dict[str, typing.List[typing.Tuple[int, int]]] = None,
+):
+    # yield `(filepath, format_result)` in the same order as `filepath_list`
+    # `format_result['style']` is the digest of the effective style file (None if there is none)
+    # with `line_ranges_dict` only the changed lines of each file are formatted
+    if style_index is None:
+        style_index = ClangFormatStyleIndex((get_clang_format_major_version() or 0) >= MIN_STYLE_FILEPATH_VERSION)
+
+    if line_ranges_dict is not None:
+        # the line ranges are different for each file
+        batch_size = 1
+
+    def format_batch(style_digest: str, index_list: typing.List[int]):
+        style_argument = style_index.get_style_argument(style_digest)
+        if line_ranges_dict is not None:
+            result_list = [
+                format_changed_lines_with_clang_format(filepath_list[i], line_ranges_dict[filepath_list[i]], style_argument)
+                for i in index_list
+            ]
+        else:
+            result_list = format_batch_with_clang_format([filepath_list[i] for i in index_list], style_argument)
+
+        for format_result in result_list:
+            format_result['style'] = style_digest
+        return result_list
+
+    # the results are held back until every earlier file is done
+    finished_result_dict = {}
+    next_filepath_idx = 0
+
+    def pop_finished_results():
+        nonlocal next_filepath_idx
+        while next_filepath_idx in finished_result_dict:
+            yield filepath_list[next_filepath_idx], finished_result_dict.pop(next_filepath_idx)
+            next_filepath_idx += 1
+
+    batch_iter = iterate_batches(filepath_list, batch_size, style_index)
+
+    if jobs <= 1:
+        for style_digest, index_list in batch_iter:
+            finished_result_dict.update(zip(index_list, format_batch(style_digest, index_list)))
+            yield from pop_finished_results()
+        return
+
+    # The work happens in the clang-format processes, a thread only waits for its process.
+    # At most `jobs` processes run at once and only a bounded number of batches is queued.
+    max_pending_batches = jobs * 2
+    RUNNING_PROCESS_SET.reset()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+
+        def submit_next_batch():
+            batch = next(batch_iter, None)
+            if batch is not None:
+                style_digest, index_list = batch
+                pending.append((index_list, executor.submit(format_batch, style_digest, index_list)))
+
+        try:
+            for _ in range(max_pending_batches):
+                submit_next_batch()
+
+            while len(pending) > 0:
+                index_list, future = pending.popleft()
+                finished_result_dict.update(zip(index_list, future.result()))
+                yield from pop_finished_results()
+                submit_next_batch()
+        except BaseException:
+            # Ctrl+C (or the caller stopping early) only reaches this thread,
+            # drop the queued batches and kill the processes so that the running batches fail fast
+            executor.shutdown(wait=False, cancel_futures=True)
+            RUNNING_PROCESS_SET.cancel()
+            raise
+
+
+def format_clang_supported_files(
+    filepath_list: typing.List[str],
+    is_run: bool,
+    verbose: bool,
+    batch_size: int = 1,
+    jobs: int = 1,
+    line_ranges_dict: typing.Dict[str, typing.List[typing.Tuple[int, int]]] = None,
+):
+    reporter = ProgressReporter(len(filepath_list), verbose)
+
+    format_results = iterate_format_results(filepath_list, batch_size, jobs, line_ranges_dict=line_ranges_dict)
+    for filepath, format_result in format_results:
+        filesize = format_result.get('filesize', 0)
+
+        if 'error' in format_result:
+            error_msg = format_result['error']
+            reporter.update(filepath, 'error', f'- {RED}{error_msg}{RESET}')
+            continue
+
+        if format_result['diff']:
+            if is_run:
+                content_bs = format_result['content_bs']
+                with TRACER.span('write', filepath) as span:
+                    span.num_bytes = len(content_bs)
+                    os.remove(filepath)  # file content may not be changed if we don't remove it
+                    with open(filepath, mode='wb') as outfile:
+                        outfile.write(content_bs)
+
+                reporter.update(filepath, 'fixed', f'{RED}x{RESET} -> {GREEN}OK{RESET}', filesize)
+            else:
+                reporter.update(filepath, 'changed', f'{RED}x{RESET}', filesize)
+        else:
+            reporter.update(filepath, 'ok', f'{GREEN}OK{RESET}', filesize)
+
+    reporter.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
@@ -284,10 +1538,28 @@ if __name__ == '__main__':
     parser.add_argument('-noautogit', '--noautogit', action='store_true')
     parser.add_argument('-r', '--r', '-run', '--run', dest='run', action='store_true')
     parser.add_argument('-v', '--v', '-verbose', '--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--since', dest='since', default=None, help='only files added, copied, modified or renamed since this git revision')
+    parser.add_argument('--staged', dest='staged', action='store_true', help='only files with staged changes')
+    parser.add_argument('--stats', dest='stats', action='store_true', help='print count, total, p50/p95/max time and bytes of each phase')
+    parser.add_argument('--trace', dest='trace', default=None, help='write one span per file and phase to this file in Chrome trace-event format')
+    parser.add_argument('--watch', dest='watch', action='store_true', help='keep formatting the files as they change (Linux only)')
+    parser.add_argument('--batch', dest='batch', type=int, default=1, help='number of files formatted by one clang-format process')
+    parser.add_argument('-j', '--j', '-jobs', '--jobs', dest='jobs', type=int, default=1, help='number of clang-format processes running at once (0 to use all CPUs)')
+    parser.add_argument('--clang-format', dest='clang_format', default=CLANG_FORMAT_BINARY, help='clang-format executable')
+    parser.add_argument('--changed-lines', dest='changed_lines', action='store_true', help='only format the lines changed since --since (or staged with --staged, or not staged by default)')
 
     args = parser.parse_args()
     print(args)
 
+    if args.watch and (not os.path.isdir(args.infile)):
+        raise Exception('--watch requires a directory')
+
+    if args.changed_lines and (args.watch or (not os.path.isdir(args.infile))):
+        raise Exception('--changed-lines requires a directory in a git repository and cannot be used with --watch')
+
+    TRACER.enabled = args.stats or (args.trace is not None)
+    CLANG_FORMAT_BINARY = args.clang_format
+
     inpath = args.infile
     use_git = args.git
     no_auto_git = args.noautogit
@@ -295,42 +1567,45 @@ if __name__ == '__main__':
     verbose = args.verbose
 
     filepath_list = []
+    line_ranges_dict = None
 
     if not os.path.exists(inpath):
         raise Exception(inpath + ' does not exist!')
     elif os.path.isfile(inpath):
         filepath_list.append(inpath)
     elif os.path.isdir(inpath):
-        if not no_auto_git:
+        if (args.since is not None) or args.staged:
+            use_git = True
+        elif not no_auto_git:
             child_filename_list = os.listdir(inpath)
             use_git = ('.git' in child_filename_list)
 
-        if use_git:
-            filepath_list = find_clang_supported_files_from_git(inpath)
-        else:
-            filepath_list = find_clang_supported_files(inpath)
+        with TRACER.span('discover'):
+            if args.changed_lines:
+                line_ranges_dict = get_changed_line_ranges(inpath, since=args.since, staged=args.staged)
+                filepath_list = list(line_ranges_dict.keys())
+            elif use_git:
+                filepath_list = find_clang_supported_files_from_git(inpath, since=args.since, staged=args.staged)
+            else:
+                filepath_list = find_clang_supported_files(inpath)
 
-    for filepath in filepath_list:
-        print('>', filepath, end=' ')
-        format_result = format_with_clang_format(filepath)
+    batch_size = max(1, args.batch)
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
 
-        if 'error' in format_result:
-            error_msg = format_result['error']
-            print(f'- {RED}{error_msg}{RESET}', flush=True)
-            continue
+    format_clang_supported_files(filepath_list, is_run, verbose, batch_size, jobs, line_ranges_dict)
 
-        if format_result['diff']:
-            if is_run:
-                content_bs = format_result['content_bs']
-                os.remove(filepath)  # file content may not be changed if we don't remove it
-                with open(filepath, mode='wb') as outfile:
-                    outfile.write(content_bs)
+    if args.watch:
+        watch_files(
+            inpath,
+            lambda filepath: os.path.splitext(filepath)[1].lower() in SUPPORTED_EXTENSIONS,
+            lambda batch: format_clang_supported_files(batch, is_run, verbose, batch_size, jobs),
+            use_git=use_git,
+        )
 
-                print(f'{RED}x{RESET} -> {GREEN}OK{RESET}', flush=True)
-            else:
-                print(f'{RED}x{RESET}', flush=True)
-        else:
-            if verbose:
-                print(f'{GREEN}OK{RESET}', flush=True)
-            else:
-                print('\r', end='')
+    if args.stats:
+        TRACER.print_stats()
+
+    if args.trace is not None:
+        TRACER.write_trace(args.trace)
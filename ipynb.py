@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 # encoding=utf-8
 import os
+import codecs
 import sys
 import subprocess
 import argparse
 import json
-from typing import List
+import time
+import collections
+import mmap
+import re
+import shutil
+import tempfile
+import base64
+import hashlib
+import concurrent.futures
+from typing import List, Iterator
 
 
 class TermColor:
@@ -25,54 +35,298 @@ class Encoding:
     UTF8 = 'utf-8'
     UTF8_WITH_BOM = 'utf-8-sig'
     UTF16 = 'utf-16'
+    UTF16_LE = 'utf-16-le'
+    UTF16_BE = 'utf-16-be'
     GB2312 = 'gb2312'
     SHIFT_JIS = 'shift-jis'
 
+    # only the beginning of the content is scanned to rank the encodings
+    SAMPLE_SIZE = 64 * 1024
+
     @classmethod
-    def decode(cls, bs: bytes):
-        try:
-            encoding = cls.UTF8_WITH_BOM
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+    def detect(cls, bs: bytes):
+        # Return `[(encoding, confidence), ...]` with the most likely encoding first.
+        # The sample is validated once per candidate and each validation stops at the first invalid byte.
+        # An empty list means that the content is binary.
+        candidate_list, _ = cls.scan(bs)
+        return candidate_list
 
-        try:
-            encoding = cls.UTF8
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+    @classmethod
+    def scan(cls, bs: bytes):
+        # Return `(candidate_list, decoded_content)`.
+        # `decoded_content` is not None if the whole content fits in the sample and is already decoded.
+        sample = bs[:cls.SAMPLE_SIZE]
+        is_truncated = (len(bs) > len(sample))
 
-        try:
-            encoding = cls.UTF16
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+        if sample.startswith(b'\xef\xbb\xbf'):
+            return [(cls.UTF8_WITH_BOM, 1.0)], None
 
-        try:
-            encoding = cls.GB2312
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+        if sample.startswith((b'\xff\xfe', b'\xfe\xff')):
+            return [(cls.UTF16, 1.0)], None
 
-        try:
-            encoding = cls.SHIFT_JIS
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+        num_nul = sample.count(0)
+        if num_nul > 0:
+            # UTF-16 text without BOM has a NUL byte next to every ASCII character
+            num_even_nul = sample[0::2].count(0)
+            num_odd_nul = num_nul - num_even_nul
+            num_pairs = len(sample) // 2
+
+            if (len(bs) % 2 == 0) and (num_nul * 4 >= num_pairs):
+                if num_odd_nul > num_even_nul * 4:
+                    return [(cls.UTF16_LE, 0.9)], None
+
+                if num_even_nul > num_odd_nul * 4:
+                    return [(cls.UTF16_BE, 0.9)], None
+
+            return [], None
+
+        if sample.isascii():
+            if not is_truncated:
+                return [(cls.UTF8, 1.0)], None
+
+            # ASCII is valid in every candidate, the rest of the content decides
+            return [(cls.UTF8, 0.9), (cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)], None
+
+        candidate_list = []
+        for encoding, confidence in (
+            (cls.UTF8, 0.99),
+            (cls.GB2312, 0.6),
+            (cls.SHIFT_JIS, 0.5),
+        ):
+            # the incremental decoder validates in a single pass and stops at the first invalid byte,
+            # a multi-byte character cut at the end of a truncated sample is not an error
+            try:
+                decoded_sample = codecs.getincrementaldecoder(encoding)().decode(sample, final=(not is_truncated))
+            except UnicodeDecodeError:
+                continue
+
+            if not is_truncated:
+                # the sample is the whole content
+                return [(encoding, confidence)], decoded_sample
+
+            candidate_list.append((encoding, confidence))
+
+            if encoding == cls.UTF8:
+                # Valid multi-byte UTF-8 sequences are very unlikely in other encodings,
+                # so they are not checked against the sample. They are still tried if the rest of the content is not UTF-8.
+                candidate_list.extend([(cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)])
+                break
+
+        return candidate_list, None
+
+    @classmethod
+    def decode(cls, bs: bytes):
+        # The content is decoded once with the most likely encoding.
+        # The next candidate is only tried if the content after the sample is invalid.
+        candidate_list, decoded_content = cls.scan(bs)
+        if decoded_content is not None:
+            return candidate_list[0][0], decoded_content
+
+        for encoding, _ in candidate_list:
+            try:
+                decoded_content = str(bs, encoding)
+                return encoding, decoded_content
+            except UnicodeDecodeError:
+                continue
 
         return None, bs
 
 
+class NullSpan:
+    # returned by a disabled `Tracer`, the instrumented code does not need to check if tracing is enabled
+    num_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class TraceSpan:
+    __slots__ = ('span_list', 'phase', 'filepath', 'num_bytes', 'start_ns')
+
+    def __init__(self, span_list: list, phase: str, filepath: str):
+        self.span_list = span_list
+        self.phase = phase
+        self.filepath = filepath
+        # bytes read or written in this phase
+        self.num_bytes = 0
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        self.span_list.append((self.phase, self.filepath, self.start_ns, duration_ns, self.num_bytes, os.getpid()))
+        return False
+
+
+class Tracer:
+    # Per-phase timing for `--stats` and `--trace`.
+    # A span is recorded as `(phase, filepath, start_ns, duration_ns, num_bytes, pid)`.
+    # `time.perf_counter_ns` is a system-wide monotonic clock so the spans of worker processes line up.
+
+    def __init__(self):
+        self.enabled = False
+        self.span_list = []
+
+    def span(self, phase: str, filepath: str = None):
+        if not self.enabled:
+            return NULL_SPAN
+
+        return TraceSpan(self.span_list, phase, filepath)
+
+    def pop_spans(self):
+        span_list = self.span_list
+        self.span_list = []
+        return span_list
+
+    def add_spans(self, span_list: list):
+        self.span_list.extend(span_list)
+
+    def print_stats(self, file=sys.stderr):
+        duration_dict = collections.defaultdict(list)
+        bytes_dict = collections.defaultdict(int)
+        for phase, _, _, duration_ns, num_bytes, _ in self.span_list:
+            duration_dict[phase].append(duration_ns)
+            bytes_dict[phase] += num_bytes
+
+        print(f'{"phase":<20} {"count":>8} {"total ms":>12} {"p50 ms":>10} {"p95 ms":>10} {"max ms":>10} {"bytes":>14}', file=file)
+        for phase, duration_list in duration_dict.items():
+            duration_list.sort()
+            count = len(duration_list)
+            p50 = duration_list[(count - 1) // 2]
+            p95 = duration_list[min(count - 1, (count * 95) // 100)]
+            print(
+                f'{phase:<20} {count:>8} {sum(duration_list) / 1e6:>12.3f} {p50 / 1e6:>10.3f}'
+                f' {p95 / 1e6:>10.3f} {duration_list[-1] / 1e6:>10.3f} {bytes_dict[phase]:>14}',
+                file=file,
+            )
+
+    def write_trace(self, outpath: str):
+        # Chrome trace-event format, open with chrome://tracing or https://ui.perfetto.dev
+        origin_ns = min([x[2] for x in self.span_list], default=0)
+
+        event_list = []
+        for phase, filepath, start_ns, duration_ns, num_bytes, pid in self.span_list:
+            event_args = {}
+            if filepath is not None:
+                event_args['file'] = filepath
+            if num_bytes > 0:
+                event_args['bytes'] = num_bytes
+
+            event_list.append({
+                'name': phase,
+                'ph': 'X',
+                'ts': (start_ns - origin_ns) / 1000,
+                'dur': duration_ns / 1000,
+                'pid': pid,
+                'tid': pid,
+                'args': event_args,
+            })
+
+        # non-UTF-8 file names are escaped
+        with open(outpath, mode='w', encoding='utf-8') as outfile:
+            json.dump({'traceEvents': event_list, 'displayTimeUnit': 'ms'}, outfile)
+
+
+TRACER = Tracer()
+
+
+class ProgressReporter:
+    # Buffers the status lines of the notebooks and writes them in batches.
+    # On a TTY a progress line (files/s, bytes/s, ETA) is redrawn at most every `REDRAW_INTERVAL` seconds.
+    # Only changed or failed notebooks are printed (every notebook with `verbose`), followed by a summary.
+
+    REDRAW_INTERVAL = 0.1  # seconds
+    MAX_PENDING_LINES = 256
+
+    # statuses that are always printed
+    REPORTED_STATUSES = ('changed', 'fixed', 'error')
+
+    def __init__(self, total_files: int, verbose: bool = False):
+        self.file = sys.stdout
+        self.is_tty = self.file.isatty()
+        self.verbose = verbose
+        self.total_files = total_files
+
+        self.num_files = 0
+        self.num_bytes = 0
+        self.status_counter = collections.Counter()
+        self.pending_lines = []
+        self.has_progress_line = False
+        self.start_time = time.monotonic()
+        self.last_flush_time = self.start_time
+
+    def update(self, filepath: str, status: str, message: str = '', num_bytes: int = 0):
+        # `status` is one of 'ok', 'skipped', 'changed', 'fixed' or 'error'
+        self.num_files += 1
+        self.num_bytes += num_bytes
+        self.status_counter[status] += 1
+
+        if (status in self.REPORTED_STATUSES) or self.verbose:
+            self.pending_lines.append(f'> {filepath} {message}')
+
+        now = time.monotonic()
+        if (len(self.pending_lines) >= self.MAX_PENDING_LINES) or ((now - self.last_flush_time) >= self.REDRAW_INTERVAL):
+            self.flush(now)
+
+    def format_progress(self, now: float):
+        elapsed = max(now - self.start_time, 1e-9)
+        files_per_second = self.num_files / elapsed
+        mb_per_second = self.num_bytes / (1024 * 1024) / elapsed
+
+        if files_per_second > 0:
+            eta = f'{(self.total_files - self.num_files) / files_per_second:.0f}s'
+        else:
+            eta = '?'
+
+        return f'{self.num_files}/{self.total_files} files {files_per_second:.0f} files/s {mb_per_second:.1f} MB/s ETA {eta}'
+
+    def flush(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+
+        parts = []
+        if self.has_progress_line:
+            # erase the progress line before the status lines are written over it
+            parts.append('\r\033[K')
+            self.has_progress_line = False
+
+        for line in self.pending_lines:
+            parts.append(line)
+            parts.append('\n')
+        self.pending_lines = []
+
+        if self.is_tty:
+            parts.append(self.format_progress(now))
+            self.has_progress_line = True
+
+        if len(parts) > 0:
+            self.file.write(''.join(parts))
+            self.file.flush()
+
+        self.last_flush_time = now
+
+    def close(self):
+        now = time.monotonic()
+        self.is_tty = False
+        self.flush(now)
+
+        count_str = ', '.join([f'{count} {status}' for status, count in self.status_counter.items()])
+        if len(count_str) > 0:
+            count_str = f' ({count_str})'
+
+        self.file.write(f'{self.num_files} files{count_str} in {now - self.start_time:.2f}s\n')
+        self.file.flush()
+
+
 IGNORED_DIRS = [
     '.git',  # git directory
     'logs',  # log directory
@@ -88,32 +342,74 @@ IGNORED_DIRS = [
 ]
 
 
+def iter_ipynb_files(infile: str) -> Iterator[str]:
+    # `.ipynb_checkpoints` is in IGNORED_DIRS so the copies that Jupyter keeps are not formatted
+    if os.path.basename(infile).lower() in IGNORED_DIRS:
+        return
+
+    if not os.path.isdir(infile):
+        if os.path.isfile(infile) and (os.path.splitext(infile)[1].lower() == '.ipynb'):
+            yield infile
+        return
+
+    dirpath_stack = [infile]
+    while len(dirpath_stack) > 0:
+        with os.scandir(dirpath_stack.pop()) as entry_iter:
+            for entry in entry_iter:
+                if entry.name.lower() in IGNORED_DIRS:
+                    continue
+
+                if entry.is_dir():
+                    dirpath_stack.append(entry.path)
+                elif entry.is_file() and (os.path.splitext(entry.name)[1].lower() == '.ipynb'):
+                    yield entry.path
+
+
 def find_all_ipynb_files(infile: str, out_list: list):
-    basename = os.path.basename(infile)
-    if basename.lower() in IGNORED_DIRS:
-        return []
+    out_list.extend(iter_ipynb_files(infile))
+
+
+def get_git_list_files_args(since: str = None, staged: bool = False):
+    if (since is None) and (not staged):
+        return ['git', '-c', 'core.quotepath=off', 'ls-files']
+
+    # Only the files that are added, copied, modified or renamed relative to `since` (or HEAD with `staged`).
+    # A renamed file is listed with its new path. Rename detection is skipped because the new path of
+    # an undetected rename is still listed as added.
+    args = [
+        'git',
+        '-c', 'core.quotepath=off',
+        'diff',
+        '--name-only',
+        '--relative',
+        '--no-renames',
+        '--diff-filter=ACMR',
+    ]
 
-    if os.path.isdir(infile):
-        flist = os.listdir(infile)
-        for fname in flist:
-            fpath = os.path.join(infile, fname)
-            find_all_ipynb_files(infile=fpath, out_list=out_list)
+    if staged:
+        args.append('--cached')
 
-    elif os.path.isfile(infile):
-        ext = os.path.splitext(infile)[1].lower()
-        if ext == '.ipynb':
-            out_list.append(infile)
+    if since is not None:
+        if since.startswith('-'):
+            # `since` is placed before `--` so git would read it as an option
+            raise Exception(f'Invalid git revision: {since!r}')
 
+        args.append(since)
 
-def list_git_files(indir: str):
+    args.append('--')
+    return args
+
+
+def list_git_files(indir: str, since: str = None, staged: bool = False):
     git_process = subprocess.run(
-        args=['git', 'ls-files'],
+        args=get_git_list_files_args(since, staged),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         cwd=indir,
     )
 
-    if len(git_process.stderr) > 0:
+    # git prints warnings (e.g. about line endings under `text=auto`) on stderr, only the returncode tells a failure
+    if git_process.returncode != 0:
         _, error_msg = Encoding.decode(git_process.stderr)
 
         if type(error_msg) is bytes:
@@ -136,17 +432,675 @@ def list_git_files(indir: str):
     return filepaths
 
 
+# One line of `json.dumps(obj, ensure_ascii=False, indent='\t')`:
+# indentation, an optional object key, then an opening bracket, a scalar (or empty container) or a closing bracket,
+# and an optional comma.
+# Strings only contain the escapes that `json.dumps` writes, the unrolled loop does not backtrack.
+CANONICAL_STRING = rb'"[^"\\\x00-\x1f]*(?:\\(?:["\\bfnrt]|u00(?:0[0-7bef]|1[0-9a-f]))[^"\\\x00-\x1f]*)*"'
+# Most of the bytes of a notebook are in strings without escapes (e.g. base64 images).
+# A single negated byte is matched much faster, the raw control bytes are checked for the whole file instead.
+UNESCAPED_STRING = rb'"[^"]*"'
+CANONICAL_NUMBER = rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?'
+
+
+def compile_canonical_line_pattern(string_pattern: bytes):
+    return re.compile(
+        rb'(\t*)'
+        rb'(?:(' + string_pattern + rb'): )?'
+        rb'(?:'
+        rb'([{[])'
+        rb'|(' + string_pattern + rb'|' + CANONICAL_NUMBER + rb'|true|false|null|NaN|-?Infinity|\{\}|\[\])'
+        rb'|([}\]])'
+        rb')'
+        rb'(,?)'
+    )
+
+
+CANONICAL_LINE_PATTERN = compile_canonical_line_pattern(CANONICAL_STRING)
+UNESCAPED_LINE_PATTERN = compile_canonical_line_pattern(UNESCAPED_STRING)
+
+# `json.dumps` escapes every control character, only the indentation tabs and the line feeds are written as they are.
+# Tabs are checked line by line.
+RAW_CONTROL_BYTES = bytes([x for x in range(0x20) if x not in (0x09, 0x0a)])
+
+CLOSING_BRACKET_DICT = {b'{': b'}', b'[': b']'}
+
+# the file is validated as UTF-8 in blocks of this size
+UTF8_VALIDATION_BLOCK_SIZE = 1024 * 1024
+
+
+def is_canonical_number(token: bytes):
+    # integers are written as they are (`-0` is written as `0`), floats with `float.__repr__`
+    if token[:1] not in b'-0123456789':
+        return True
+
+    if (b'.' not in token) and (b'e' not in token) and (b'E' not in token):
+        return token != b'-0'
+
+    return repr(float(token)).encode('ascii') == token
+
+
+def is_utf8_without_control_bytes(buf):
+    # block by block so that a large file is not copied at once
+    decoder = codecs.getincrementaldecoder(Encoding.UTF8)()
+    try:
+        for block_start in range(0, len(buf), UTF8_VALIDATION_BLOCK_SIZE):
+            block = buf[block_start:block_start + UTF8_VALIDATION_BLOCK_SIZE]
+            if len(block.translate(None, RAW_CONTROL_BYTES)) != len(block):
+                return False
+            decoder.decode(block)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def find_canonical_version_line(buf):
+    # Check line by line that `buf` is exactly what `format_ipynb_file` would write for it,
+    # except for a `metadata.language_info.version` member.
+    # Return None if it is not (the notebook has to be parsed),
+    # otherwise `(line_start, line_end, has_comma, previous_line_end)` of the version member or `()` if there is none.
+    if (not buf[:2] == b'{\n') or (not buf[-2:] == b'}\n'):
+        return None
+
+    # `[bracket, key_set, key]` of the open containers, `key` is the key of the container in its parent object
+    container_stack = []
+    # the next line has to be a member (not a closing bracket)
+    expects_member = True
+    version_line = ()
+    # the line before the version member, it has a comma that goes away if the version is the last member
+    previous_line_end = -1
+
+    line_start = 0
+    buf_size = len(buf)
+    while line_start < buf_size:
+        line_end = buf.find(b'\n', line_start)
+        if line_end < 0:
+            return None
+
+        if buf.find(b'\\', line_start, line_end) < 0:
+            match = UNESCAPED_LINE_PATTERN.fullmatch(buf, line_start, line_end)
+        else:
+            match = CANONICAL_LINE_PATTERN.fullmatch(buf, line_start, line_end)
+
+        if match is None:
+            return None
+
+        indent, key, opening_bracket, scalar, closing_bracket, comma = match.groups()
+        depth = len(container_stack)
+
+        if buf.find(b'\t', line_start + len(indent), line_end) >= 0:
+            # a tab that is not indentation is in a string
+            return None
+
+        if closing_bracket is not None:
+            if expects_member or (depth == 0) or (key is not None) or (len(indent) != depth - 1):
+                return None
+
+            bracket, _, _ = container_stack.pop()
+            if CLOSING_BRACKET_DICT[bracket] != closing_bracket:
+                return None
+
+            if (len(container_stack) == 0) and (len(comma) > 0):
+                return None
+
+            expects_member = (len(comma) > 0)
+        else:
+            if (not expects_member) or (len(indent) != depth):
+                return None
+
+            if depth == 0:
+                if (key is not None) or (opening_bracket != b'{'):
+                    return None
+            elif container_stack[-1][0] == b'{':
+                # `json.loads` keeps the last of duplicate keys
+                key_set = container_stack[-1][1]
+                if (key is None) or (key in key_set):
+                    return None
+                key_set.add(key)
+            elif key is not None:
+                return None
+
+            is_language_info = (
+                (key == b'"language_info"')
+                and (depth == 2)
+                and (container_stack[1][2] == b'"metadata"')
+            )
+            is_version = (
+                (key == b'"version"')
+                and (depth == 3)
+                and (container_stack[1][2] == b'"metadata"')
+                and (container_stack[2][2] == b'"language_info"')
+            )
+
+            if is_language_info and (opening_bracket != b'{') and (scalar != b'{}'):
+                return None
+
+            if opening_bracket is not None:
+                # an empty container is written on one line
+                if (len(comma) > 0) or is_version:
+                    return None
+                container_stack.append([opening_bracket, set(), key])
+                expects_member = True
+            else:
+                if not is_canonical_number(scalar):
+                    return None
+
+                if is_version:
+                    if (len(comma) == 0) and (len(container_stack[2][1]) == 1):
+                        # `language_info` would become `{}` on one line
+                        return None
+                    version_line = (line_start, line_end, len(comma) > 0, previous_line_end)
+
+                expects_member = (len(comma) > 0)
+
+        if (len(container_stack) == 0) and (line_end + 1 != buf_size):
+            # something after the notebook
+            return None
+
+        previous_line_end = line_end
+        line_start = line_end + 1
+
+    if len(container_stack) > 0:
+        return None
+
+    if not is_utf8_without_control_bytes(buf):
+        return None
+
+    return version_line
+
+
+def get_version_line_removal_spans(version_line: tuple):
+    # Return the `(start, end)` spans of the original content that are kept,
+    # `version_line` is returned by `find_canonical_version_line`.
+    line_start, line_end, has_comma, previous_line_end = version_line
+    if has_comma:
+        return [(0, line_start), (line_end + 1, None)]
+
+    # the member before it becomes the last one
+    return [(0, previous_line_end - 1), (previous_line_end, line_start), (line_end + 1, None)]
+
+
+# characters encoded and compared at once
+ENCODE_CHUNK_SIZE = 64 * 1024
+
+
+def iterate_encoded_chunks(obj):
+    # `json.dumps(obj, ensure_ascii=False, indent='\t') + '\n'` encoded as UTF-8 piece by piece,
+    # the whole output is never held in memory
+    encoder = json.JSONEncoder(ensure_ascii=False, indent='\t')
+
+    piece_list = []
+    num_chars = 0
+    for piece in encoder.iterencode(obj):
+        piece_list.append(piece)
+        num_chars += len(piece)
+        if num_chars >= ENCODE_CHUNK_SIZE:
+            yield ''.join(piece_list).encode(Encoding.UTF8)
+            piece_list = []
+            num_chars = 0
+
+    piece_list.append('\n')
+    yield ''.join(piece_list).encode(Encoding.UTF8)
+
+
+def create_temporary_file(filepath: str):
+    # In the same directory so that `os.replace` does not copy across file systems.
+    # Return `(outfile, tmp_filepath)`.
+    fd, tmp_filepath = tempfile.mkstemp(
+        prefix='.' + os.path.basename(filepath) + '.',
+        suffix='.tmp',
+        dir=(os.path.dirname(filepath) or '.'),
+    )
+    shutil.copymode(filepath, tmp_filepath)
+    return os.fdopen(fd, mode='wb'), tmp_filepath
+
+
+def remove_file_if_exists(filepath: str):
+    if (filepath is not None) and os.path.exists(filepath):
+        os.remove(filepath)
+
+
+def compare_encoded_chunks(filepath: str, buf, chunk_iter, is_run: bool):
+    # Compare the chunks with the original content `buf` as they are encoded.
+    # Return `(diff, tmp_filepath)`.
+    # Without `is_run` the comparison stops at the first difference.
+    # With `is_run` the new content is written to `tmp_filepath` from the first difference on,
+    # the caller replaces the original file with it.
+    offset = 0
+    outfile = None
+    tmp_filepath = None
+
+    try:
+        with memoryview(buf) as view:
+            for chunk in chunk_iter:
+                if outfile is None:
+                    chunk_end = offset + len(chunk)
+                    if view[offset:chunk_end] == chunk:
+                        offset = chunk_end
+                        continue
+
+                    if not is_run:
+                        return True, None
+
+                    outfile, tmp_filepath = create_temporary_file(filepath)
+                    outfile.write(view[:offset])
+
+                outfile.write(chunk)
+
+            if outfile is None:
+                if offset == len(buf):
+                    return False, None
+
+                if not is_run:
+                    return True, None
+
+                # the new content is a prefix of the original one
+                outfile, tmp_filepath = create_temporary_file(filepath)
+                outfile.write(view[:offset])
+
+        outfile.close()
+        return True, tmp_filepath
+    except BaseException:
+        if outfile is not None:
+            outfile.close()
+        remove_file_if_exists(tmp_filepath)
+        raise
+
+
+# base64 encoded output and attachment types, `image/svg+xml` is text
+BINARY_MIME_TYPE_PATTERN = re.compile(r'^(?:image/(?!svg\+xml$).+|application/pdf)$')
+
+# what is left in the notebook of an extracted value, the trailing line feed of the value is kept
+ATTACHMENT_REFERENCE_PREFIX = 'ipynb-attachment:sha256:'
+ATTACHMENT_REFERENCE_PATTERN = re.compile(r'^' + re.escape(ATTACHMENT_REFERENCE_PREFIX) + r'([0-9a-f]{64})(\n?)$')
+
+
+def iterate_mime_bundles(obj):
+    # the `data` of every output and every attachment of the cells
+    cell_list = obj.get('cells') if isinstance(obj, dict) else None
+    if not isinstance(cell_list, list):
+        return
+
+    for cell in cell_list:
+        if not isinstance(cell, dict):
+            continue
+
+        output_list = cell.get('outputs')
+        if isinstance(output_list, list):
+            for output in output_list:
+                if isinstance(output, dict) and isinstance(output.get('data'), dict):
+                    yield output['data']
+
+        attachment_dict = cell.get('attachments')
+        if isinstance(attachment_dict, dict):
+            for mime_bundle in attachment_dict.values():
+                if isinstance(mime_bundle, dict):
+                    yield mime_bundle
+
+
+def strip_outputs(obj):
+    # the outputs and execution counts of code cells, return True if anything is removed
+    cell_list = obj.get('cells') if isinstance(obj, dict) else None
+    if not isinstance(cell_list, list):
+        return False
+
+    is_stripped = False
+    for cell in cell_list:
+        if (not isinstance(cell, dict)) or (cell.get('cell_type') != 'code'):
+            continue
+
+        if cell.get('outputs') != []:
+            cell['outputs'] = []
+            is_stripped = True
+
+        if cell.get('execution_count') is not None:
+            cell['execution_count'] = None
+            is_stripped = True
+
+    return is_stripped
+
+
+class AttachmentStore:
+    # Content-addressed store for the base64 values of notebooks, deduplicated across notebooks and revisions.
+    # A value is stored decoded as `<root>/<first 2 hex digits>/<sha256 of the decoded bytes>`.
+
+    def __init__(self, root: str, min_size: int = 4096):
+        self.root = root
+        # only base64 values of at least this many characters are extracted
+        self.min_size = min_size
+        # blobs whose content is already checked by this process
+        self.verified_digest_set = set()
+
+    def get_filepath(self, hex_digest: str):
+        return os.path.join(self.root, hex_digest[:2], hex_digest)
+
+    def is_stored(self, hex_digest: str):
+        if hex_digest in self.verified_digest_set:
+            return True
+
+        blob_filepath = self.get_filepath(hex_digest)
+        if not os.path.exists(blob_filepath):
+            return False
+
+        with open(blob_filepath, mode='rb') as infile:
+            if hashlib.sha256(infile.read()).hexdigest() != hex_digest:
+                # e.g. an interrupted copy of the store, it is written again
+                return False
+
+        self.verified_digest_set.add(hex_digest)
+        return True
+
+    def put(self, data: bytes, hex_digest: str):
+        if self.is_stored(hex_digest):
+            return
+
+        blob_filepath = self.get_filepath(hex_digest)
+        os.makedirs(os.path.dirname(blob_filepath), exist_ok=True)
+
+        # other processes may store the same blob at the same time
+        fd, tmp_filepath = tempfile.mkstemp(prefix='.' + hex_digest + '.', suffix='.tmp', dir=os.path.dirname(blob_filepath))
+        try:
+            with os.fdopen(fd, mode='wb') as outfile:
+                outfile.write(data)
+            os.replace(tmp_filepath, blob_filepath)
+        except BaseException:
+            remove_file_if_exists(tmp_filepath)
+            raise
+
+        self.verified_digest_set.add(hex_digest)
+
+    def get(self, hex_digest: str):
+        blob_filepath = self.get_filepath(hex_digest)
+        if not os.path.exists(blob_filepath):
+            raise Exception(f'{blob_filepath} is missing from the attachment store')
+
+        with open(blob_filepath, mode='rb') as infile:
+            data = infile.read()
+
+        if hashlib.sha256(data).hexdigest() != hex_digest:
+            raise Exception(f'{blob_filepath} does not match its SHA-256')
+
+        return data
+
+    def extract_value(self, value, is_run: bool):
+        # Return the reference that replaces `value`, or `value` if it is kept in the notebook.
+        # Only values that `restore_value` turns back into the exact same string are extracted.
+        # Without `is_run` the store is not written.
+        if (not isinstance(value, str)) or (len(value) < self.min_size):
+            return value
+
+        base64_str = value[:-1] if value.endswith('\n') else value
+        try:
+            data = base64.b64decode(base64_str, validate=True)
+        except ValueError:
+            return value
+
+        if base64.b64encode(data).decode('ascii') != base64_str:
+            # e.g. wrapped lines
+            return value
+
+        hex_digest = hashlib.sha256(data).hexdigest()
+        if is_run:
+            self.put(data, hex_digest)
+
+        return ATTACHMENT_REFERENCE_PREFIX + hex_digest + value[len(base64_str):]
+
+    def restore_value(self, value):
+        if not isinstance(value, str):
+            return value
+
+        match = ATTACHMENT_REFERENCE_PATTERN.match(value)
+        if match is None:
+            return value
+
+        hex_digest, line_feed = match.groups()
+        return base64.b64encode(self.get(hex_digest)).decode('ascii') + line_feed
+
+    def extract(self, obj, is_run: bool):
+        # return the number of extracted values
+        num_extracted = 0
+        for mime_bundle in iterate_mime_bundles(obj):
+            for mime_type, value in mime_bundle.items():
+                if BINARY_MIME_TYPE_PATTERN.match(mime_type) is None:
+                    continue
+
+                reference = self.extract_value(value, is_run)
+                if reference is not value:
+                    mime_bundle[mime_type] = reference
+                    num_extracted += 1
+
+        return num_extracted
+
+    def restore(self, obj):
+        # return the number of restored values
+        num_restored = 0
+        for mime_bundle in iterate_mime_bundles(obj):
+            for mime_type, value in mime_bundle.items():
+                restored_value = self.restore_value(value)
+                if restored_value is not value:
+                    mime_bundle[mime_type] = restored_value
+                    num_restored += 1
+
+        return num_restored
+
+
+def format_ipynb_buffer(
+    filepath: str,
+    buf,
+    is_run: bool,
+    is_stripping_outputs: bool = False,
+    extract_store: AttachmentStore = None,
+    restore_store: AttachmentStore = None,
+):
+    # Return `(format_result, tmp_filepath)`, see `format_ipynb_file`.
+    filesize = len(buf)
+    is_transformed = is_stripping_outputs or (extract_store is not None) or (restore_store is not None)
+
+    # Most notebooks are already written by this script, they are checked without a full parse.
+    with TRACER.span('fast_path', filepath) as span:
+        span.num_bytes = filesize
+        version_line = None if is_transformed else find_canonical_version_line(buf)
+
+    if version_line == ():
+        return {'diff': False, 'filesize': filesize}, None
+
+    if version_line is not None:
+        if not is_run:
+            return {'diff': True, 'filesize': filesize}, None
+
+        with TRACER.span('write', filepath) as span:
+            outfile, tmp_filepath = create_temporary_file(filepath)
+            try:
+                with outfile, memoryview(buf) as view:
+                    for span_start, span_end in get_version_line_removal_spans(version_line):
+                        span.num_bytes += outfile.write(view[span_start:span_end])
+            except BaseException:
+                remove_file_if_exists(tmp_filepath)
+                raise
+
+        return {'diff': True, 'filesize': filesize}, tmp_filepath
+
+    with TRACER.span('decode', filepath):
+        encoding, decoded_string = Encoding.decode(buf)
+
+    if (encoding is None) or (not isinstance(decoded_string, str)):
+        return {'ignored': True}, None
+
+    with TRACER.span('json_load', filepath):
+        obj = json.loads(decoded_string)
+
+    # only the parsed notebook and the original (mapped) content are kept while it is encoded
+    del decoded_string
+
+    # not every notebook has `metadata.language_info` (e.g. one that was never run)
+    language_info = obj.get('metadata', {}).get('language_info', None)
+    if isinstance(language_info, dict) and ('version' in language_info):
+        del language_info['version']
+
+    if is_stripping_outputs:
+        with TRACER.span('strip_outputs', filepath):
+            strip_outputs(obj)
+
+    # the values are decoded one by one, the store is written before the notebook
+    if extract_store is not None:
+        with TRACER.span('extract', filepath):
+            extract_store.extract(obj, is_run)
+
+    if restore_store is not None:
+        with TRACER.span('restore', filepath):
+            restore_store.restore(obj)
+
+    with TRACER.span('json_dump', filepath):
+        diff, tmp_filepath = compare_encoded_chunks(filepath, buf, iterate_encoded_chunks(obj), is_run)
+
+    return {'diff': diff, 'filesize': filesize}, tmp_filepath
+
+
+def format_ipynb_file(
+    filepath: str,
+    is_run: bool = False,
+    is_stripping_outputs: bool = False,
+    extract_store: AttachmentStore = None,
+    restore_store: AttachmentStore = None,
+):
+    # Return `{'ignored': True}` or `{'diff': ..., 'filesize': ...}`.
+    # With `is_run` a changed notebook is replaced by a temporary file with the new content.
+    # `is_stripping_outputs` removes the outputs and execution counts,
+    # `extract_store` moves the base64 values to the store and `restore_store` puts them back.
+    filesize = os.path.getsize(filepath)
+    if filesize == 0:
+        return {
+            'ignored': True,
+        }
+
+    with open(filepath, mode='rb') as infile:
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            format_result, tmp_filepath = format_ipynb_buffer(
+                filepath,
+                mm,
+                is_run,
+                is_stripping_outputs,
+                extract_store,
+                restore_store,
+            )
+
+    if tmp_filepath is not None:
+        # Windows cannot replace a file that is still open or mapped
+        try:
+            os.replace(tmp_filepath, filepath)
+        except BaseException:
+            remove_file_if_exists(tmp_filepath)
+            raise
+
+    return format_result
+
+
+def try_format_ipynb_file(filepath: str, format_args: tuple = ()):
+    # a malformed notebook is reported instead of stopping the other files
+    try:
+        return format_ipynb_file(filepath, *format_args)
+    except Exception as ex:
+        try:
+            filesize = os.path.getsize(filepath)
+        except OSError:
+            filesize = 0
+
+        return {
+            'error': f'{type(ex).__name__}: {ex}',
+            'filesize': filesize,
+        }
+
+
+def format_ipynb_file_task(filepath: str, format_args: tuple, trace: bool):
+    # return `(format_result, span_list)`, the spans of the worker process are sent back with the result
+    TRACER.enabled = trace
+    # a forked worker starts with a copy of the spans of the parent process
+    TRACER.pop_spans()
+
+    format_result = try_format_ipynb_file(filepath, format_args)
+    return format_result, TRACER.pop_spans()
+
+
+DEFAULT_MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+
+
+def iterate_format_results(
+    filepath_list: List[str],
+    format_args: tuple = (),
+    jobs: int = 1,
+    max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES,
+):
+    # yield `(filepath, format_result)` in the same order as `filepath_list`
+    # `format_args` are the arguments of `format_ipynb_file` after `filepath`
+    if jobs <= 1:
+        for filepath in filepath_list:
+            yield filepath, try_format_ipynb_file(filepath, format_args)
+        return
+
+    # Parsing a notebook takes a few times its size in memory.
+    # A notebook is only submitted while the total size of the notebooks in flight stays within `max_inflight_bytes`,
+    # a larger one waits until it is the only one, so large notebooks run one at a time and small ones in parallel.
+    # A notebook stays in flight until the results before it are reported.
+    max_pending_files = jobs * 2
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        inflight_bytes = 0
+        next_filepath_idx = 0
+
+        while True:
+            while (next_filepath_idx < len(filepath_list)) and (len(pending) < max_pending_files):
+                filepath = filepath_list[next_filepath_idx]
+                try:
+                    filesize = os.path.getsize(filepath)
+                except OSError:
+                    # reported by the worker
+                    filesize = 0
+
+                if (len(pending) > 0) and (inflight_bytes + filesize > max_inflight_bytes):
+                    break
+
+                future = executor.submit(format_ipynb_file_task, filepath, format_args, TRACER.enabled)
+                pending.append((filepath, filesize, future))
+                inflight_bytes += filesize
+                next_filepath_idx += 1
+
+            if len(pending) == 0:
+                break
+
+            filepath, filesize, future = pending.popleft()
+            format_result, span_list = future.result()
+            TRACER.add_spans(span_list)
+            inflight_bytes -= filesize
+
+            yield filepath, format_result
+
+
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('infile', default='.', action='store', nargs='?')
     parser.add_argument('--git', help='use git to list file', action='store_true')
+    parser.add_argument('--since', help='only files added, copied, modified or renamed since this git revision')
+    parser.add_argument('--staged', help='only files with staged changes', action='store_true')
     parser.add_argument('--run', action='store_true')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--strip-outputs', action='store_true', help='remove the outputs and execution counts of code cells')
+    attachment_group = parser.add_mutually_exclusive_group()
+    attachment_group.add_argument('--extract-attachments', metavar='STORE_DIR', help='move the base64 images of outputs and attachments to a sha256 content-addressed store and leave a reference')
+    attachment_group.add_argument('--restore-attachments', metavar='STORE_DIR', help='put back the values moved by --extract-attachments')
+    parser.add_argument('--min-attachment-size', type=int, default=4096, help='only extract base64 values of at least this many characters')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of notebooks processed at once (0 to use all CPUs)')
+    parser.add_argument('--max-inflight-bytes', type=int, default=DEFAULT_MAX_INFLIGHT_BYTES, help='total size of the notebooks processed at once with --jobs, a larger notebook runs alone')
+    parser.add_argument('--stats', action='store_true', help='print count, total, p50/p95/max time and bytes of each phase')
+    parser.add_argument('--trace', help='write one span per file and phase to this file in Chrome trace-event format')
 
     args = parser.parse_args()
     print(args)
 
+    TRACER.enabled = args.stats or (args.trace is not None)
+
     filepaths = []
 
     if not os.path.exists(args.infile):
@@ -161,58 +1115,65 @@ def main():
                 args.git = True
                 break
 
-        if args.git:
-            filepaths = list_git_files(args.infile)
-            filepaths = filter(lambda filepath: os.path.splitext(filepath)[1].lower() == '.ipynb', filepaths)
-            filepaths = list(filepaths)
-        else:
-            find_all_ipynb_files(args.infile, out_list=filepaths)
+        if (args.since is not None) or args.staged:
+            args.git = True
 
-    for filepath in filepaths:
-        print('>', filepath, end=' ')
+        with TRACER.span('discover'):
+            if args.git:
+                filepaths = list_git_files(args.infile, since=args.since, staged=args.staged)
+                filepaths = filter(lambda filepath: os.path.splitext(filepath)[1].lower() == '.ipynb', filepaths)
+                filepaths = list(filepaths)
+            else:
+                find_all_ipynb_files(args.infile, out_list=filepaths)
 
-        filesize = os.path.getsize(filepath)
-        if filesize == 0:
-            print('\r', end='')
-            continue
+    extract_store = None
+    if args.extract_attachments is not None:
+        extract_store = AttachmentStore(args.extract_attachments, args.min_attachment_size)
 
-        bs = open(filepath, mode='rb').read()
+    restore_store = None
+    if args.restore_attachments is not None:
+        restore_store = AttachmentStore(args.restore_attachments)
 
-        encoding, decoded_string = Encoding.decode(bs)
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
 
-        if (encoding is None) or (type(decoded_string) is bytes):
-            print('\r', end='')
-            continue
+    format_args = (args.run, args.strip_outputs, extract_store, restore_store)
+    format_results = iterate_format_results(filepaths, format_args, jobs, args.max_inflight_bytes)
 
-        obj = json.loads(decoded_string)
-        if 'version' in obj['metadata']['language_info']:
-            del obj['metadata']['language_info']['version']
+    reporter = ProgressReporter(len(filepaths), args.verbose)
+    num_errors = 0
 
-        json_str = json.dumps(
-            obj=obj,
-            ensure_ascii=False,
-            indent='\t',
-        )
+    for filepath, format_result in format_results:
+        filesize = format_result.get('filesize', 0)
 
-        if not json_str[-1] == '\n':
-            json_str += '\n'
+        if 'error' in format_result:
+            num_errors += 1
+            reporter.update(filepath, 'error', f'- {TermColor.FG_BRIGHT_RED}{format_result["error"]}{TermColor.RESET_COLOR}', filesize)
+            continue
 
-        encoded_content = json_str.encode(Encoding.UTF8)
+        if format_result.get('ignored', False):
+            reporter.update(filepath, 'skipped', f'- {TermColor.FG_BRIGHT_YELLOW}SKIP{TermColor.RESET_COLOR}')
+            continue
 
-        if encoded_content == bs:
-            if args.verbose:
-                print(f'{TermColor.FG_BRIGHT_GREEN}OK{TermColor.RESET_COLOR}')
-            else:
-                print('\r', end='')
+        if not format_result['diff']:
+            reporter.update(filepath, 'ok', f'{TermColor.FG_BRIGHT_GREEN}OK{TermColor.RESET_COLOR}', filesize)
         else:
             if args.run:
-                os.remove(filepath)  # file content may not be changed if we don't remove it
-                with open(filepath, mode='wb') as outfile:
-                    outfile.write(encoded_content)
-
-                print(f'{TermColor.FG_RED}x{TermColor.RESET_COLOR} -> {TermColor.FG_BRIGHT_GREEN}OK{TermColor.RESET_COLOR}')
+                reporter.update(filepath, 'fixed', f'{TermColor.FG_RED}x{TermColor.RESET_COLOR} -> {TermColor.FG_BRIGHT_GREEN}OK{TermColor.RESET_COLOR}', filesize)
             else:
-                print(f'{TermColor.FG_RED}x{TermColor.RESET_COLOR}')
+                reporter.update(filepath, 'changed', f'{TermColor.FG_RED}x{TermColor.RESET_COLOR}', filesize)
+
+    reporter.close()
+
+    if args.stats:
+        TRACER.print_stats()
+
+    if args.trace is not None:
+        TRACER.write_trace(args.trace)
+
+    if num_errors > 0:
+        sys.exit(-1)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,31 @@
 #!/usr/bin/env python3
 # encoding=utf-8
 import os
+import re
+import codecs
 import sys
 import subprocess
 import argparse
 import urllib.request
+import urllib.error
 import traceback
+import typing
+import json
+import time
+import collections
+import struct
+import shutil
+import hashlib
+import statistics
+import heapq
+import queue
+import threading
+import concurrent.futures
 
 
 GJF_BINARIES_ROOT_ENVIRONMENT_VARIABLE_NAME = 'GJF_BINARIES_ROOT'
+# expected SHA-256 of the jar, overrides `GJF_BIN_SHA256_DICT`
+GJF_BIN_SHA256_ENVIRONMENT_VARIABLE_NAME = 'GJF_BIN_SHA256'
 
 IGNORED_FILES = [
     '.git',  # git directory
@@ -42,79 +59,359 @@ class Encoding:
     UTF8 = 'utf-8'
     UTF8_WITH_BOM = 'utf-8-sig'
     UTF16 = 'utf-16'
+    UTF16_LE = 'utf-16-le'
+    UTF16_BE = 'utf-16-be'
     GB2312 = 'gb2312'
     SHIFT_JIS = 'shift-jis'
 
+    # only the beginning of the content is scanned to rank the encodings
+    SAMPLE_SIZE = 64 * 1024
+
     @classmethod
-    def decode(cls, bs: bytes):
-        try:
-            encoding = cls.UTF8_WITH_BOM
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+    def detect(cls, bs: bytes):
+        # Return `[(encoding, confidence), ...]` with the most likely encoding first.
+        # The sample is validated once per candidate and each validation stops at the first invalid byte.
+        # An empty list means that the content is binary.
+        candidate_list, _ = cls.scan(bs)
+        return candidate_list
 
-        try:
-            encoding = cls.UTF8
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+    @classmethod
+    def scan(cls, bs: bytes):
+        # Return `(candidate_list, decoded_content)`.
+        # `decoded_content` is not None if the whole content fits in the sample and is already decoded.
+        sample = bs[:cls.SAMPLE_SIZE]
+        is_truncated = (len(bs) > len(sample))
+
+        if sample.startswith(b'\xef\xbb\xbf'):
+            return [(cls.UTF8_WITH_BOM, 1.0)], None
+
+        if sample.startswith((b'\xff\xfe', b'\xfe\xff')):
+            return [(cls.UTF16, 1.0)], None
+
+        num_nul = sample.count(0)
+        if num_nul > 0:
+            # UTF-16 text without BOM has a NUL byte next to every ASCII character
+            num_even_nul = sample[0::2].count(0)
+            num_odd_nul = num_nul - num_even_nul
+            num_pairs = len(sample) // 2
+
+            if (len(bs) % 2 == 0) and (num_nul * 4 >= num_pairs):
+                if num_odd_nul > num_even_nul * 4:
+                    return [(cls.UTF16_LE, 0.9)], None
+
+                if num_even_nul > num_odd_nul * 4:
+                    return [(cls.UTF16_BE, 0.9)], None
+
+            return [], None
+
+        if sample.isascii():
+            if not is_truncated:
+                return [(cls.UTF8, 1.0)], None
+
+            # ASCII is valid in every candidate, the rest of the content decides
+            return [(cls.UTF8, 0.9), (cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)], None
+
+        candidate_list = []
+        for encoding, confidence in (
+            (cls.UTF8, 0.99),
+            (cls.GB2312, 0.6),
+            (cls.SHIFT_JIS, 0.5),
+        ):
+            # the incremental decoder validates in a single pass and stops at the first invalid byte,
+            # a multi-byte character cut at the end of a truncated sample is not an error
+            try:
+                decoded_sample = codecs.getincrementaldecoder(encoding)().decode(sample, final=(not is_truncated))
+            except UnicodeDecodeError:
+                continue
 
-        try:
-            encoding = cls.UTF16
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+            if not is_truncated:
+                # the sample is the whole content
+                return [(encoding, confidence)], decoded_sample
 
-        try:
-            encoding = cls.GB2312
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+            candidate_list.append((encoding, confidence))
 
-        try:
-            encoding = cls.SHIFT_JIS
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+            if encoding == cls.UTF8:
+                # Valid multi-byte UTF-8 sequences are very unlikely in other encodings,
+                # so they are not checked against the sample. They are still tried if the rest of the content is not UTF-8.
+                candidate_list.extend([(cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)])
+                break
+
+        return candidate_list, None
+
+    @classmethod
+    def decode(cls, bs: bytes):
+        # The content is decoded once with the most likely encoding.
+        # The next candidate is only tried if the content after the sample is invalid.
+        candidate_list, decoded_content = cls.scan(bs)
+        if decoded_content is not None:
+            return candidate_list[0][0], decoded_content
+
+        for encoding, _ in candidate_list:
+            try:
+                decoded_content = str(bs, encoding)
+                return encoding, decoded_content
+            except UnicodeDecodeError:
+                continue
 
         return None, bs
 
 
-def find_all_java_files(infile: str, out_list: list):
-    basename = os.path.basename(infile)
-    if basename.lower() in IGNORED_FILES:
+class NullSpan:
+    # returned by a disabled `Tracer`, the instrumented code does not need to check if tracing is enabled
+    num_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class TraceSpan:
+    __slots__ = ('span_list', 'phase', 'filepath', 'num_bytes', 'start_ns')
+
+    def __init__(self, span_list: list, phase: str, filepath: str):
+        self.span_list = span_list
+        self.phase = phase
+        self.filepath = filepath
+        # bytes read or written in this phase
+        self.num_bytes = 0
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        self.span_list.append((self.phase, self.filepath, self.start_ns, duration_ns, self.num_bytes, threading.get_ident()))
+        return False
+
+
+class Tracer:
+    # Per-phase timing for `--stats` and `--trace`.
+    # A span is recorded as `(phase, filepath, start_ns, duration_ns, num_bytes, thread_id)`,
+    # the worker threads append to the same list (`list.append` is atomic).
+
+    def __init__(self):
+        self.enabled = False
+        self.span_list = []
+
+    def span(self, phase: str, filepath: str = None):
+        if not self.enabled:
+            return NULL_SPAN
+
+        return TraceSpan(self.span_list, phase, filepath)
+
+    def print_stats(self, file=sys.stderr):
+        duration_dict = collections.defaultdict(list)
+        bytes_dict = collections.defaultdict(int)
+        for phase, _, _, duration_ns, num_bytes, _ in self.span_list:
+            duration_dict[phase].append(duration_ns)
+            bytes_dict[phase] += num_bytes
+
+        print(f'{"phase":<20} {"count":>8} {"total ms":>12} {"p50 ms":>10} {"p95 ms":>10} {"max ms":>10} {"bytes":>14}', file=file)
+        for phase, duration_list in duration_dict.items():
+            duration_list.sort()
+            count = len(duration_list)
+            p50 = duration_list[(count - 1) // 2]
+            p95 = duration_list[min(count - 1, (count * 95) // 100)]
+            print(
+                f'{phase:<20} {count:>8} {sum(duration_list) / 1e6:>12.3f} {p50 / 1e6:>10.3f}'
+                f' {p95 / 1e6:>10.3f} {duration_list[-1] / 1e6:>10.3f} {bytes_dict[phase]:>14}',
+                file=file,
+            )
+
+    def write_trace(self, outpath: str):
+        # Chrome trace-event format, open with chrome://tracing or https://ui.perfetto.dev
+        origin_ns = min([x[2] for x in self.span_list], default=0)
+
+        event_list = []
+        pid = os.getpid()
+        for phase, filepath, start_ns, duration_ns, num_bytes, thread_id in self.span_list:
+            event_args = {}
+            if filepath is not None:
+                event_args['file'] = filepath
+            if num_bytes > 0:
+                event_args['bytes'] = num_bytes
+
+            event_list.append({
+                'name': phase,
+                'ph': 'X',
+                'ts': (start_ns - origin_ns) / 1000,
+                'dur': duration_ns / 1000,
+                'pid': pid,
+                'tid': thread_id,
+                'args': event_args,
+            })
+
+        # non-UTF-8 file names are escaped
+        with open(outpath, mode='w', encoding='utf-8') as outfile:
+            json.dump({'traceEvents': event_list, 'displayTimeUnit': 'ms'}, outfile)
+
+
+TRACER = Tracer()
+
+
+class ProgressReporter:
+    # Status lines are buffered so the formatter threads are not slowed down by the terminal.
+    # On a TTY a progress line (files/s, bytes/s, ETA) is redrawn at most every `REDRAW_INTERVAL` seconds.
+    # Only changed or failed files are printed (every file with `verbose`), followed by a summary.
+
+    REDRAW_INTERVAL = 0.1  # seconds
+    MAX_PENDING_LINES = 256
+
+    # statuses that are always printed
+    REPORTED_STATUSES = ('changed', 'fixed', 'error')
+
+    def __init__(self, total_files: int, verbose: bool = False):
+        self.file = sys.stdout
+        self.is_tty = self.file.isatty()
+        self.verbose = verbose
+        self.total_files = total_files
+
+        self.num_files = 0
+        self.num_bytes = 0
+        self.status_counter = collections.Counter()
+        self.pending_lines = []
+        self.has_progress_line = False
+        self.start_time = time.monotonic()
+        self.last_flush_time = self.start_time
+
+    def update(self, filepath: str, status: str, message: str = '', num_bytes: int = 0):
+        # `status` is one of 'ok', 'skipped', 'changed', 'fixed' or 'error'
+        self.num_files += 1
+        self.num_bytes += num_bytes
+        self.status_counter[status] += 1
+
+        if (status in self.REPORTED_STATUSES) or self.verbose:
+            self.pending_lines.append(f'> {filepath} {message}')
+
+        now = time.monotonic()
+        if (len(self.pending_lines) >= self.MAX_PENDING_LINES) or ((now - self.last_flush_time) >= self.REDRAW_INTERVAL):
+            self.flush(now)
+
+    def format_progress(self, now: float):
+        elapsed = max(now - self.start_time, 1e-9)
+        files_per_second = self.num_files / elapsed
+        mb_per_second = self.num_bytes / (1024 * 1024) / elapsed
+
+        if files_per_second > 0:
+            eta = f'{(self.total_files - self.num_files) / files_per_second:.0f}s'
+        else:
+            eta = '?'
+
+        return f'{self.num_files}/{self.total_files} files {files_per_second:.0f} files/s {mb_per_second:.1f} MB/s ETA {eta}'
+
+    def flush(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+
+        parts = []
+        if self.has_progress_line:
+            # erase the progress line before the status lines are written over it
+            parts.append('\r\033[K')
+            self.has_progress_line = False
+
+        for line in self.pending_lines:
+            parts.append(line)
+            parts.append('\n')
+        self.pending_lines = []
+
+        if self.is_tty:
+            parts.append(self.format_progress(now))
+            self.has_progress_line = True
+
+        if len(parts) > 0:
+            self.file.write(''.join(parts))
+            self.file.flush()
+
+        self.last_flush_time = now
+
+    def close(self):
+        now = time.monotonic()
+        self.is_tty = False
+        self.flush(now)
+
+        count_str = ', '.join([f'{count} {status}' for status, count in self.status_counter.items()])
+        if len(count_str) > 0:
+            count_str = f' ({count_str})'
+
+        self.file.write(f'{self.num_files} files{count_str} in {now - self.start_time:.2f}s\n')
+        self.file.flush()
+
+
+def iter_java_files(infile: str) -> typing.Iterator[str]:
+    # iterative so deep package directories cannot hit the recursion limit
+    if os.path.basename(infile).lower() in IGNORED_FILES:
+        return
+
+    if not os.path.isdir(infile):
+        if os.path.isfile(infile) and (os.path.splitext(infile)[1].lower() == '.java'):
+            yield infile
         return
 
-    if os.path.isfile(infile):
-        ext = os.path.splitext(basename)[1].lower()
-        if ext == '.java':
-            out_list.append(infile)
-    elif os.path.isdir(infile):
-        flist = os.listdir(infile)
-        for fname in flist:
-            fpath = os.path.join(infile, fname)
-            find_all_java_files(infile=fpath, out_list=out_list)
+    dirpath_stack = [infile]
+    while len(dirpath_stack) > 0:
+        with os.scandir(dirpath_stack.pop()) as entry_iter:
+            for entry in entry_iter:
+                if entry.name.lower() in IGNORED_FILES:
+                    continue
+
+                if entry.is_dir():
+                    dirpath_stack.append(entry.path)
+                elif entry.is_file() and (os.path.splitext(entry.name)[1].lower() == '.java'):
+                    yield entry.path
+
+
+def find_all_java_files(infile: str, out_list: list):
+    out_list.extend(iter_java_files(infile))
+
+
+def get_git_list_files_args(since: str = None, staged: bool = False):
+    if (since is None) and (not staged):
+        return ['git', '-c', 'core.quotepath=off', 'ls-files']
+
+    # Only the files that are added, copied, modified or renamed relative to `since` (or HEAD with `staged`).
+    # A renamed file is listed with its new path. Rename detection is skipped because the new path of
+    # an undetected rename is still listed as added.
+    args = [
+        'git',
+        '-c', 'core.quotepath=off',
+        'diff',
+        '--name-only',
+        '--relative',
+        '--no-renames',
+        '--diff-filter=ACMR',
+    ]
+
+    if staged:
+        args.append('--cached')
+
+    if since is not None:
+        if since.startswith('-'):
+            # `since` is placed before `--` so git would read it as an option
+            raise Exception(f'Invalid git revision: {since!r}')
+
+        args.append(since)
+
+    args.append('--')
+    return args
 
 
-def find_java_files_tracked_by_git(infile: str):
+def find_java_files_tracked_by_git(infile: str, since: str = None, staged: bool = False):
     git_process = subprocess.run(
-        args=['git', 'ls-files'],
+        args=get_git_list_files_args(since, staged),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         cwd=os.path.abspath(infile),
     )
 
-    if (len(git_process.stderr) > 0) or (git_process.returncode != 0):
+    # git prints warnings (e.g. about line endings under `text=auto`) on stderr, only the returncode tells a failure
+    if git_process.returncode != 0:
         _, error_msg = Encoding.decode(git_process.stderr)
 
         if type(error_msg) is bytes:
@@ -186,28 +483,608 @@ def ensure_extractly_one_empty_line_at_the_end(s: str):
     return s
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        'infile',
-        default='.',
-        action='store',
-        nargs='?',
-        help=(
-            'Specify file for directory to format.'
-            ' If a file is specified,'
-            ' then the --git and --nogit options are ignored.'
-        ),
+GJF_BIN_URL = 'https://github.com/google/google-java-format/releases/download/google-java-format-1.9/google-java-format-1.9-all-deps.jar'
+
+# `url: sha256` of the jars that can be downloaded without setting `GJF_BIN_SHA256_ENVIRONMENT_VARIABLE_NAME`.
+# A jar is never downloaded without a pinned hash, a jar that is already in the cache is used as is.
+GJF_BIN_SHA256_DICT = {
+}
+
+GJF_ARGS = ['--aosp', '--skip-reflowing-long-strings']
+
+# The persistent worker is launched as a single-file source program (Java 11+) with the jar on the class path.
+# Every request is a big-endian int32 length followed by the file content.
+# Every response is the int32 exit code of the formatter followed by the length-prefixed stdout and stderr.
+GJF_WORKER_CLASS_NAME = 'GjfWorker'
+
+GJF_WORKER_SOURCE = r'''
+import com.google.googlejavaformat.java.Main;
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStreamWriter;
+import java.io.PrintWriter;
+import java.nio.charset.StandardCharsets;
+
+public class GjfWorker {
+    static final int READY = 0x474a4657;
+
+    static void writeFrame(DataOutputStream out, byte[] bs) throws IOException {
+        out.writeInt(bs.length);
+        out.write(bs);
+    }
+
+    public static void main(String[] args) throws IOException {
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+        // anything printed by the formatter must not end up in the response frames
+        System.setOut(System.err);
+
+        out.writeInt(READY);
+        out.flush();
+
+        while (true) {
+            int length;
+            try {
+                length = in.readInt();
+            } catch (EOFException ex) {
+                break;
+            }
+
+            byte[] content = new byte[length];
+            in.readFully(content);
+
+            ByteArrayOutputStream outBuffer = new ByteArrayOutputStream();
+            ByteArrayOutputStream errBuffer = new ByteArrayOutputStream();
+            PrintWriter outWriter = new PrintWriter(new OutputStreamWriter(outBuffer, StandardCharsets.UTF_8));
+            PrintWriter errWriter = new PrintWriter(new OutputStreamWriter(errBuffer, StandardCharsets.UTF_8));
+
+            int returncode;
+            try {
+                returncode = new Main(outWriter, errWriter, new ByteArrayInputStream(content)).format(args);
+            } catch (Exception ex) {
+                ex.printStackTrace(errWriter);
+                returncode = 1;
+            }
+
+            outWriter.flush();
+            errWriter.flush();
+
+            out.writeInt(returncode);
+            writeFrame(out, outBuffer.toByteArray());
+            writeFrame(out, errBuffer.toByteArray());
+            out.flush();
+        }
+    }
+}
+'''
+
+GJF_WORKER_READY = 0x474a4657
+
+
+def get_gjf_binaries_root():
+    if GJF_BINARIES_ROOT_ENVIRONMENT_VARIABLE_NAME in os.environ:
+        return os.environ[GJF_BINARIES_ROOT_ENVIRONMENT_VARIABLE_NAME]
+
+    tmp_dir_value = os.path.dirname(os.path.abspath(__file__))
+    print(f'{GJF_BINARIES_ROOT_ENVIRONMENT_VARIABLE_NAME} is not set. Using {tmp_dir_value} to store the binary.')
+    return tmp_dir_value
+
+
+FETCH_CHUNK_SIZE = 64 * 1024
+FETCH_TIMEOUT = 30  # seconds
+FETCH_NUM_ATTEMPTS = 3
+
+
+def get_file_sha256(filepath: str):
+    digest = hashlib.sha256()
+    with open(filepath, mode='rb') as infile:
+        while True:
+            chunk = infile.read(FETCH_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            digest.update(chunk)
+    return digest
+
+
+def get_expected_num_bytes(res, offset: int):
+    # the number of bytes that the response body must have, None if the server did not tell
+    if res.status == 206:
+        # `Content-Range: bytes <first>-<last>/<total>`
+        content_range = res.headers.get('Content-Range', '')
+        match = re.fullmatch(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', content_range.strip())
+        if match is None:
+            raise urllib.error.URLError(f'Invalid Content-Range: {content_range!r}')
+
+        first_byte_idx = int(match.group(1))
+        if first_byte_idx != offset:
+            raise urllib.error.URLError(f'Requested bytes from {offset}, received from {first_byte_idx}')
+
+        return int(match.group(2)) - first_byte_idx + 1
+
+    content_length = res.headers.get('Content-Length')
+    if content_length is None:
+        return None
+
+    return int(content_length)
+
+
+def download_to_part_file(url: str, part_filepath: str):
+    # Append the rest of `url` to `part_filepath` in chunks, resuming from its current size with a Range request.
+    # Return the SHA-256 digest of the whole file.
+    # A body that is shorter than announced raises `urllib.error.ContentTooShortError` and the part is kept for resuming.
+    while True:
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part_filepath):
+            digest = get_file_sha256(part_filepath)
+            offset = os.path.getsize(part_filepath)
+
+        request = urllib.request.Request(url)
+        if offset > 0:
+            request.add_header('Range', f'bytes={offset}-')
+
+        try:
+            res = urllib.request.urlopen(request, timeout=FETCH_TIMEOUT)
+            break
+        except urllib.error.HTTPError as ex:
+            if (ex.code != 416) or (offset == 0):
+                raise
+
+            # the partial file is not a prefix of the artifact (e.g. it changed on the server), start over
+            os.remove(part_filepath)
+
+    with res:
+        if (offset > 0) and (res.status != 206):
+            # the server ignored the Range header and sends the whole file
+            digest = hashlib.sha256()
+            offset = 0
+
+        expected_num_bytes = get_expected_num_bytes(res, offset)
+        num_bytes = 0
+
+        with TRACER.span('download') as span:
+            with open(part_filepath, mode=('ab' if offset > 0 else 'wb')) as outfile:
+                while True:
+                    chunk = res.read(FETCH_CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    outfile.write(chunk)
+                    digest.update(chunk)
+                    num_bytes += len(chunk)
+                    span.num_bytes += len(chunk)
+
+        if (expected_num_bytes is not None) and (num_bytes < expected_num_bytes):
+            raise urllib.error.ContentTooShortError(
+                f'Received {num_bytes} of {expected_num_bytes} bytes from {url}',
+                None,
+            )
+
+    return digest
+
+
+def fetch_artifact(url: str, filepath: str, expected_sha256: str, offline: bool = False):
+    # Make sure that `filepath` is a copy of `url` with the SHA-256 `expected_sha256`.
+    # The download goes to `<filepath>.part` and is renamed when it is complete and its SHA-256 matches,
+    # so an interrupted download never leaves a corrupt `filepath` and is resumed by the next attempt.
+    expected_sha256 = expected_sha256.lower()
+
+    if os.path.exists(filepath):
+        with TRACER.span('verify', filepath):
+            actual_sha256 = get_file_sha256(filepath).hexdigest()
+
+        if actual_sha256 == expected_sha256:
+            return filepath
+
+        print(f'{filepath} does not match SHA-256 {expected_sha256}, removing it', file=sys.stderr)
+        os.remove(filepath)
+
+    if offline:
+        raise Exception(f'{filepath} is not in the cache and --offline is set')
+
+    dirpath = os.path.dirname(filepath)
+    if (len(dirpath) > 0) and (not os.path.exists(dirpath)):
+        os.makedirs(dirpath)
+
+    print(f'Downloading {url}')
+    for attempt_idx in range(FETCH_NUM_ATTEMPTS):
+        try:
+            actual_sha256 = download_to_part_file(url, part_filepath=filepath + '.part').hexdigest()
+            break
+        except (urllib.error.URLError, OSError) as ex:
+            # the partial file is kept and resumed
+            if attempt_idx == (FETCH_NUM_ATTEMPTS - 1):
+                raise
+            print(f'Download failed ({ex}), retrying...', file=sys.stderr)
+            time.sleep(2 ** attempt_idx)
+
+    if actual_sha256 != expected_sha256:
+        os.remove(filepath + '.part')
+        raise Exception(f'SHA-256 of {url} is {actual_sha256}, expected {expected_sha256}')
+
+    os.replace(filepath + '.part', filepath)
+    return filepath
+
+
+def download_gjf_bin(tmp_dir_value: str, gjf_bin_url: str = GJF_BIN_URL, offline: bool = False):
+    gjf_bin_filename = gjf_bin_url.split('/')[-1]
+    gjf_bin_filepath = os.path.join(tmp_dir_value, gjf_bin_filename)
+
+    print('gjf_bin_filepath: ' + gjf_bin_filepath)
+
+    expected_sha256 = os.environ.get(GJF_BIN_SHA256_ENVIRONMENT_VARIABLE_NAME, GJF_BIN_SHA256_DICT.get(gjf_bin_url))
+    if expected_sha256 is None:
+        # a jar that is already in the cache was put there by the user (or by an earlier verified download),
+        # only a new download needs a pinned hash
+        if os.path.exists(gjf_bin_filepath):
+            print(f'No SHA-256 is pinned for {gjf_bin_url}, using the cached jar without verifying it', file=sys.stderr)
+            return gjf_bin_filepath
+
+        raise Exception(f'No SHA-256 is pinned for {gjf_bin_url}, set {GJF_BIN_SHA256_ENVIRONMENT_VARIABLE_NAME} to the SHA-256 of the published jar')
+
+    return fetch_artifact(
+        gjf_bin_url,
+        gjf_bin_filepath,
+        expected_sha256,
+        offline,
     )
 
-    parser.add_argument('--git', help='use git to list tracked files')
-    parser.add_argument('--nogit', help='force disable git detection', action='store_true')
-    parser.add_argument('--run', action='store_true')
-    parser.add_argument('--verbose', '-v', action='store_true')
 
-    args = parser.parse_args()
-    print(args)
+def write_gjf_worker_source(tmp_dir_value: str):
+    # The source is stored next to the jar and only rewritten if it changed.
+    worker_source_filepath = os.path.join(tmp_dir_value, GJF_WORKER_CLASS_NAME + '.java')
+    worker_source_bs = GJF_WORKER_SOURCE.encode('utf-8')
+
+    if os.path.exists(worker_source_filepath):
+        with open(worker_source_filepath, mode='rb') as infile:
+            if infile.read() == worker_source_bs:
+                return worker_source_filepath
 
+    with open(worker_source_filepath, mode='wb') as outfile:
+        outfile.write(worker_source_bs)
+
+    return worker_source_filepath
+
+
+def run_gjf_process(gjf_bin_filepath: str, fpath: str, cwd: str, jvm_args: typing.List[str] = None):
+    # one JVM for one file
+    gjf_process = subprocess.run(
+        args=[
+            'java',
+            *(jvm_args or []),
+            '-jar',
+            gjf_bin_filepath,
+            *GJF_ARGS,
+            # `fpath` may be relative to the current directory instead of `cwd`
+            os.path.abspath(fpath),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+    )
+
+    return gjf_process.returncode, gjf_process.stdout, gjf_process.stderr
+
+
+class GjfWorker:
+    # One long-lived JVM that keeps the google-java-format classes loaded and JIT-compiled between files.
+
+    def __init__(self, gjf_bin_filepath: str, worker_source_filepath: str, cwd: str, jvm_args: typing.List[str] = None):
+        self.cmd = [
+            'java',
+            *(jvm_args or []),
+            '-cp',
+            gjf_bin_filepath,
+            worker_source_filepath,
+            *GJF_ARGS,
+            '-',
+        ]
+        self.cwd = cwd
+        self.process = None
+
+    def read_exact(self, size: int):
+        bs = self.process.stdout.read(size)
+        if len(bs) != size:
+            raise EOFError('google-java-format worker exited')
+        return bs
+
+    def read_frame(self):
+        size, = struct.unpack('>i', self.read_exact(4))
+        return self.read_exact(size)
+
+    def start(self):
+        # Return False if the worker cannot be started, e.g. Java 8 cannot run a source file.
+        try:
+            self.process = subprocess.Popen(
+                self.cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                cwd=self.cwd,
+            )
+
+            ready, = struct.unpack('>i', self.read_exact(4))
+            return ready == GJF_WORKER_READY
+        except (OSError, EOFError):
+            return False
+
+    def request(self, content_bs: bytes):
+        # Return `(returncode, stdout, stderr)` or None if the worker died.
+        try:
+            self.process.stdin.write(struct.pack('>i', len(content_bs)))
+            self.process.stdin.write(content_bs)
+            self.process.stdin.flush()
+
+            returncode, = struct.unpack('>i', self.read_exact(4))
+            stdout = self.read_frame()
+            stderr = self.read_frame()
+            return returncode, stdout, stderr
+        except (OSError, EOFError):
+            return None
+
+    def close(self):
+        # Return the exit code of the worker (None if it was not started).
+        if self.process is None:
+            return None
+
+        try:
+            # the worker exits at the end of its input
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+        try:
+            # the class data sharing archive is written at exit
+            returncode = self.process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            returncode = self.process.wait()
+
+        self.process.stdout.close()
+        self.process = None
+        return returncode
+
+
+class JavaFormatter:
+    # Formats with a `GjfWorker` and restarts it if it crashes.
+    # A file that crashes the worker twice, or every file if the worker cannot be started,
+    # is formatted with one JVM per file like before.
+
+    MAX_WORKER_STARTS = 8
+
+    def __init__(self, gjf_bin_filepath: str, worker_source_filepath: str, cwd: str, jvm_args: typing.List[str] = None):
+        self.gjf_bin_filepath = gjf_bin_filepath
+        self.worker_source_filepath = worker_source_filepath
+        self.cwd = os.path.abspath(cwd)
+        self.jvm_args = jvm_args
+        self.worker = None
+        # None disables the worker
+        self.num_worker_starts = 0 if (worker_source_filepath is not None) else None
+
+    def get_worker(self):
+        if (self.worker is not None) or (self.num_worker_starts is None):
+            return self.worker
+
+        if self.num_worker_starts >= self.MAX_WORKER_STARTS:
+            print('google-java-format worker keeps crashing, falling back to one JVM per file', file=sys.stderr)
+            self.num_worker_starts = None
+            return None
+
+        self.num_worker_starts += 1
+        worker = GjfWorker(self.gjf_bin_filepath, self.worker_source_filepath, self.cwd, self.jvm_args)
+        with TRACER.span('worker_start'):
+            is_started = worker.start()
+
+        if not is_started:
+            worker.close()
+            print('Cannot start the google-java-format worker (Java 11+ is required), falling back to one JVM per file', file=sys.stderr)
+            self.num_worker_starts = None
+            return None
+
+        self.worker = worker
+        return worker
+
+    def format(self, fpath: str, content_bs: bytes):
+        # Return `(returncode, stdout, stderr)` of google-java-format.
+        for _ in range(2):
+            worker = self.get_worker()
+            if worker is None:
+                break
+
+            result = worker.request(content_bs)
+            if result is not None:
+                return result
+
+            # crashed on this file (e.g. out of memory), retry once with a new worker
+            worker.close()
+            self.worker = None
+
+        return run_gjf_process(self.gjf_bin_filepath, fpath, self.cwd, self.jvm_args)
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
+
+
+# Formatted once by the training run that creates the class data sharing archive,
+# so the archive contains the classes that are loaded for a typical file.
+GJF_SAMPLE_SOURCE = r"""
+package com.example.sample;
+
+import java.io.IOException;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.Map;
+import java.util.function.Function;
+
+/** Sample. */
+@SuppressWarnings("unchecked")
+public class Sample<T extends Comparable<T>> implements Runnable {
+  private static final String MESSAGE = "a long string literal that is not reflowed " + "by the formatter";
+  private final List<T> items = new ArrayList<>();
+  enum Kind { A, B, C }
+
+  public Sample(List<T> items) { this.items.addAll(items); }
+
+  @Override
+  public void run() {
+    for (int i = 0; i < items.size(); i++) {
+      if (i % 2 == 0 && items.get(i) != null) { System.out.println(items.get(i)); } else { continue; }
+    }
+    items.stream().map(x -> x.toString()).filter(x -> !x.isEmpty()).forEach(System.out::println);
+    switch (Kind.A) {
+      case A: break;
+      default: throw new IllegalStateException(MESSAGE);
+    }
+  }
+
+  <R> R apply(Function<? super T, ? extends R> function, Map<String, int[]> unused) throws IOException {
+    try { return function.apply(items.get(0)); } catch (RuntimeException ex) { throw new IOException(ex); } finally { items.clear(); }
+  }
+}
+"""
+
+
+def get_cds_archive_filepath(tmp_dir_value: str, gjf_bin_filepath: str):
+    # An archive only works with the JVM that created it and the same class path,
+    # its name changes when the JVM, the jar or the worker is replaced.
+    # Return None if java is not found.
+    java_filepath = shutil.which('java')
+    if java_filepath is None:
+        return None
+
+    digest = hashlib.sha1()
+    for filepath in (os.path.realpath(java_filepath), os.path.abspath(gjf_bin_filepath)):
+        stat_result = os.stat(filepath)
+        digest.update(f'{filepath}\0{stat_result.st_size}\0{stat_result.st_mtime_ns}\0'.encode('utf-8', 'surrogateescape'))
+    digest.update(GJF_WORKER_SOURCE.encode('utf-8'))
+
+    archive_name = os.path.splitext(os.path.basename(gjf_bin_filepath))[0]
+    return os.path.join(tmp_dir_value, f'{archive_name}-{digest.hexdigest()[:16]}.jsa')
+
+
+def get_cds_jvm_args(archive_filepath: str):
+    # `-Xshare:auto` (the default) ignores an archive that cannot be mapped,
+    # `-Xlog:disable` keeps the warnings about it out of the formatter stderr
+    return [f'-XX:SharedArchiveFile={archive_filepath}', '-Xlog:disable']
+
+
+def is_cds_dump_supported(probe_filepath: str):
+    # Return False if the JVM rejects `-XX:ArchiveClassesAtExit` (before JDK 13),
+    # None if the probe does not tell (e.g. it timed out).
+    try:
+        completed_process = subprocess.run(
+            ['java', f'-XX:ArchiveClassesAtExit={probe_filepath}', '-version'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=60,
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    finally:
+        if os.path.exists(probe_filepath):
+            os.remove(probe_filepath)
+
+    if b'Unrecognized VM option' in completed_process.stderr:
+        return False
+
+    if completed_process.returncode != 0:
+        return None
+
+    return True
+
+
+def create_cds_archive(archive_filepath: str, gjf_bin_filepath: str, worker_source_filepath: str):
+    # Return True if the archive exists or is created by a training run of the worker (JDK 13+).
+    # A JVM that rejects the option leaves a `.unsupported` marker so it is not tried on every run,
+    # delete the marker to try again. Other failures (e.g. a full disk) are retried on the next run.
+    if os.path.exists(archive_filepath):
+        return True
+
+    unsupported_filepath = archive_filepath + '.unsupported'
+    if os.path.exists(unsupported_filepath):
+        return False
+
+    print('Creating class data sharing archive: ' + archive_filepath)
+
+    # concurrent runs do not see a partial archive
+    tmp_archive_filepath = f'{archive_filepath}.{os.getpid()}.tmp'
+    worker = GjfWorker(
+        gjf_bin_filepath,
+        worker_source_filepath,
+        os.path.dirname(archive_filepath),
+        [f'-XX:ArchiveClassesAtExit={tmp_archive_filepath}', '-Xlog:disable'],
+    )
+
+    with TRACER.span('cds_archive'):
+        is_created = worker.start() and (worker.request(GJF_SAMPLE_SOURCE.encode('utf-8')) is not None)
+        returncode = worker.close()
+
+    if is_created and (returncode == 0) and os.path.exists(tmp_archive_filepath):
+        os.replace(tmp_archive_filepath, archive_filepath)
+        return True
+
+    if os.path.exists(tmp_archive_filepath):
+        os.remove(tmp_archive_filepath)
+
+    if is_cds_dump_supported(f'{archive_filepath}.{os.getpid()}.probe') is False:
+        with open(unsupported_filepath, mode='wb'):
+            pass
+
+    return False
+
+
+def measure_jvm_startup(
+    gjf_bin_filepath: str,
+    worker_source_filepath: str,
+    archive_filepath: str,
+    num_runs: int = 5,
+):
+    # Print the median time until a new worker is ready and until it has formatted the sample,
+    # without and with the class data sharing archive.
+    sample_bs = GJF_SAMPLE_SOURCE.encode('utf-8')
+    cwd = os.path.dirname(os.path.abspath(gjf_bin_filepath))
+
+    config_list = [('without archive', [])]
+    if archive_filepath is not None:
+        config_list.append(('with archive', get_cds_jvm_args(archive_filepath)))
+
+    print(f'JVM cold start, median of {num_runs} runs')
+    for config_name, jvm_args in config_list:
+        ready_list = []
+        first_file_list = []
+        for _ in range(num_runs):
+            worker = GjfWorker(gjf_bin_filepath, worker_source_filepath, cwd, jvm_args)
+            start_time = time.perf_counter()
+            try:
+                if not worker.start():
+                    raise Exception('Cannot start the google-java-format worker (Java 11+ is required)')
+                ready_list.append(time.perf_counter() - start_time)
+
+                if worker.request(sample_bs) is None:
+                    raise Exception('google-java-format worker exited')
+                first_file_list.append(time.perf_counter() - start_time)
+            finally:
+                worker.close()
+
+        print(
+            f'{config_name:<16}'
+            f' ready {statistics.median(ready_list) * 1000:8.0f} ms'
+            f' first file {statistics.median(first_file_list) * 1000:8.0f} ms'
+        )
+
+
+def find_java_files(args):
+    # Return `(fpath_list, gjf_process_cwd)`.
     fpath_list = []
 
     gjf_process_cwd = ''
@@ -223,16 +1100,16 @@ if __name__ == '__main__':
         # list and append file to the pending list
         if args.nogit:
             find_all_java_files(infile=args.infile, out_list=fpath_list)
-        if args.git:
+        if args.git or (args.since is not None) or args.staged:
             # force to use git to list file
             # fatal error if the directory is not belong to a git repo
-            fpath_list = find_java_files_tracked_by_git(args.infile)
+            fpath_list = find_java_files_tracked_by_git(args.infile, since=args.since, staged=args.staged)
         else:
             # detect git
             try:
                 tmp_fpath_list = find_java_files_tracked_by_git(args.infile)
                 fpath_list = tmp_fpath_list
-            except Exception as ex:
+            except Exception:
                 print()
                 print(TermColor.FG_BRIGHT_RED)
                 print('Failed to use git to list files!')
@@ -244,124 +1121,302 @@ if __name__ == '__main__':
         print('This should not be executed!', file=sys.stderr)
         sys.exit(-1)
 
-    # Download google-java-format binary
+    return fpath_list, gjf_process_cwd
+
+
+def format_java_file(fpath: str, formatter: JavaFormatter, is_run: bool):
+    # Return `(status, message, filesize, error_msg)`.
+    filesize = os.path.getsize(fpath)
+    if filesize == 0:
+        # skip empty file
+        return (
+            'skipped',
+            '- '
+            + TermColor.FG_BRIGHT_YELLOW
+            + 'SKIP_EMPTY'
+            + TermColor.RESET_COLOR,
+            filesize,
+            None,
+        )
 
-    if GJF_BINARIES_ROOT_ENVIRONMENT_VARIABLE_NAME in os.environ:
-        tmp_dir_value = os.environ[GJF_BINARIES_ROOT_ENVIRONMENT_VARIABLE_NAME]
-    else:
-        tmp_dir_value = os.path.dirname(os.path.abspath(__file__))
-        print(f'{GJF_BINARIES_ROOT_ENVIRONMENT_VARIABLE_NAME} is not set. Using {tmp_dir_value} to store the binary.')
+    with TRACER.span('read', fpath) as span:
+        bs = open(fpath, mode='rb').read()
+        span.num_bytes = len(bs)
 
-    # print('tmp_dir_value: ' + tmp_dir_value)
+    with TRACER.span('google-java-format', fpath):
+        returncode, gjf_stdout, gjf_stderr = formatter.format(fpath, bs)
+
+    if (len(gjf_stderr) > 0) or (returncode != 0):
+        _, error_msg = Encoding.decode(gjf_stderr)
+        if type(error_msg) is bytes:
+            error_msg = 'Cannot decode Google Java Format stderr!\n' + str(error_msg)
+
+        return (
+            'error',
+            '',
+            filesize,
+            'Google Java Format failed or exited with non-zero status code!\n'
+            + f'returncode: {returncode}\n'
+            + 'stderr: '
+            + error_msg,
+        )
 
-    gjf_bin_url = 'https://github.com/google/google-java-format/releases/download/google-java-format-1.9/google-java-format-1.9-all-deps.jar'
+    with TRACER.span('decode', fpath):
+        _, formatted_java_code = Encoding.decode(gjf_stdout)
+
+    if type(formatted_java_code) is bytes:
+        return (
+            'error',
+            '',
+            filesize,
+            'Cannot decode Google Java Format stdout!\n'
+            + 'stdout: '
+            + str(formatted_java_code),
+        )
 
-    gjf_bin_filename = gjf_bin_url.split('/')[-1]
+    with TRACER.span('normalize', fpath):
+        formatted_java_code = ensure_lf_line_ending(formatted_java_code)
+        formatted_java_code = remove_trailing_spaces_or_tabs(formatted_java_code)
+        formatted_java_code = remove_leading_empty_lines(formatted_java_code)
+        formatted_java_code = ensure_extractly_one_empty_line_at_the_end(formatted_java_code)
 
-    # print('gjf_bin_filename: ' + gjf_bin_filename)
+        formatted_bs = formatted_java_code.encode('utf-8')
 
-    gjf_bin_filepath = os.path.join(tmp_dir_value, gjf_bin_filename)
+    if bs == formatted_bs:
+        return (
+            'ok',
+            TermColor.FG_BRIGHT_GREEN
+            + 'OK'
+            + TermColor.RESET_COLOR,
+            filesize,
+            None,
+        )
 
-    print('gjf_bin_filepath: ' + gjf_bin_filepath)
+    if is_run:
+        with TRACER.span('write', fpath) as span:
+            span.num_bytes = len(formatted_bs)
+            os.remove(fpath)
+            with open(fpath, mode='wb') as outfile:
+                outfile.write(formatted_bs)
+
+        return (
+            'fixed',
+            TermColor.FG_BRIGHT_RED
+            + 'x'
+            + TermColor.RESET_COLOR
+            + ' -> '
+            + TermColor.FG_BRIGHT_GREEN
+            + 'OK'
+            + TermColor.RESET_COLOR,
+            filesize,
+            None,
+        )
 
-    if not os.path.exists(gjf_bin_filepath):
-        print('Downloading google-java-format binary...')
-        res = urllib.request.urlopen(gjf_bin_url)
-        # TODO handle failed request
-        if not os.path.exists(tmp_dir_value):
-            os.makedirs(tmp_dir_value)
+    return (
+        'changed',
+        TermColor.FG_BRIGHT_RED
+        + 'x'
+        + TermColor.RESET_COLOR,
+        filesize,
+        None,
+    )
 
-        with open(gjf_bin_filepath, mode='wb') as outfile:
-            outfile.write(res.read())
 
+def shard_by_size(fpath_list: typing.List[str], num_shards: int):
+    # Return `[[index, ...], ...]` with at most `num_shards` shards of similar total size.
+    # The largest files are assigned first, each to the shard with the fewest bytes so far.
+    # A shard keeps the input order so its early files can be reported while it is still running.
+    size_list = []
     for fpath in fpath_list:
-        print('>', fpath, end=' ')
-        filesize = os.path.getsize(fpath)
-        if filesize == 0:
-            # skip empty file
-            if args.verbose:
-                print((
-                    '- '
-                    + TermColor.FG_BRIGHT_YELLOW
-                    + 'SKIP_EMPTY'
-                    + TermColor.RESET_COLOR
-                ),)
-            else:
-                print('\r', end='')
-                continue
+        try:
+            size_list.append(os.path.getsize(fpath))
+        except OSError:
+            # reported as an error by `format_java_file`
+            size_list.append(0)
+
+    shard_list = [[] for _ in range(num_shards)]
+    shard_heap = [(0, shard_idx) for shard_idx in range(num_shards)]
+
+    for fpath_idx in sorted(range(len(fpath_list)), key=lambda x: size_list[x], reverse=True):
+        total_size, shard_idx = heapq.heappop(shard_heap)
+        shard_list[shard_idx].append(fpath_idx)
+        # every file costs a round trip even if it is empty
+        heapq.heappush(shard_heap, (total_size + size_list[fpath_idx] + 1, shard_idx))
+
+    for index_list in shard_list:
+        index_list.sort()
+
+    return [x for x in shard_list if len(x) > 0]
+
+
+def try_format_java_file(fpath: str, formatter: JavaFormatter, is_run: bool):
+    # a file that cannot be read or written is reported instead of stopping the other files
+    try:
+        return format_java_file(fpath, formatter, is_run)
+    except Exception:
+        return 'error', '', 0, traceback.format_exc()
+
+
+def iterate_format_results(
+    fpath_list: typing.List[str],
+    create_formatter: typing.Callable[[], JavaFormatter],
+    is_run: bool,
+    jobs: int = 1,
+):
+    # yield `(fpath, (status, message, filesize, error_msg))` in the same order as `fpath_list`
+    if jobs <= 1:
+        formatter = create_formatter()
+        try:
+            for fpath in fpath_list:
+                yield fpath, try_format_java_file(fpath, formatter, is_run)
+        finally:
+            formatter.close()
+        return
 
-        bs = open(fpath, mode='rb').read()
-        gjf_process = subprocess.run(
-            args=[
-                'java',
-                '-jar',
-                gjf_bin_filepath,
-                '--aosp',
-                '--skip-reflowing-long-strings',
-                fpath,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=os.path.abspath(gjf_process_cwd),
-        )
+    # One formatter (and JVM) per shard, a thread only waits for its JVM.
+    # The results are held back until every earlier file is done.
+    result_queue = queue.Queue()
+    stop_event = threading.Event()
 
-        if (len(gjf_process.stderr) > 0) or (gjf_process.returncode != 0):
-            print(TermColor.FG_BRIGHT_RED, end='', file=sys.stderr)
-            print('\nGoogle Java Format failed or exited with non-zero status code!', file=sys.stderr)
-            print('returncode:', gjf_process.returncode, file=sys.stderr)
+    def format_shard(index_list: typing.List[int]):
+        try:
+            formatter = create_formatter()
+            try:
+                for fpath_idx in index_list:
+                    if stop_event.is_set():
+                        break
+                    result_queue.put((fpath_idx, try_format_java_file(fpath_list[fpath_idx], formatter, is_run)))
+            finally:
+                formatter.close()
+        finally:
+            # The shard is done even if it failed (its exception is raised by `future.result()`),
+            # so the main thread never waits for results that will not come.
+            result_queue.put(None)
+
+    shard_list = shard_by_size(fpath_list, jobs)
+
+    finished_result_dict = {}
+    next_fpath_idx = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shard_list) or 1) as executor:
+        future_list = [executor.submit(format_shard, x) for x in shard_list]
+        num_running_shards = len(future_list)
+        try:
+            while num_running_shards > 0:
+                queue_item = result_queue.get()
+                if queue_item is None:
+                    num_running_shards -= 1
+                    continue
 
-            _, error_msg = Encoding.decode(gjf_process.stderr)
-            if type(error_msg) is bytes:
-                print('Cannot decode Google Java Format stderr!', file=sys.stderr)
-                error_msg = str(error_msg)
+                fpath_idx, format_result = queue_item
+                finished_result_dict[fpath_idx] = format_result
 
-            print('stderr:', error_msg, file=sys.stderr, end='')
-            print(TermColor.RESET_COLOR, file=sys.stderr)
-            sys.exit(-1)
+                while next_fpath_idx in finished_result_dict:
+                    yield fpath_list[next_fpath_idx], finished_result_dict.pop(next_fpath_idx)
+                    next_fpath_idx += 1
+        finally:
+            # e.g. KeyboardInterrupt, the shards stop after their current file
+            stop_event.set()
 
-        _, formatted_java_code = Encoding.decode(gjf_process.stdout)
+        for future in future_list:
+            future.result()
 
-        if type(formatted_java_code) is bytes:
-            print(TermColor.FG_BRIGHT_RED, end='', file=sys.stderr)
-            print('Cannot decode Google Java Format stdout!', file=sys.stderr)
-            print('stdout:', formatted_java_code, end='', file=sys.stderr)
-            print(TermColor.RESET_COLOR, file=sys.stderr)
-            sys.exit(-1)
 
-        formatted_java_code = ensure_lf_line_ending(formatted_java_code)
-        formatted_java_code = remove_trailing_spaces_or_tabs(formatted_java_code)
-        formatted_java_code = remove_leading_empty_lines(formatted_java_code)
-        formatted_java_code = ensure_extractly_one_empty_line_at_the_end(formatted_java_code)
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'infile',
+        default='.',
+        action='store',
+        nargs='?',
+        help=(
+            'Specify file for directory to format.'
+            ' If a file is specified,'
+            ' then the --git and --nogit options are ignored.'
+        ),
+    )
 
-        formatted_bs = formatted_java_code.encode('utf-8')
+    parser.add_argument('--git', help='use git to list tracked files')
+    parser.add_argument('--nogit', help='force disable git detection', action='store_true')
+    parser.add_argument('--since', help='only files added, copied, modified or renamed since this git revision')
+    parser.add_argument('--staged', help='only files with staged changes', action='store_true')
+    parser.add_argument('--run', action='store_true')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of google-java-format JVMs running at once (0 to use all CPUs)')
+    parser.add_argument('--no-worker', action='store_true', help='start one JVM per file instead of a persistent worker')
+    parser.add_argument('--gjf-url', default=GJF_BIN_URL, help='where to download the google-java-format jar from')
+    parser.add_argument('--offline', action='store_true', help='only use the cached google-java-format jar')
+    parser.add_argument('--no-cds', action='store_true', help='do not create or use a class data sharing archive of the google-java-format classes')
+    parser.add_argument('--measure-startup', action='store_true', help='print the JVM cold start time without and with the class data sharing archive, then exit')
+    parser.add_argument('--stats', action='store_true', help='print count, total, p50/p95/max time and bytes of each phase')
+    parser.add_argument('--trace', help='write one span per file and phase to this file in Chrome trace-event format')
 
-        if bs == formatted_bs:
-            if args.verbose:
-                print(
-                    TermColor.FG_BRIGHT_GREEN
-                    + 'OK'
-                    + TermColor.RESET_COLOR
-                )
-            else:
-                print(end='\r')
-        else:
-            if args.run:
-                os.remove(fpath)
-                with open(fpath, mode='wb') as outfile:
-                    outfile.write(formatted_bs)
-
-                print(
-                    TermColor.FG_BRIGHT_RED
-                    + 'x'
-                    + TermColor.RESET_COLOR
-                    + ' -> '
-                    + TermColor.FG_BRIGHT_GREEN
-                    + 'OK'
-                    + TermColor.RESET_COLOR
-                )
-            else:
-                print(
-                    TermColor.FG_BRIGHT_RED
-                    + 'x'
-                    + TermColor.RESET_COLOR
-                )
+    args = parser.parse_args()
+    print(args)
+
+    TRACER.enabled = args.stats or (args.trace is not None)
+
+    with TRACER.span('discover'):
+        fpath_list, gjf_process_cwd = find_java_files(args)
+
+    # Download google-java-format binary
+    tmp_dir_value = get_gjf_binaries_root()
+    gjf_bin_filepath = download_gjf_bin(tmp_dir_value, args.gjf_url, args.offline)
+
+    worker_source_filepath = write_gjf_worker_source(tmp_dir_value)
+
+    archive_filepath = None
+    if not args.no_cds:
+        archive_filepath = get_cds_archive_filepath(tmp_dir_value, gjf_bin_filepath)
+        if (archive_filepath is not None) and (not create_cds_archive(archive_filepath, gjf_bin_filepath, worker_source_filepath)):
+            # e.g. Java 11 and 12 cannot create a dynamic archive
+            archive_filepath = None
+
+    if args.measure_startup:
+        measure_jvm_startup(gjf_bin_filepath, worker_source_filepath, archive_filepath)
+        return
+
+    jvm_args = None
+    if archive_filepath is not None:
+        jvm_args = get_cds_jvm_args(archive_filepath)
+
+    if args.no_worker:
+        worker_source_filepath = None
+
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    def create_formatter():
+        return JavaFormatter(gjf_bin_filepath, worker_source_filepath, gjf_process_cwd, jvm_args)
+
+    reporter = ProgressReporter(len(fpath_list), args.verbose)
+    error_list = []
+
+    try:
+        for fpath, (status, message, filesize, error_msg) in iterate_format_results(fpath_list, create_formatter, args.run, jobs):
+            reporter.update(fpath, status, message, filesize)
+
+            if error_msg is not None:
+                error_list.append((fpath, error_msg))
+    finally:
+        reporter.close()
+
+    for fpath, error_msg in error_list:
+        print(TermColor.FG_BRIGHT_RED, end='', file=sys.stderr)
+        print('\n' + fpath, file=sys.stderr)
+        print(error_msg, file=sys.stderr, end='')
+        print(TermColor.RESET_COLOR, file=sys.stderr)
+
+    if args.stats:
+        TRACER.print_stats()
+
+    if args.trace is not None:
+        TRACER.write_trace(args.trace)
+
+    if len(error_list) > 0:
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,26 @@
 #!/usr/bin/env python3
 # encoding=utf-8
 import os
+import re
+import json
+import time
+import mmap
 import subprocess
 import argparse
 import stat
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
 import typing
+import sys
+import codecs
+import shutil
+import hashlib
+import tempfile
+import collections
+import concurrent.futures
 
 RS = '\033[0m'
 R = '\033[91m'
@@ -28,53 +44,301 @@ class Encoding:
     UTF8 = 'utf-8'
     UTF8_WITH_BOM = 'utf-8-sig'
     UTF16 = 'utf-16'
+    UTF16_LE = 'utf-16-le'
+    UTF16_BE = 'utf-16-be'
     GB2312 = 'gb2312'
     SHIFT_JIS = 'shift-jis'
 
+    # only the beginning of the content is scanned to rank the encodings
+    SAMPLE_SIZE = 64 * 1024
+
+    @classmethod
+    def detect(cls, bs: bytes):
+        # Return `[(encoding, confidence), ...]` with the most likely encoding first.
+        # The sample is validated once per candidate and each validation stops at the first invalid byte.
+        # An empty list means that the content is binary.
+        candidate_list, _ = cls.scan(bs)
+        return candidate_list
+
+    @classmethod
+    def scan(cls, bs: bytes):
+        # Return `(candidate_list, decoded_content)`.
+        # `decoded_content` is not None if the whole content fits in the sample and is already decoded.
+        sample = bs[:cls.SAMPLE_SIZE]
+        is_truncated = (len(bs) > len(sample))
+
+        if sample.startswith(b'\xef\xbb\xbf'):
+            return [(cls.UTF8_WITH_BOM, 1.0)], None
+
+        if sample.startswith((b'\xff\xfe', b'\xfe\xff')):
+            return [(cls.UTF16, 1.0)], None
+
+        num_nul = sample.count(0)
+        if num_nul > 0:
+            # UTF-16 text without BOM has a NUL byte next to every ASCII character
+            num_even_nul = sample[0::2].count(0)
+            num_odd_nul = num_nul - num_even_nul
+            num_pairs = len(sample) // 2
+
+            if (len(bs) % 2 == 0) and (num_nul * 4 >= num_pairs):
+                if num_odd_nul > num_even_nul * 4:
+                    return [(cls.UTF16_LE, 0.9)], None
+
+                if num_even_nul > num_odd_nul * 4:
+                    return [(cls.UTF16_BE, 0.9)], None
+
+            return [], None
+
+        if sample.isascii():
+            if not is_truncated:
+                return [(cls.UTF8, 1.0)], None
+
+            # ASCII is valid in every candidate, the rest of the content decides
+            return [(cls.UTF8, 0.9), (cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)], None
+
+        candidate_list = []
+        for encoding, confidence in (
+            (cls.UTF8, 0.99),
+            (cls.GB2312, 0.6),
+            (cls.SHIFT_JIS, 0.5),
+        ):
+            # the incremental decoder validates in a single pass and stops at the first invalid byte,
+            # a multi-byte character cut at the end of a truncated sample is not an error
+            try:
+                decoded_sample = codecs.getincrementaldecoder(encoding)().decode(sample, final=(not is_truncated))
+            except UnicodeDecodeError:
+                continue
+
+            if not is_truncated:
+                # the sample is the whole content
+                return [(encoding, confidence)], decoded_sample
+
+            candidate_list.append((encoding, confidence))
+
+            if encoding == cls.UTF8:
+                # Valid multi-byte UTF-8 sequences are very unlikely in other encodings,
+                # so they are not checked against the sample. They are still tried if the rest of the content is not UTF-8.
+                candidate_list.extend([(cls.GB2312, 0.1), (cls.SHIFT_JIS, 0.1)])
+                break
+
+        return candidate_list, None
+
     @classmethod
     def decode(cls, bs: bytes):
-        if check_for_utf8_bom(bs):
+        # The content is decoded once with the most likely encoding.
+        # The next candidate is only tried if the content after the sample is invalid.
+        candidate_list, decoded_content = cls.scan(bs)
+        if decoded_content is not None:
+            return candidate_list[0][0], decoded_content
+
+        for encoding, _ in candidate_list:
             try:
-                encoding = cls.UTF8_WITH_BOM
-                decoded_content = bs.decode(encoding)
+                decoded_content = str(bs, encoding)
                 return encoding, decoded_content
-            except Exception as ex:
-                # traceback.print_exc()
-                pass
+            except UnicodeDecodeError:
+                continue
 
-        try:
-            encoding = cls.UTF8
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+        return None, bs
 
-        try:
-            encoding = cls.UTF16
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
 
-        try:
-            encoding = cls.GB2312
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+class NullSpan:
+    # returned by a disabled `Tracer`, the instrumented code does not need to check if tracing is enabled
+    num_bytes = 0
 
-        try:
-            encoding = cls.SHIFT_JIS
-            decoded_content = bs.decode(encoding)
-            return encoding, decoded_content
-        except Exception as ex:
-            # traceback.print_exc()
-            pass
+    def __enter__(self):
+        return self
 
-        return None, bs
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class TraceSpan:
+    __slots__ = ('span_list', 'phase', 'filepath', 'num_bytes', 'start_ns')
+
+    def __init__(self, span_list: list, phase: str, filepath: str):
+        self.span_list = span_list
+        self.phase = phase
+        self.filepath = filepath
+        # bytes read or written in this phase
+        self.num_bytes = 0
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        self.span_list.append((self.phase, self.filepath, self.start_ns, duration_ns, self.num_bytes, os.getpid()))
+        return False
+
+
+class Tracer:
+    # Per-phase timing for `--stats` and `--trace`.
+    # A span is recorded as `(phase, filepath, start_ns, duration_ns, num_bytes, pid)`.
+    # `time.perf_counter_ns` is a system-wide monotonic clock so the spans of worker processes line up.
+
+    def __init__(self):
+        self.enabled = False
+        self.span_list = []
+
+    def span(self, phase: str, filepath: str = None):
+        if not self.enabled:
+            return NULL_SPAN
+
+        return TraceSpan(self.span_list, phase, filepath)
+
+    def pop_spans(self):
+        span_list = self.span_list
+        self.span_list = []
+        return span_list
+
+    def add_spans(self, span_list: list):
+        self.span_list.extend(span_list)
+
+    def print_stats(self, file=sys.stderr):
+        duration_dict = collections.defaultdict(list)
+        bytes_dict = collections.defaultdict(int)
+        for phase, _, _, duration_ns, num_bytes, _ in self.span_list:
+            duration_dict[phase].append(duration_ns)
+            bytes_dict[phase] += num_bytes
+
+        print(f'{"phase":<20} {"count":>8} {"total ms":>12} {"p50 ms":>10} {"p95 ms":>10} {"max ms":>10} {"bytes":>14}', file=file)
+        for phase, duration_list in duration_dict.items():
+            duration_list.sort()
+            count = len(duration_list)
+            p50 = duration_list[(count - 1) // 2]
+            p95 = duration_list[min(count - 1, (count * 95) // 100)]
+            print(
+                f'{phase:<20} {count:>8} {sum(duration_list) / 1e6:>12.3f} {p50 / 1e6:>10.3f}'
+                f' {p95 / 1e6:>10.3f} {duration_list[-1] / 1e6:>10.3f} {bytes_dict[phase]:>14}',
+                file=file,
+            )
+
+    def write_trace(self, outpath: str):
+        # Chrome trace-event format, open with chrome://tracing or https://ui.perfetto.dev
+        origin_ns = min([x[2] for x in self.span_list], default=0)
+
+        event_list = []
+        for phase, filepath, start_ns, duration_ns, num_bytes, pid in self.span_list:
+            event_args = {}
+            if filepath is not None:
+                event_args['file'] = filepath
+            if num_bytes > 0:
+                event_args['bytes'] = num_bytes
+
+            event_list.append({
+                'name': phase,
+                'ph': 'X',
+                'ts': (start_ns - origin_ns) / 1000,
+                'dur': duration_ns / 1000,
+                'pid': pid,
+                'tid': pid,
+                'args': event_args,
+            })
+
+        # non-UTF-8 file names are escaped
+        with open(outpath, mode='w', encoding='utf-8') as outfile:
+            json.dump({'traceEvents': event_list, 'displayTimeUnit': 'ms'}, outfile)
+
+
+TRACER = Tracer()
+
+
+class ProgressReporter:
+    # Status lines are buffered and written in batches, a tree of small files is not slowed down by the terminal.
+    # On a TTY a single progress line is redrawn at most every `REDRAW_INTERVAL` seconds,
+    # without ETA when the files come from a generator.
+    # Only changed or failed files are printed (every file with `verbose`), followed by a summary.
+
+    REDRAW_INTERVAL = 0.1  # seconds
+    MAX_PENDING_LINES = 256
+
+    # statuses that are always printed
+    REPORTED_STATUSES = ('changed', 'fixed', 'error')
+
+    def __init__(self, total_files: int = None, verbose: bool = False):
+        self.file = sys.stdout
+        self.is_tty = self.file.isatty()
+        self.verbose = verbose
+        # None if the files are discovered while they are formatted
+        self.total_files = total_files
+
+        self.num_files = 0
+        self.num_bytes = 0
+        self.status_counter = collections.Counter()
+        self.pending_lines = []
+        self.has_progress_line = False
+        self.start_time = time.monotonic()
+        self.last_flush_time = self.start_time
+
+    def update(self, filepath: str, status: str, message: str = '', num_bytes: int = 0):
+        # `status` is one of 'ok', 'skipped', 'changed', 'fixed' or 'error'
+        self.num_files += 1
+        self.num_bytes += num_bytes
+        self.status_counter[status] += 1
+
+        if (status in self.REPORTED_STATUSES) or self.verbose:
+            self.pending_lines.append(f'> {filepath} {message}')
+
+        now = time.monotonic()
+        if (len(self.pending_lines) >= self.MAX_PENDING_LINES) or ((now - self.last_flush_time) >= self.REDRAW_INTERVAL):
+            self.flush(now)
+
+    def format_progress(self, now: float):
+        elapsed = max(now - self.start_time, 1e-9)
+        files_per_second = self.num_files / elapsed
+        mb_per_second = self.num_bytes / (1024 * 1024) / elapsed
+
+        if self.total_files is None:
+            return f'{self.num_files} files {files_per_second:.0f} files/s {mb_per_second:.1f} MB/s'
+
+        if files_per_second > 0:
+            eta = f'{(self.total_files - self.num_files) / files_per_second:.0f}s'
+        else:
+            eta = '?'
+
+        return f'{self.num_files}/{self.total_files} files {files_per_second:.0f} files/s {mb_per_second:.1f} MB/s ETA {eta}'
+
+    def flush(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+
+        parts = []
+        if self.has_progress_line:
+            # erase the progress line before the status lines are written over it
+            parts.append('\r\033[K')
+            self.has_progress_line = False
+
+        for line in self.pending_lines:
+            parts.append(line)
+            parts.append('\n')
+        self.pending_lines = []
+
+        if self.is_tty:
+            parts.append(self.format_progress(now))
+            self.has_progress_line = True
+
+        if len(parts) > 0:
+            self.file.write(''.join(parts))
+            self.file.flush()
+
+        self.last_flush_time = now
+
+    def close(self):
+        now = time.monotonic()
+        self.is_tty = False
+        self.flush(now)
+
+        count_str = ', '.join([f'{count} {status}' for status, count in self.status_counter.items()])
+        if len(count_str) > 0:
+            count_str = f' ({count_str})'
+
+        self.file.write(f'{self.num_files} files{count_str} in {now - self.start_time:.2f}s\n')
+        self.file.flush()
 
 
 IGNORED_DIRS = [
@@ -133,37 +397,74 @@ IGNORED_EXTS = [
 ]
 
 
+def iter_regular_files(inpath: str) -> typing.Iterator[str]:
+    # `os.scandir` entries know their type, so the walk needs no `stat` call per entry
+    if os.path.basename(inpath).lower() in IGNORED_DIRS:
+        return
+
+    if not os.path.isdir(inpath):
+        if os.path.isfile(inpath) and (os.path.splitext(inpath)[1].lower() not in IGNORED_EXTS):
+            yield inpath
+        return
+
+    dirpath_stack = [inpath]
+    while len(dirpath_stack) > 0:
+        with os.scandir(dirpath_stack.pop()) as entry_iter:
+            for entry in entry_iter:
+                if entry.name.lower() in IGNORED_DIRS:
+                    continue
+
+                if entry.is_dir():
+                    dirpath_stack.append(entry.path)
+                elif entry.is_file() and (os.path.splitext(entry.name)[1].lower() not in IGNORED_EXTS):
+                    yield entry.path
+
+
 def find_regular_files(inpath: str) -> typing.List[str]:
-    basename = os.path.basename(inpath)
-    if basename.lower() in IGNORED_DIRS:
-        return []
+    return list(iter_regular_files(inpath))
 
-    regular_filepath_list = []
 
-    file_stat = os.stat(inpath)
+def get_git_list_files_args(since: str = None, staged: bool = False):
+    if (since is None) and (not staged):
+        return ['git', '-c', 'core.quotepath=off', 'ls-files']
 
-    if stat.S_ISDIR(file_stat.st_mode):
-        child_filename_list = os.listdir(inpath)
-        for child_filename in child_filename_list:
-            child_filepath = os.path.join(inpath, child_filename)
-            regular_filepath_list.extend(find_regular_files(child_filepath))
-    elif stat.S_ISREG(file_stat.st_mode):
-        ext = os.path.splitext(inpath)[1].lower()
-        if ext not in IGNORED_EXTS:
-            regular_filepath_list.append(inpath)
+    # Only the files that are added, copied, modified or renamed relative to `since` (or HEAD with `staged`).
+    # A renamed file is listed with its new path. Rename detection is skipped because the new path of
+    # an undetected rename is still listed as added.
+    args = [
+        'git',
+        '-c', 'core.quotepath=off',
+        'diff',
+        '--name-only',
+        '--relative',
+        '--no-renames',
+        '--diff-filter=ACMR',
+    ]
 
-    return regular_filepath_list
+    if staged:
+        args.append('--cached')
 
+    if since is not None:
+        if since.startswith('-'):
+            # `since` is placed before `--` so git would read it as an option
+            raise Exception(f'Invalid git revision: {since!r}')
 
-def find_regular_files_from_git(inpath: str):
+        args.append(since)
+
+    args.append('--')
+    return args
+
+
+def find_regular_files_from_git(inpath: str, since: str = None, staged: bool = False):
     git_process = subprocess.run(
-        args=['git', 'ls-files'],
+        args=get_git_list_files_args(since, staged),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         cwd=inpath,
     )
 
-    if len(git_process.stderr) > 0:
+    # git prints warnings (e.g. about line endings under `text=auto`) on stderr, only the returncode tells a failure
+    if git_process.returncode != 0:
         _, error_msg = Encoding.decode(git_process.stderr)
 
         if type(error_msg) is bytes:
@@ -203,6 +504,271 @@ def find_regular_files_from_git(inpath: str):
     return filepath_list
 
 
+class Inotify:
+    # Minimal inotify binding through ctypes (Linux only).
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x00080000
+
+    # a file is formatted once it is closed after writing or moved into place (atomic save)
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    # struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+    EVENT_HEADER = struct.Struct('iIII')
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            error_code = ctypes.get_errno()
+            raise OSError(error_code, os.strerror(error_code))
+
+        # watch descriptor -> directory path
+        self.wd_dict = {}
+
+    def add_watch(self, dirpath: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.WATCH_MASK)
+        if wd < 0:
+            error_code = ctypes.get_errno()
+            if error_code in (errno.ENOENT, errno.ENOTDIR):
+                # removed before the watch was added
+                return None
+
+            # ENOSPC means that fs.inotify.max_user_watches is too low for this tree
+            raise OSError(error_code, f'{os.strerror(error_code)}: {dirpath}')
+
+        self.wd_dict[wd] = dirpath
+        return wd
+
+    def remove_watch(self, wd: int):
+        # the kernel sends IN_IGNORED afterwards
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float = None):
+        # return `[(wd, dirpath, name, mask), ...]`, `dirpath` is None for IN_Q_OVERFLOW
+        readable_list, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable_list) == 0:
+            return []
+
+        buf = os.read(self.fd, self.READ_SIZE)
+
+        event_list = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(buf, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+
+            if mask & self.IN_IGNORED:
+                self.wd_dict.pop(wd, None)
+                continue
+
+            dirpath = self.wd_dict.get(wd, None)
+            if (dirpath is None) and (not (mask & self.IN_Q_OVERFLOW)):
+                continue
+
+            event_list.append((wd, dirpath, name, mask))
+
+        return event_list
+
+    def close(self):
+        os.close(self.fd)
+
+
+def list_watch_dirs(inpath: str):
+    # directories under `inpath` (included) with the same pruning as `iter_regular_files`
+    dirpath_list = []
+    dirpath_stack = [inpath]
+    while len(dirpath_stack) > 0:
+        dirpath = dirpath_stack.pop()
+        dirpath_list.append(dirpath)
+
+        try:
+            with os.scandir(dirpath) as entry_iter:
+                for entry in entry_iter:
+                    if entry.name.lower() in IGNORED_DIRS:
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        dirpath_stack.append(entry.path)
+        except OSError:
+            continue
+
+    return dirpath_list
+
+
+def filter_git_ignored(inpath: str, path_list: typing.List[str]):
+    # Drop the paths that are excluded by .gitignore. Tracked files are never reported as ignored.
+    if len(path_list) == 0:
+        return path_list
+
+    git_process = subprocess.run(
+        args=['git', 'check-ignore', '--stdin', '-z'],
+        input=b''.join([os.fsencode(path) + b'\0' for path in path_list]),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=inpath,
+    )
+
+    # 1 means that none of the paths is ignored
+    if git_process.returncode not in (0, 1):
+        return path_list
+
+    ignored_path_set = set([os.fsdecode(path) for path in git_process.stdout.split(b'\0') if len(path) > 0])
+    return [path for path in path_list if path not in ignored_path_set]
+
+
+WATCH_DEBOUNCE_SECONDS = 0.2
+# a continuous stream of events is still processed at this interval
+WATCH_MAX_DELAY_SECONDS = 2.0
+
+
+def watch_files(
+    inpath: str,
+    is_watched_file: typing.Callable[[str], bool],
+    process_batch: typing.Callable[[typing.List[str]], None],
+    use_git: bool = False,
+):
+    # Run `process_batch` on the files under `inpath` whenever they are written, until Ctrl+C.
+    # Bursts of events (e.g. `git checkout`) are debounced and processed as one batch.
+    if not sys.platform.startswith('linux'):
+        raise Exception('--watch requires Linux (inotify)')
+
+    inpath = os.path.abspath(inpath)
+    inotify = Inotify()
+
+    def add_watch_tree(dirpath: str, is_moved: bool = False):
+        # return the files that already exist in the new directories
+        dirpath_list = list_watch_dirs(dirpath)
+        if use_git:
+            dirpath_list = filter_git_ignored(inpath, dirpath_list)
+
+        filepath_list = []
+        for child_dirpath in dirpath_list:
+            wd = inotify.add_watch(child_dirpath)
+            if wd is None:
+                continue
+
+            if is_moved and (child_dirpath == dirpath):
+                moved_wd_set.add(wd)
+
+            with os.scandir(child_dirpath) as entry_iter:
+                for entry in entry_iter:
+                    if (entry.name.lower() not in IGNORED_DIRS) and entry.is_file() and is_watched_file(entry.path):
+                        filepath_list.append(entry.path)
+
+        return filepath_list
+
+    # filepath -> stat after the last batch, the events of our own writes are skipped
+    processed_stat_dict = {}
+    pending_filepath_set = set()
+    # A directory that is renamed inside the tree keeps its watch descriptor, IN_MOVED_TO of the new parent
+    # registers the new path and the IN_MOVE_SELF that follows must not remove the watch.
+    moved_wd_set = set()
+    first_event_time = None
+    last_event_time = None
+
+    add_watch_tree(inpath)
+    print(f'watching {len(inotify.wd_dict)} directories in {inpath}', flush=True)
+
+    try:
+        while True:
+            timeout = None
+            if len(pending_filepath_set) > 0:
+                deadline = min(last_event_time + WATCH_DEBOUNCE_SECONDS, first_event_time + WATCH_MAX_DELAY_SECONDS)
+                timeout = max(0, deadline - time.monotonic())
+
+            event_list = inotify.read_events(timeout)
+            now = time.monotonic()
+
+            if len(event_list) == 0:
+                # IN_MOVE_SELF is queued together with IN_MOVED_TO, the queue is empty so it has been read
+                moved_wd_set.clear()
+
+            for wd, dirpath, name, mask in event_list:
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    # events were dropped, every file may have changed
+                    pending_filepath_set.update([x for x in iter_regular_files(inpath) if is_watched_file(x)])
+                    continue
+
+                if mask & Inotify.IN_MOVE_SELF:
+                    # moved out of the tree unless IN_MOVED_TO of the new parent registered it again
+                    if wd in moved_wd_set:
+                        moved_wd_set.discard(wd)
+                    else:
+                        inotify.remove_watch(wd)
+                    continue
+
+                if (len(name) == 0) or (name.lower() in IGNORED_DIRS):
+                    continue
+
+                path = os.path.join(dirpath, name)
+                if mask & Inotify.IN_ISDIR:
+                    if mask & Inotify.IN_CREATE:
+                        pending_filepath_set.update(add_watch_tree(path))
+                    elif mask & Inotify.IN_MOVED_TO:
+                        pending_filepath_set.update(add_watch_tree(path, is_moved=True))
+                elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    if is_watched_file(path):
+                        pending_filepath_set.add(path)
+
+            if len(pending_filepath_set) == 0:
+                first_event_time = None
+                continue
+
+            if len(event_list) > 0:
+                last_event_time = now
+                if first_event_time is None:
+                    first_event_time = now
+
+            if ((now - last_event_time) < WATCH_DEBOUNCE_SECONDS) and ((now - first_event_time) < WATCH_MAX_DELAY_SECONDS):
+                continue
+
+            batch = []
+            for filepath in sorted(pending_filepath_set):
+                try:
+                    file_stat = os.stat(filepath)
+                except OSError:
+                    continue
+
+                stat_key = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+                if stat.S_ISREG(file_stat.st_mode) and (processed_stat_dict.get(filepath, None) != stat_key):
+                    batch.append(filepath)
+
+            pending_filepath_set.clear()
+            first_event_time = None
+
+            if use_git:
+                batch = filter_git_ignored(inpath, batch)
+
+            if len(batch) == 0:
+                continue
+
+            process_batch(batch)
+
+            for filepath in batch:
+                try:
+                    file_stat = os.stat(filepath)
+                except OSError:
+                    continue
+
+                processed_stat_dict[filepath] = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
+
+
 def format_text_file_content(content: str):
     # enforce LF line ending
     content = content.replace('\r', '')
@@ -228,18 +794,117 @@ def format_text_file_content(content: str):
     return content
 
 
+# files are checked and files larger than MAX_FILESIZE are normalized in chunks of this size
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# byte sequences that are valid for Python's utf-8 codec (no overlong forms and no surrogates)
+UTF8_PATTERN = re.compile(
+    rb'(?:[\x00-\x7f]+'
+    rb'|[\xc2-\xdf][\x80-\xbf]'
+    rb'|\xe0[\xa0-\xbf][\x80-\xbf]'
+    rb'|[\xe1-\xec\xee\xef][\x80-\xbf]{2}'
+    rb'|\xed[\x80-\x9f][\x80-\xbf]'
+    rb'|\xf0[\x90-\xbf][\x80-\xbf]{2}'
+    rb'|[\xf1-\xf3][\x80-\xbf]{3}'
+    rb'|\xf4[\x80-\x8f][\x80-\xbf]{2}'
+    rb')*'
+)
+
+NON_ASCII_PATTERN = re.compile(rb'[\x80-\xff]')
+
+NON_ASCII_BYTES = bytes(range(0x80, 0x100))
+
+# Maps the ASCII characters removed by `str.rstrip` and every non-ASCII byte to a space
+# so that a single `find(b' \n')` finds every line that may end with whitespace.
+LINE_END_TRANSLATION_TABLE = bytes(
+    0x20 if ((c in b'\t\x0b\x0c\x1c\x1d\x1e\x1f ') or (c >= 0x80)) else c
+    for c in range(256)
+)
+
+
+def is_normalized_utf8_buffer(content_buf: typing.Union[bytes, mmap.mmap], chunk_size: int = STREAM_CHUNK_SIZE):
+    # Return True if `format_text_file_bytes` would not change the UTF-8 content.
+    # The check only works on bytes (at most one chunk is copied at a time) so no `str` object is created.
+    # False means that the full decode and format path has to decide.
+    num_bytes = len(content_buf)
+    if num_bytes == 0:
+        return False
+
+    # exactly one new line character at the end
+    if content_buf[-1] != 0x0A:
+        return False
+
+    if num_bytes > 1:
+        # no leading new line character
+        if content_buf[0] == 0x0A:
+            return False
+
+        if content_buf[-2] == 0x0A:
+            return False
+
+    # the BOM would be removed
+    if check_for_utf8_bom(content_buf[:3]):
+        return False
+
+    first_non_ascii_idx = -1
+    num_non_ascii_bytes = 0
+
+    for chunk_start in range(0, num_bytes, chunk_size):
+        # one extra byte so that a line end on the chunk boundary is checked too
+        chunk_bs = content_buf[chunk_start:chunk_start + chunk_size + 1]
+
+        if b'\r' in chunk_bs:
+            return False
+
+        # `Encoding.scan` treats NUL bytes as binary (or UTF-16) content
+        if b'\x00' in chunk_bs:
+            return False
+
+        # trailing whitespace or a non-ASCII character (which may be whitespace) before a new line
+        if chunk_bs.translate(LINE_END_TRANSLATION_TABLE).find(b' \n') != -1:
+            return False
+
+        if not chunk_bs.isascii():
+            if first_non_ascii_idx < 0:
+                first_non_ascii_idx = chunk_start + NON_ASCII_PATTERN.search(chunk_bs).start()
+
+            num_non_ascii_bytes += len(chunk_bs) - len(chunk_bs.translate(None, NON_ASCII_BYTES))
+
+    if first_non_ascii_idx >= 0:
+        # the regex validator is slower than the utf-8 codec for text with a lot of multi-byte characters
+        if num_non_ascii_bytes * 16 > num_bytes:
+            return False
+
+        utf8_match = UTF8_PATTERN.match(content_buf, first_non_ascii_idx)
+        if utf8_match.end() != num_bytes:
+            return False
+
+    return True
+
+
+def is_normalized_utf8_file(inpath: str):
+    with open(inpath, mode='rb') as infile:
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as content_mm:
+            return is_normalized_utf8_buffer(content_mm)
+
+
 def format_text_file(inpath: str):
     content_bs = open(inpath, mode='rb').read()
+    return format_text_file_bytes(content_bs)
 
-    encoding, decoded_string = Encoding.decode(content_bs)
+
+def format_text_file_bytes(content_bs: bytes, filepath: str = None):
+    with TRACER.span('decode', filepath):
+        encoding, decoded_string = Encoding.decode(content_bs)
 
     if (encoding is None) or (type(decoded_string) is bytes):
         return {
             'error': 'Failed to decode the file!',
         }
 
-    content = format_text_file_content(decoded_string)
-    encoded_content = content.encode(Encoding.UTF8)
+    with TRACER.span('normalize', filepath):
+        content = format_text_file_content(decoded_string)
+        encoded_content = content.encode(Encoding.UTF8)
 
     if content_bs == encoded_content:
         return {
@@ -253,6 +918,742 @@ def format_text_file(inpath: str):
         }
 
 
+MAX_FILESIZE = 1024 * 1024 * 10  # 10 MBs
+
+
+def get_candidate_encodings(inpath: str):
+    # same order as `Encoding.decode`
+    with open(inpath, mode='rb') as infile:
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as content_mm:
+            return [encoding for encoding, _ in Encoding.detect(content_mm)]
+
+
+def stream_format_text_file(inpath: str, encoding: str, outfile: typing.BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE):
+    # Same rules as `format_text_file_content` but only one chunk and one partial line are kept in memory.
+    # Raise UnicodeDecodeError if the file cannot be decoded with `encoding`.
+    decoder = codecs.getincrementaldecoder(encoding)()
+
+    partial_line = ''
+    # leading empty lines are dropped
+    has_content = False
+    # empty lines are written only when they are followed by a non-empty line
+    num_pending_empty_lines = 0
+
+    with open(inpath, mode='rb') as infile:
+        while True:
+            chunk_bs = infile.read(chunk_size)
+            is_final = (len(chunk_bs) == 0)
+
+            text = partial_line + decoder.decode(chunk_bs, final=is_final)
+            # enforce LF line ending
+            text = text.replace('\r', '')
+            lines = text.split('\n')
+
+            if is_final:
+                partial_line = ''
+            else:
+                partial_line = lines.pop()
+
+            formatted_lines = []
+            for line in lines:
+                if len(line) == 0:
+                    if has_content:
+                        num_pending_empty_lines += 1
+                    continue
+
+                has_content = True
+                if num_pending_empty_lines > 0:
+                    formatted_lines.append('\n' * num_pending_empty_lines)
+                    num_pending_empty_lines = 0
+
+                # remove trailing whitespace or tab characters
+                formatted_lines.append(line.rstrip())
+                formatted_lines.append('\n')
+
+            outfile.write(''.join(formatted_lines).encode(Encoding.UTF8))
+
+            if is_final:
+                break
+
+    if not has_content:
+        outfile.write(b'\n')
+
+
+class StreamComparer:
+    # A write-only file object for `stream_format_text_file` that compares the formatted bytes with `infile`
+    # instead of storing them. The comparison stops at the first difference.
+
+    def __init__(self, infile: typing.BinaryIO):
+        self.infile = infile
+        self.is_diff = False
+
+    def write(self, bs: bytes):
+        if self.is_diff:
+            return
+
+        if self.infile.read(len(bs)) != bs:
+            self.is_diff = True
+
+    def finish(self):
+        # the original file must not have more bytes than the formatted content
+        if (not self.is_diff) and (len(self.infile.read(1)) > 0):
+            self.is_diff = True
+
+        return self.is_diff
+
+
+def format_large_text_file(inpath: str, is_run: bool = False, chunk_size: int = STREAM_CHUNK_SIZE):
+    # The formatted content is compared with `inpath` as it is produced, nothing is written to check a file.
+    # Only with `is_run` a changed file is formatted again into a temporary file next to `inpath`.
+    # The caller has to move it over `inpath` or remove it.
+    decoded_encoding = None
+    is_diff = False
+    for encoding in get_candidate_encodings(inpath):
+        try:
+            with open(inpath, mode='rb') as infile:
+                comparer = StreamComparer(infile)
+                # the rest of the file is still decoded after a difference to find the same encoding as a full read
+                stream_format_text_file(inpath, encoding, comparer, chunk_size)
+                is_diff = comparer.finish()
+        except UnicodeDecodeError:
+            continue
+
+        decoded_encoding = encoding
+        break
+
+    if decoded_encoding is None:
+        return {
+            'error': 'Failed to decode the file!',
+        }
+
+    if not is_diff:
+        return {
+            'diff': False,
+        }
+
+    if not is_run:
+        return {
+            'encoding': decoded_encoding,
+            'diff': True,
+        }
+
+    abs_inpath = os.path.abspath(inpath)
+    fd, tmp_filepath = tempfile.mkstemp(
+        prefix='.' + os.path.basename(abs_inpath) + '.',
+        suffix='.tmp',
+        dir=os.path.dirname(abs_inpath),
+    )
+
+    try:
+        with os.fdopen(fd, mode='wb') as outfile:
+            stream_format_text_file(inpath, decoded_encoding, outfile, chunk_size)
+
+        shutil.copymode(inpath, tmp_filepath)
+        return {
+            'encoding': decoded_encoding,
+            'diff': True,
+            'temp_filepath': tmp_filepath,
+        }
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+
+def hash_file(inpath: str, chunk_size: int = STREAM_CHUNK_SIZE):
+    hash_obj = hashlib.sha1()
+    with open(inpath, mode='rb') as infile:
+        while True:
+            chunk_bs = infile.read(chunk_size)
+            if len(chunk_bs) == 0:
+                break
+            hash_obj.update(chunk_bs)
+
+    return hash_obj.hexdigest()
+
+
+# number of files sent to a worker process at once
+DEFAULT_CHUNK_SIZE = 64
+
+
+BINARY_SNIFF_SIZE = 8000  # same as git
+
+# binary formats that may not have a NUL byte at the beginning
+BINARY_MAGIC_NUMBERS = (
+    b'\x7fELF',
+    b'!<arch>\n',  # static libraries (.a, .lib)
+    b'PK\x03\x04',  # zip, jar, docx, ...
+    b'PK\x05\x06',
+    b'\x1f\x8b',  # gzip
+    b'\xfd7zXZ\x00',
+    b'7z\xbc\xaf\x27\x1c',
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b'Rar!\x1a\x07',
+    b'\x89PNG\r\n\x1a\n',
+    b'GIF87a',
+    b'GIF89a',
+    b'\xff\xd8\xff',  # jpeg
+    b'%PDF-',
+    b'PAR1',  # parquet
+    b'\xca\xfe\xba\xbe',  # java class, mach-o fat binary
+    b'\xcf\xfa\xed\xfe',  # mach-o
+    b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',  # Microsoft Office (.doc, .xls, .msi)
+    b'SQLite format 3\x00',
+    b'\x00asm',  # WebAssembly
+)
+
+# control characters that are common in text files
+TEXT_CONTROL_BYTES = b'\t\n\r\x0c\x08\x1b'
+NON_CONTROL_BYTES = bytes([c for c in range(256) if (c >= 0x20 and c != 0x7f) or (c in TEXT_CONTROL_BYTES)])
+
+# more control characters than this in the sniffed bytes means the file is binary
+MAX_CONTROL_RATIO = 0.3
+
+
+def is_binary_content(head_bs: bytes):
+    # `head_bs` is the beginning of the file (at most BINARY_SNIFF_SIZE bytes)
+    if head_bs.startswith(BINARY_MAGIC_NUMBERS):
+        return True
+
+    if b'\x00' in head_bs:
+        # UTF-16 text has NUL bytes too
+        return len(Encoding.detect(head_bs)) == 0
+
+    num_control_bytes = len(head_bs.translate(None, NON_CONTROL_BYTES))
+    return num_control_bytes > len(head_bs) * MAX_CONTROL_RATIO
+
+
+class BinaryExtensionCache:
+    # Per-extension verdicts of `is_binary_content`.
+    # An extension is known to be binary after MIN_BINARY_FILES binary files and no text file,
+    # files with that extension are then rejected without being opened.
+
+    MIN_BINARY_FILES = 3
+
+    def __init__(self):
+        # ext -> [num_binary_files, num_text_files]
+        self.counts = {}
+
+    def is_known_binary(self, ext: str):
+        count = self.counts.get(ext, None)
+        if count is None:
+            return False
+
+        return (count[1] == 0) and (count[0] >= self.MIN_BINARY_FILES)
+
+    def record(self, ext: str, is_binary: bool):
+        if len(ext) == 0:
+            return
+
+        if ext not in self.counts:
+            self.counts[ext] = [0, 0]
+
+        if is_binary:
+            self.counts[ext][0] += 1
+        else:
+            self.counts[ext][1] += 1
+
+    def record_result(self, filepath: str, format_result: dict):
+        if format_result.get('binary', False):
+            self.record(os.path.splitext(filepath)[1].lower(), True)
+        elif not format_result.get('ignored', False) and ('error' not in format_result):
+            self.record(os.path.splitext(filepath)[1].lower(), False)
+
+
+# Only the main process uses the cache, in the order of the files, so the verdicts do not depend on --jobs.
+# The worker processes check every file that they get.
+BINARY_EXTENSION_CACHE = BinaryExtensionCache()
+
+
+def check_text_file(filepath: str, known_digest: str = None, with_digest: bool = False, is_run: bool = False):
+    basename = os.path.basename(filepath)
+    ext = os.path.splitext(basename)[1].lower()
+
+    # git will not filter these extensions
+    if ext in IGNORED_EXTS:
+        return {
+            'ignored': True,
+        }
+
+    filesize = os.path.getsize(filepath)
+    if filesize == 0:
+        return {
+            'error': f'file is too big ({filesize})',
+        }
+
+    if filesize > MAX_FILESIZE:
+        with TRACER.span('sniff', filepath):
+            with open(filepath, mode='rb') as infile:
+                head_bs = infile.read(BINARY_SNIFF_SIZE)
+
+            is_binary = is_binary_content(head_bs)
+
+        if is_binary:
+            format_result = {
+                'ignored': True,
+                'binary': True,
+            }
+        else:
+            format_result = check_large_text_file(filepath, known_digest, with_digest, is_run)
+
+        format_result['filesize'] = filesize
+        return format_result
+
+    with open(filepath, mode='rb') as infile:
+        file_stat = os.fstat(infile.fileno())
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as content_mm:
+            with TRACER.span('sniff', filepath):
+                is_binary = is_binary_content(content_mm[:BINARY_SNIFF_SIZE])
+
+            if is_binary:
+                format_result = {
+                    'ignored': True,
+                    'binary': True,
+                }
+            else:
+                format_result = check_text_file_buffer(content_mm, known_digest, with_digest, filepath)
+
+    format_result['filesize'] = filesize
+
+    if 'digest' in format_result:
+        format_result['stat'] = CleanFileIndex.stat_key(file_stat)
+
+    return format_result
+
+
+def check_text_file_buffer(
+    content_buf: typing.Union[bytes, mmap.mmap],
+    known_digest: str = None,
+    with_digest: bool = False,
+    filepath: str = None,
+):
+    digest = None
+    if known_digest is not None:
+        # the stat information changed (e.g. `touch` or `git checkout`) but the content may not
+        with TRACER.span('hash', filepath) as span:
+            span.num_bytes = len(content_buf)
+            digest = hashlib.sha1(content_buf).hexdigest()
+
+    if (digest is not None) and (digest == known_digest):
+        is_normalized = True
+    else:
+        # the pages of the mapped file are read here
+        with TRACER.span('check', filepath) as span:
+            span.num_bytes = len(content_buf)
+            is_normalized = is_normalized_utf8_buffer(content_buf)
+
+    if is_normalized:
+        format_result = {
+            'diff': False,
+        }
+    else:
+        format_result = format_text_file_bytes(content_buf[:], filepath)
+
+    if with_digest and ('error' not in format_result) and (not format_result['diff']):
+        if digest is None:
+            with TRACER.span('hash', filepath) as span:
+                span.num_bytes = len(content_buf)
+                digest = hashlib.sha1(content_buf).hexdigest()
+
+        format_result['digest'] = digest
+
+    return format_result
+
+
+def check_large_text_file(filepath: str, known_digest: str = None, with_digest: bool = False, is_run: bool = False):
+    file_stat = os.stat(filepath)
+
+    digest = None
+    if known_digest is not None:
+        with TRACER.span('hash', filepath) as span:
+            span.num_bytes = file_stat.st_size
+            digest = hash_file(filepath)
+
+    if (digest is not None) and (digest == known_digest):
+        is_normalized = True
+    else:
+        with TRACER.span('check', filepath) as span:
+            span.num_bytes = file_stat.st_size
+            is_normalized = is_normalized_utf8_file(filepath)
+
+    if is_normalized:
+        format_result = {
+            'diff': False,
+        }
+    else:
+        with TRACER.span('stream_format', filepath) as span:
+            span.num_bytes = file_stat.st_size
+            format_result = format_large_text_file(filepath, is_run)
+
+    if with_digest and ('error' not in format_result) and (not format_result['diff']):
+        if digest is None:
+            with TRACER.span('hash', filepath) as span:
+                span.num_bytes = file_stat.st_size
+                digest = hash_file(filepath)
+
+        format_result['stat'] = CleanFileIndex.stat_key(file_stat)
+        format_result['digest'] = digest
+
+    return format_result
+
+
+def check_text_file_chunk(
+    work_list: typing.List[typing.Tuple[str, str]],
+    with_digest: bool,
+    is_run: bool = False,
+    trace: bool = False,
+):
+    # return `(result_list, span_list)`, the spans of the worker process are sent back with the results
+    TRACER.enabled = trace
+    # a forked worker starts with a copy of the spans of the parent process
+    TRACER.pop_spans()
+
+    result_list = [check_text_file(filepath, known_digest, with_digest, is_run) for filepath, known_digest in work_list]
+    return result_list, TRACER.pop_spans()
+
+
+def get_normalization_version():
+    # The version changes whenever the code of the normalization rules changes,
+    # which invalidates every entry of an existing index.
+    hash_obj = hashlib.sha1(sys.version.encode(Encoding.UTF8))
+    code_list = [
+        Encoding.scan.__code__,
+        Encoding.decode.__code__,
+        is_normalized_utf8_buffer.__code__,
+        format_text_file_content.__code__,
+        format_text_file_bytes.__code__,
+        stream_format_text_file.__code__,
+    ]
+
+    while len(code_list) > 0:
+        code = code_list.pop()
+        hash_obj.update(code.co_code)
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                code_list.append(const)
+            else:
+                hash_obj.update(repr(const).encode(Encoding.UTF8))
+
+    # the tables of the byte-level fast path are module constants, not code constants
+    hash_obj.update(UTF8_PATTERN.pattern)
+    hash_obj.update(LINE_END_TRANSLATION_TABLE)
+
+    return hash_obj.hexdigest()[:16]
+
+
+def get_default_index_filepath(inpath: str):
+    if 'XDG_CACHE_HOME' in os.environ:
+        cache_dir = os.environ['XDG_CACHE_HOME']
+    else:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache')
+
+    abs_inpath = os.path.abspath(inpath)
+    index_filename = hashlib.sha1(abs_inpath.encode(Encoding.UTF8, errors='surrogateescape')).hexdigest()[:16] + '.index'
+    return os.path.join(cache_dir, 'lf-utf8', index_filename)
+
+
+class CleanFileIndex:
+    # On-disk record of files that are known to be clean.
+    #
+    # The file is an append-only log of tab-separated lines:
+    #   lf-utf8-index <version>
+    #   <abspath> <size> <mtime_ns> <inode> <sha1>   (verified clean)
+    #   <abspath> -                                  (removed)
+    # The log is rewritten (compacted) when it contains too many stale records.
+
+    HEADER = 'lf-utf8-index'
+    MIN_COMPACTION_RECORDS = 1024
+
+    def __init__(self, index_filepath: str, version: str):
+        self.index_filepath = index_filepath
+        self.version = version
+
+        # abspath -> (size, mtime_ns, inode, digest)
+        self.entries = {}
+        self.num_records = 0
+        self.pending_records = []
+        self.needs_rewrite = True
+
+    @staticmethod
+    def stat_key(file_stat: os.stat_result):
+        return (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+
+    def load(self):
+        if not os.path.exists(self.index_filepath):
+            return
+
+        with open(self.index_filepath, mode='r', encoding=Encoding.UTF8, errors='surrogateescape', newline='\n') as infile:
+            header = infile.readline().rstrip('\n').split('\t')
+            if header != [self.HEADER, self.version]:
+                # the normalization rules changed, every entry is stale
+                return
+
+            for line in infile:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) == 5:
+                    try:
+                        self.entries[parts[0]] = (int(parts[1]), int(parts[2]), int(parts[3]), parts[4])
+                    except ValueError:
+                        continue
+                elif len(parts) == 2:
+                    self.entries.pop(parts[0], None)
+                else:
+                    continue
+
+                self.num_records += 1
+
+        self.needs_rewrite = False
+
+    def lookup(self, filepath: str, file_stat: os.stat_result):
+        # return `(is_clean, known_digest)`
+        entry = self.entries.get(os.path.abspath(filepath), None)
+        if entry is None:
+            return False, None
+
+        if entry[:3] == self.stat_key(file_stat):
+            return True, entry[3]
+
+        if entry[0] == file_stat.st_size:
+            return False, entry[3]
+
+        return False, None
+
+    def mark_clean(self, filepath: str, stat_key: typing.Tuple[int, int, int], digest: str):
+        abs_filepath = os.path.abspath(filepath)
+        if ('\t' in abs_filepath) or ('\n' in abs_filepath):
+            return
+
+        entry = (*stat_key, digest)
+        if self.entries.get(abs_filepath, None) == entry:
+            return
+
+        self.entries[abs_filepath] = entry
+        self.pending_records.append('\t'.join([abs_filepath, *[str(x) for x in entry]]))
+
+    def discard(self, filepath: str):
+        abs_filepath = os.path.abspath(filepath)
+        if abs_filepath in self.entries:
+            del self.entries[abs_filepath]
+            self.pending_records.append(f'{abs_filepath}\t-')
+
+    def save(self):
+        num_records = self.num_records + len(self.pending_records)
+        if (not self.needs_rewrite) and (num_records <= max(self.MIN_COMPACTION_RECORDS, 2 * len(self.entries))):
+            if len(self.pending_records) > 0:
+                with open(self.index_filepath, mode='a', encoding=Encoding.UTF8, errors='surrogateescape', newline='\n') as outfile:
+                    for record in self.pending_records:
+                        outfile.write(record + '\n')
+
+            self.num_records = num_records
+            self.pending_records = []
+            return
+
+        # compaction
+        index_dir = os.path.dirname(self.index_filepath)
+        if (len(index_dir) > 0) and (not os.path.exists(index_dir)):
+            os.makedirs(index_dir)
+
+        tmp_filepath = self.index_filepath + '.tmp'
+        with open(tmp_filepath, mode='w', encoding=Encoding.UTF8, errors='surrogateescape', newline='\n') as outfile:
+            outfile.write(f'{self.HEADER}\t{self.version}\n')
+            for abs_filepath, entry in self.entries.items():
+                outfile.write('\t'.join([abs_filepath, *[str(x) for x in entry]]) + '\n')
+
+        os.replace(tmp_filepath, self.index_filepath)
+
+        self.num_records = len(self.entries)
+        self.pending_records = []
+        self.needs_rewrite = False
+
+
+def iterate_work_items(filepath_iter: typing.Iterable[str], index: CleanFileIndex = None):
+    # yield `(filepath, known_digest, local_result)`
+    # `local_result` is not None if the file is clean according to the index
+    for filepath in filepath_iter:
+        if index is None:
+            yield filepath, None, None
+            continue
+
+        with TRACER.span('index', filepath):
+            try:
+                file_stat = os.stat(filepath)
+            except OSError:
+                file_stat = None
+
+            if file_stat is not None:
+                is_clean, known_digest = index.lookup(filepath, file_stat)
+
+        if file_stat is None:
+            yield filepath, None, None
+            continue
+
+        if is_clean:
+            yield filepath, None, {'diff': False, 'indexed': True}
+        else:
+            yield filepath, known_digest, None
+
+
+def iterate_check_results(
+    filepath_iter: typing.Iterable[str],
+    jobs: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    index: CleanFileIndex = None,
+    is_run: bool = False,
+):
+    # yield `(filepath, result)` in the same order as `filepath_iter`
+    # with `is_run` the changed files larger than MAX_FILESIZE are formatted into temporary files
+    with_digest = (index is not None)
+    work_iter = iterate_work_items(filepath_iter, index)
+
+    def finish_result(filepath: str, known_digest: str, format_result: typing.Optional[dict]):
+        # `format_result` is None if the file was not checked because its extension was known to be binary.
+        # The verdict of BINARY_EXTENSION_CACHE only depends on the results of the earlier files.
+        ext = os.path.splitext(filepath)[1].lower()
+        if BINARY_EXTENSION_CACHE.is_known_binary(ext):
+            if (format_result is not None) and ('temp_filepath' in format_result):
+                os.remove(format_result['temp_filepath'])
+
+            return {'ignored': True, 'binary': True}
+
+        if format_result is None:
+            # a text file with the same extension came after the file was skipped
+            format_result = check_text_file(filepath, known_digest, with_digest, is_run)
+
+        if not format_result.get('indexed', False):
+            BINARY_EXTENSION_CACHE.record_result(filepath, format_result)
+
+        return format_result
+
+    if jobs <= 1:
+        for filepath, known_digest, local_result in work_iter:
+            yield filepath, finish_result(filepath, known_digest, local_result)
+        return
+
+    # Files are sent to the worker processes in chunks so the IPC overhead stays low for tiny files.
+    # Only a bounded number of chunks is in flight so `filepath_iter` does not need to be a list.
+    max_pending_chunks = jobs * 2
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+
+        def submit_next_chunk():
+            # `item_list` has every file in order, `(filepath, known_digest, local_result, is_sent)`
+            item_list = []
+            chunk = []
+            for filepath, known_digest, local_result in work_iter:
+                ext = os.path.splitext(filepath)[1].lower()
+                is_sent = (local_result is None) and (not BINARY_EXTENSION_CACHE.is_known_binary(ext))
+                item_list.append((filepath, known_digest, local_result, is_sent))
+                if is_sent:
+                    chunk.append((filepath, known_digest))
+
+                if len(item_list) >= chunk_size:
+                    break
+
+            if len(item_list) == 0:
+                return False
+
+            future = None
+            if len(chunk) > 0:
+                future = executor.submit(check_text_file_chunk, chunk, with_digest, is_run, TRACER.enabled)
+
+            pending.append((item_list, future))
+            return True
+
+        while len(pending) < max_pending_chunks:
+            if not submit_next_chunk():
+                break
+
+        while len(pending) > 0:
+            item_list, future = pending.popleft()
+
+            result_iter = iter([])
+            if future is not None:
+                result_list, span_list = future.result()
+                TRACER.add_spans(span_list)
+                result_iter = iter(result_list)
+
+            for filepath, known_digest, local_result, is_sent in item_list:
+                format_result = next(result_iter) if is_sent else local_result
+                yield filepath, finish_result(filepath, known_digest, format_result)
+
+            submit_next_chunk()
+
+
+def report_check_results(
+    check_results: typing.Iterable[typing.Tuple[str, dict]],
+    reporter: ProgressReporter,
+    is_run: bool,
+    index: CleanFileIndex = None,
+):
+    # write the changes (with `is_run`) and update the index
+    # the summary is written even if formatting fails
+    try:
+        for filepath, format_result in check_results:
+            if format_result.get('ignored', False):
+                reporter.update(filepath, 'skipped', 'binary' if format_result.get('binary', False) else 'ignored')
+                continue
+
+            if format_result.get('indexed', False):
+                reporter.update(filepath, 'ok', f'{G}OK{RS} (indexed)')
+                continue
+
+            filesize = format_result.get('filesize', 0)
+            decoded_encoding = format_result.get('encoding', None)
+
+            if 'error' in format_result:
+                error_msg = format_result['error']
+                reporter.update(filepath, 'error', f'- {R}{error_msg}{RS}', filesize)
+                if index is not None:
+                    index.discard(filepath)
+                continue
+
+            if format_result['diff']:
+                if is_run:
+                    with TRACER.span('write', filepath) as span:
+                        if 'temp_filepath' in format_result:
+                            os.replace(format_result['temp_filepath'], filepath)
+                        else:
+                            content_bs = format_result['content_bs']
+                            span.num_bytes = len(content_bs)
+                            os.remove(filepath)  # file content may not be changed if we don't remove it
+                            with open(filepath, mode='wb') as outfile:
+                                outfile.write(content_bs)
+
+                    if index is not None:
+                        # `format_text_file_content` is not idempotent (e.g. `'   \nfoo\n'` -> `'\nfoo\n'` -> `'foo\n'`),
+                        # the written content is only recorded if the next check would find it clean
+                        if 'temp_filepath' in format_result:
+                            is_clean = is_normalized_utf8_file(filepath)
+                            digest = hash_file(filepath) if is_clean else None
+                        else:
+                            is_clean = is_normalized_utf8_buffer(content_bs) or (not format_text_file_bytes(content_bs).get('diff', True))
+                            digest = hashlib.sha1(content_bs).hexdigest()
+
+                        if is_clean:
+                            index.mark_clean(filepath, CleanFileIndex.stat_key(os.stat(filepath)), digest)
+                        else:
+                            index.discard(filepath)
+
+                    reporter.update(filepath, 'fixed', f'{G}{decoded_encoding}{RS} {R}x{RS} -> {G}OK{RS}', filesize)
+                else:
+                    if 'temp_filepath' in format_result:
+                        os.remove(format_result['temp_filepath'])
+
+                    if index is not None:
+                        index.discard(filepath)
+
+                    reporter.update(filepath, 'changed', f'{G}{decoded_encoding}{RS} {R}x{RS}', filesize)
+            else:
+                if index is not None:
+                    index.mark_clean(filepath, format_result['stat'], format_result['digest'])
+
+                reporter.update(filepath, 'ok', f'{G}{decoded_encoding}{RS} {G}OK{RS}', filesize)
+
+    finally:
+        reporter.close()
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -261,15 +1662,31 @@ def main():
     parser.add_argument('-noautogit', '--noautogit', action='store_true')
     parser.add_argument('-r', '--r', '-run', '--run', dest='run', action='store_true')
     parser.add_argument('-v', '--v', '-verbose', '--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--since', dest='since', default=None, help='only files added, copied, modified or renamed since this git revision')
+    parser.add_argument('--staged', dest='staged', action='store_true', help='only files with staged changes')
+    parser.add_argument('-j', '--j', '-jobs', '--jobs', dest='jobs', type=int, default=1, help='number of worker processes (0 to use all CPUs)')
+    parser.add_argument('--index', dest='index', nargs='?', const='', default=None, help='skip files that are recorded as clean in this index file (default location if no path is given)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=DEFAULT_CHUNK_SIZE, help='number of files sent to a worker process at once')
+    parser.add_argument('--stats', dest='stats', action='store_true', help='print count, total, p50/p95/max time and bytes of each phase')
+    parser.add_argument('--trace', dest='trace', default=None, help='write one span per file and phase to this file in Chrome trace-event format')
+    parser.add_argument('--watch', dest='watch', action='store_true', help='keep formatting the files as they change (Linux only)')
 
     args = parser.parse_args()
     print(args)
 
+    if args.watch and (not os.path.isdir(args.infile)):
+        raise Exception('--watch requires a directory')
+
+    TRACER.enabled = args.stats or (args.trace is not None)
+
     inpath = args.infile
     use_git = args.git
     no_auto_git = args.noautogit
     is_run = args.run
     verbose = args.verbose
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
 
     filepath_list = []
 
@@ -278,55 +1695,75 @@ def main():
     elif os.path.isfile(inpath):
         filepath_list.append(inpath)
     elif os.path.isdir(inpath):
-        if not no_auto_git:
+        if (args.since is not None) or args.staged:
+            use_git = True
+        elif not no_auto_git:
             child_filename_list = os.listdir(inpath)
             use_git = ('.git' in child_filename_list)
 
-        if use_git:
-            filepath_list = find_regular_files_from_git(inpath)
-        else:
-            filepath_list = find_regular_files(inpath)
-
-    MAX_FILESIZE = 1024 * 1024 * 10  # 10 MBs
-    for filepath in filepath_list:
-        print('>', filepath, end='')
-
-        basename = os.path.basename(filepath)
-        ext = os.path.splitext(basename)[1]
-
-        # git will not filter these extensions
-        if ext.lower() in IGNORED_EXTS:
-            print('\r', end='')
-            continue
-
-        filesize = os.path.getsize(filepath)
-        if (filesize == 0) or (filesize > MAX_FILESIZE):
-            print(f' - {R}file is too big ({filesize}){RS}', flush=True)
-            continue
-
-        format_result = format_text_file(filepath)
-        decoded_encoding = format_result.get('encoding', None)
-
-        if 'error' in format_result:
-            error_msg = format_result['error']
-            print(f' - {R}{error_msg}{RS}', flush=True)
-            continue
-
-        if format_result['diff']:
-            if is_run:
-                content_bs = format_result['content_bs']
-                os.remove(filepath)  # file content may not be changed if we don't remove it
-                with open(filepath, mode='wb') as outfile:
-                    outfile.write(content_bs)
-
-                print(f' {G}{decoded_encoding}{RS} {R}x{RS} -> {G}OK{RS}', flush=True)
-            else:
-                print(f' {G}{decoded_encoding}{RS} {R}x{RS}', flush=True)
-        else:
-            if verbose:
-                print(f' {G}{decoded_encoding}{RS} {G}OK{RS}', flush=True)
+        with TRACER.span('discover'):
+            if use_git:
+                filepath_list = find_regular_files_from_git(inpath, since=args.since, staged=args.staged)
+            elif TRACER.enabled:
+                # the walk is timed on its own instead of being interleaved with the checks
+                filepath_list = find_regular_files(inpath)
             else:
-                print('\r', end='')
+                # formatting starts before the walk finishes
+                filepath_list = iter_regular_files(inpath)
+
+    index = None
+    if args.index is not None:
+        index_filepath = args.index
+        if len(index_filepath) == 0:
+            index_filepath = get_default_index_filepath(inpath)
+
+        index = CleanFileIndex(index_filepath, get_normalization_version())
+        index.load()
+
+    # the total is unknown while the directory is walked
+    total_files = len(filepath_list) if isinstance(filepath_list, list) else None
+    reporter = ProgressReporter(total_files, verbose)
+
+    try:
+        check_results = iterate_check_results(
+            filepath_list,
+            jobs=jobs,
+            chunk_size=max(1, args.chunk_size),
+            index=index,
+            is_run=is_run,
+        )
+
+        report_check_results(check_results, reporter, is_run, index)
+
+        if index is not None:
+            index.save()
+
+        if args.watch:
+            def process_batch(batch: typing.List[str]):
+                batch_reporter = ProgressReporter(len(batch), verbose)
+                check_results = iterate_check_results(
+                    batch,
+                    jobs=jobs,
+                    chunk_size=max(1, args.chunk_size),
+                    index=index,
+                    is_run=is_run,
+                )
+
+                report_check_results(check_results, batch_reporter, is_run, index)
+
+                if index is not None:
+                    index.save()
+
+            watch_files(inpath, lambda filepath: True, process_batch, use_git=use_git)
+    finally:
+        if index is not None:
+            index.save()
+
+        if args.stats:
+            TRACER.print_stats()
+
+        if args.trace is not None:
+            TRACER.write_trace(args.trace)
 
 
 if __name__ == '__main__':
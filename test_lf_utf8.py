@@ -0,0 +1,64 @@
+import os
+import importlib.util
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(filename: str):
+    # the scripts are not importable by name (e.g. `lf-utf8.py`)
+    module_name = os.path.splitext(filename)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+lf_utf8 = load_script('lf-utf8.py')
+
+
+def run_with_index(filepath: str, index_filepath: str, is_run: bool):
+    index = lf_utf8.CleanFileIndex(index_filepath, lf_utf8.get_normalization_version())
+    index.load()
+
+    result_list = list(lf_utf8.iterate_check_results([filepath], index=index, is_run=is_run))
+    lf_utf8.report_check_results(result_list, lf_utf8.ProgressReporter(1), is_run, index)
+    index.save()
+    return result_list[0][1]
+
+
+def test_run_does_not_index_content_that_is_still_not_normalized(tmp_path):
+    # `'   \nfoo\n'` -> `'\nfoo\n'` -> `'foo\n'`, one pass leaves a leading empty line
+    filepath = str(tmp_path / 'a.txt')
+    index_filepath = str(tmp_path / 'index')
+    with open(filepath, mode='wb') as outfile:
+        outfile.write(b'   \nfoo\n')
+
+    assert run_with_index(filepath, index_filepath, is_run=True)['diff']
+    with open(filepath, mode='rb') as infile:
+        assert infile.read() == b'\nfoo\n'
+
+    format_result = run_with_index(filepath, index_filepath, is_run=False)
+    assert not format_result.get('indexed', False)
+    assert format_result['diff']
+
+
+def test_run_indexes_normalized_content(tmp_path):
+    filepath = str(tmp_path / 'a.txt')
+    index_filepath = str(tmp_path / 'index')
+    with open(filepath, mode='wb') as outfile:
+        outfile.write(b'foo \r\nbar\r\n')
+
+    assert run_with_index(filepath, index_filepath, is_run=True)['diff']
+    assert run_with_index(filepath, index_filepath, is_run=False).get('indexed', False)
+
+
+def test_run_does_not_index_large_content_that_is_still_not_normalized(tmp_path, monkeypatch):
+    # files larger than MAX_FILESIZE are formatted into a temporary file
+    monkeypatch.setattr(lf_utf8, 'MAX_FILESIZE', 4)
+    filepath = str(tmp_path / 'a.txt')
+    index_filepath = str(tmp_path / 'index')
+    with open(filepath, mode='wb') as outfile:
+        outfile.write(b'   \nfoo\n')
+
+    assert run_with_index(filepath, index_filepath, is_run=True)['diff']
+    assert run_with_index(filepath, index_filepath, is_run=False)['diff']
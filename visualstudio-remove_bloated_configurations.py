@@ -1,6 +1,7 @@
 import os
-import stat
+import re
 import argparse
+import typing
 
 IGNORED_FILE_NAMES = [
     '.git',
@@ -9,34 +10,104 @@ IGNORED_FILE_NAMES = [
 ]
 
 
+def iter_visual_studio_config_files(inpath: str) -> typing.Iterator[str]:
+    # only the names are compared, `os.scandir` entries do not need a `stat` call
+    if os.path.basename(inpath).lower() in IGNORED_FILE_NAMES:
+        return
+
+    if not os.path.isdir(inpath):
+        if os.path.isfile(inpath) and (os.path.splitext(inpath.lower())[1] in ('.sln', '.vcxproj')):
+            yield inpath
+        return
+
+    dirpath_stack = [inpath]
+    while len(dirpath_stack) > 0:
+        with os.scandir(dirpath_stack.pop()) as entry_iter:
+            for entry in entry_iter:
+                if entry.name.lower() in IGNORED_FILE_NAMES:
+                    continue
+
+                if entry.is_dir():
+                    dirpath_stack.append(entry.path)
+                elif entry.is_file() and (os.path.splitext(entry.name.lower())[1] in ('.sln', '.vcxproj')):
+                    yield entry.path
+
+
 def find_visual_studio_config_files(
     inpath: str,
     solution_file_list: list,
     vcxproj_file_list: list,
 ):
-    _, filename = os.path.split(inpath)
-    lowered_filename = filename.lower()
+    for filepath in iter_visual_studio_config_files(inpath):
+        _, ext = os.path.splitext(filepath.lower())
+        if ext == '.sln':
+            solution_file_list.append(filepath)
+        else:
+            vcxproj_file_list.append(filepath)
 
-    if lowered_filename in IGNORED_FILE_NAMES:
-        return
 
-    file_stat = os.stat(inpath)
+def find_longest_common_substring(string_list: typing.List[str]):
+    # the blacklists are short so every substring of the shortest string is tried, longest first
+    shortest_string = min(string_list, key=len)
+    for length in range(len(shortest_string), 0, -1):
+        substring_list = [shortest_string[idx:idx + length] for idx in range(len(shortest_string) - length + 1)]
+        substring_list = [x for x in substring_list if all([x in y for y in string_list])]
+        if len(substring_list) > 0:
+            # punctuation (e.g. `|`) is rarer than letters in the project files
+            return min(substring_list, key=lambda x: (sum([c.isalnum() for c in x]), x))
+
+    return ''
+
+
+def compile_substring_matcher(string_list: typing.List[str]):
+    # Compile the strings into one regex that matches if any of them is in the searched text.
+    # A plain alternation makes the regex engine try every alternative at every position,
+    # so every match starts at a substring that all the strings share instead (e.g. `|`).
+    # The regex engine skips ahead to that literal with a fast search
+    # and the rest of each string is checked around it with a lookbehind.
+    unique_string_list = sorted(set(string_list))
+    anchor = find_longest_common_substring(unique_string_list)
+    if len(anchor) == 0:
+        return re.compile('|'.join([re.escape(x) for x in unique_string_list]))
+
+    alternative_list = []
+    for x in unique_string_list:
+        suffix_idx = x.find(anchor) + len(anchor)
+        alternative_list.append(f'(?<={re.escape(x[:suffix_idx])}){re.escape(x[suffix_idx:])}')
+
+    return re.compile(re.escape(anchor) + '(?:' + '|'.join(alternative_list) + ')')
+
+
+def normalize_lines(content_str: str):
+    # the lines of `str.splitlines`, each line ends with a line feed
+    return '\n'.join(content_str.splitlines()) + '\n'
+
+
+def remove_line_spans(content_str: str, span_list: typing.List[typing.Tuple[int, int]]):
+    # `span_list` are sorted `(start, end)` spans of whole lines in `content_str`
+    if len(span_list) == 0:
+        return content_str
+
+    part_list = []
+    offset = 0
+    for span_start, span_end in span_list:
+        part_list.append(content_str[offset:span_start])
+        offset = span_end
+    part_list.append(content_str[offset:])
+
+    output_str = ''.join(part_list)
+    if len(output_str) == 0:
+        # there is always a line feed, even without lines
+        return '\n'
+
+    return output_str
 
-    if stat.S_ISREG(file_stat.st_mode):
-        _, ext = os.path.splitext(lowered_filename)
-        if ext == '.sln':
-            solution_file_list.append(inpath)
-        elif ext == '.vcxproj':
-            vcxproj_file_list.append(inpath)
-    elif stat.S_ISDIR(file_stat.st_mode):
-        child_filename_list = os.listdir(inpath)
-        for child_filename in child_filename_list:
-            child_filepath = os.path.join(inpath, child_filename)
-            find_visual_studio_config_files(
-                child_filepath,
-                solution_file_list,
-                vcxproj_file_list,
-            )
+
+def get_line_span(content_str: str, idx: int):
+    # `(line_start, next_line_start)` of the line that contains `content_str[idx]`
+    line_start = content_str.rfind('\n', 0, idx) + 1
+    line_end = content_str.find('\n', idx)
+    return line_start, line_end + 1
 
 
 SOLUTION_FILE_BLACKLIST_CONFIG = [
@@ -45,32 +116,37 @@ SOLUTION_FILE_BLACKLIST_CONFIG = [
     'Release|x64',
 ]
 
+# the rest of the line is part of the match so each blacklisted line is found once
+SOLUTION_FILE_BLACKLIST_LINE_MATCHER = re.compile(compile_substring_matcher(SOLUTION_FILE_BLACKLIST_CONFIG).pattern + '[^\n]*\n')
 
-def remove_visual_studio_config_from_solution_file(inpath: str):
-    content_bs = open(inpath, 'rb').read()
-    content_str = content_bs.decode('utf-8')
-    lines = content_str.splitlines()
-
-    output_lines = []
-    for line in lines:
-        detected = False
-        for s in SOLUTION_FILE_BLACKLIST_CONFIG:
-            if s in line:
-                detected = True
-                break
-
-        if detected:
-            continue
 
-        output_lines.append(line)
+def find_solution_blacklist_line_spans(content_str: str):
+    # Return the spans of the lines that contain a blacklisted string, adjacent lines are merged.
+    # `content_str` is normalized by `normalize_lines`, the blacklisted strings cannot span lines.
+    span_list = []
+    for match in SOLUTION_FILE_BLACKLIST_LINE_MATCHER.finditer(content_str):
+        line_start, next_line_start = get_line_span(content_str, match.start())
+        if (len(span_list) > 0) and (span_list[-1][1] == line_start):
+            span_list[-1] = (span_list[-1][0], next_line_start)
+        else:
+            span_list.append((line_start, next_line_start))
+
+    return span_list
 
-    output_str = '\n'.join(output_lines)
-    output_str += '\n'
+
+def remove_visual_studio_config_from_solution_content(content_bs: bytes):
+    content_str = normalize_lines(content_bs.decode('utf-8'))
+    output_str = remove_line_spans(content_str, find_solution_blacklist_line_spans(content_str))
     output_bs = output_str.encode('utf-8')
     is_diff = (content_bs != output_bs)
     return is_diff, output_bs
 
 
+def remove_visual_studio_config_from_solution_file(inpath: str):
+    content_bs = open(inpath, 'rb').read()
+    return remove_visual_studio_config_from_solution_content(content_bs)
+
+
 VXCPROJ_FILE_BLACKLIST_STRING_LIST = [
     'Debug|Win32',
     'Release|Win32',
@@ -85,43 +161,66 @@ VCXPROJ_FILE_BLACKLIST_CONFIG_INFO_LIST = [
     ('PropertyGroup', 'Condition', VXCPROJ_FILE_BLACKLIST_STRING_LIST),
 ]
 
+# a line can only start a removed element if it contains one of the attribute values
+VCXPROJ_FILE_BLACKLIST_MATCHER = compile_substring_matcher([
+    attribute_value
+    for _, _, attribute_value_list in VCXPROJ_FILE_BLACKLIST_CONFIG_INFO_LIST
+    for attribute_value in attribute_value_list
+])
+
+
+def get_vcxproj_blacklist_tag_name(line: str):
+    # the tag of the first entry of `VCXPROJ_FILE_BLACKLIST_CONFIG_INFO_LIST` that matches the line
+    for tag_name, attribute_name, attribute_value_list in VCXPROJ_FILE_BLACKLIST_CONFIG_INFO_LIST:
+        if (tag_name in line) and (attribute_name in line):
+            for attribute_value in attribute_value_list:
+                if attribute_value in line:
+                    return tag_name
+
+    return None
+
+
+def find_vcxproj_blacklist_line_spans(content_str: str):
+    # Return the spans from each line that opens a blacklisted element
+    # to the end of the next line that contains its closing tag.
+    # `content_str` is normalized by `normalize_lines`
+    # and only the lines found by `VCXPROJ_FILE_BLACKLIST_MATCHER` are checked in Python.
+    span_list = []
+
+    match = VCXPROJ_FILE_BLACKLIST_MATCHER.search(content_str)
+    while match is not None:
+        line_start, next_line_start = get_line_span(content_str, match.start())
+        tag_name = get_vcxproj_blacklist_tag_name(content_str[line_start:next_line_start - 1])
+        if tag_name is None:
+            match = VCXPROJ_FILE_BLACKLIST_MATCHER.search(content_str, next_line_start)
+            continue
 
-def remove_visual_studio_config_from_vcxproj_file(inpath: str):
-    content_bs = open(inpath, 'rb').read()
-    content_str = content_bs.decode('utf-8')
-    lines = content_str.splitlines()
+        # the closing tag is searched from the next line, everything up to the end is removed without it
+        closing_tag_idx = content_str.find(f'</{tag_name}>', next_line_start)
+        if closing_tag_idx < 0:
+            span_list.append((line_start, len(content_str)))
+            break
 
-    output_lines = []
+        _, span_end = get_line_span(content_str, closing_tag_idx)
+        span_list.append((line_start, span_end))
+        match = VCXPROJ_FILE_BLACKLIST_MATCHER.search(content_str, span_end)
 
-    ignoring_tag_name = None
-    for line in lines:
-        if ignoring_tag_name is not None:
-            if f'</{ignoring_tag_name}>' in line:
-                ignoring_tag_name = None
-            continue
-        else:
-            detected = False
-            for tag_name, attribute_name, attribute_value_list in VCXPROJ_FILE_BLACKLIST_CONFIG_INFO_LIST:
-                if (tag_name in line) and (attribute_name in line):
-                    for attribute_value in attribute_value_list:
-                        if attribute_value in line:
-                            ignoring_tag_name = tag_name
-                            detected = True
-                            break
-                    if detected:
-                        break
-            if detected:
-                continue
-            else:
-                output_lines.append(line)
-
-    output_str = '\n'.join(output_lines)
-    output_str += '\n'
+    return span_list
+
+
+def remove_visual_studio_config_from_vcxproj_content(content_bs: bytes):
+    content_str = normalize_lines(content_bs.decode('utf-8'))
+    output_str = remove_line_spans(content_str, find_vcxproj_blacklist_line_spans(content_str))
     output_bs = output_str.encode('utf-8')
     is_diff = (content_bs != output_bs)
     return is_diff, output_bs
 
 
+def remove_visual_studio_config_from_vcxproj_file(inpath: str):
+    content_bs = open(inpath, 'rb').read()
+    return remove_visual_studio_config_from_vcxproj_content(content_bs)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('inpath', nargs='?', default='.')